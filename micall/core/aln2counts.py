@@ -23,7 +23,8 @@ import os
 
 from micall.core import miseq_logging
 from micall.core import project_config
-from micall.utils.translation import translate, ambig_dict
+from micall.utils.aligned_deltas import read_aligned_rows
+from micall.utils.translation import translate, ambig_dict, amino_table
 from micall.alignment import gotoh2
 
 AMINO_ALPHABET = 'ACDEFGHIKLMNPQRSTVWY*'
@@ -118,6 +119,12 @@ class SequenceReport(object):
         Populates self.seed_aminos with SeedAmino objects that count the number
         of amino acids at each codon position, for all three reading frames.
 
+        Every nucleotide position starts a codon in one of the reading frames,
+        so each read is scanned once, counting the three letters that start
+        at each position in a table of trigram counts. Then each distinct
+        trigram is counted in its SeedAmino, in the order they were first
+        read, so ties are broken the same way as counting each read.
+
         :param aligned_reads: a List of Dicts from csv.DictReader
         :return:
         """
@@ -129,6 +136,9 @@ class SequenceReport(object):
             self.seed = first_row['refname']
             self.qcut = first_row['qcut']
 
+        # [{trigram: count}] for each position, starting at -2
+        trigram_counts = []
+        frame_lengths = [0, 0, 0]  # codons in each reading frame
         for row in aligned_reads:
             nuc_seq = row['seq']
             offset = int(row['offset'])
@@ -150,23 +160,41 @@ class SequenceReport(object):
             # record this read to calculate insertions later
             self.insert_writer.add_nuc_read('-'*offset + nuc_seq, count)
 
-            # cycle through reading frames
-            for reading_frame, frame_seed_aminos in self.seed_aminos.items():
-                offset_nuc_seq = '-' * (reading_frame + offset) + nuc_seq
-                # pad to a codon boundary
-                offset_nuc_seq += '-' * ((3 - (len(offset_nuc_seq) % 3)) % 3)
-                start = offset - (offset % 3)
-
-                for nuc_pos in range(start, len(offset_nuc_seq), 3):
-                    codon_index = int(nuc_pos / 3)
-
-                    # append SeedAmino objects to this list if necessary
-                    while len(frame_seed_aminos) <= codon_index:
-                        frame_seed_aminos.append(SeedAmino(len(frame_seed_aminos)))
-
-                    # update amino acid counts
-                    codon = offset_nuc_seq[nuc_pos:nuc_pos + 3]
-                    frame_seed_aminos[codon_index].count_aminos(codon, count)
+            # Codons start at the codon boundary before offset in reading
+            # frame 0, and the two positions before it in frames 2 and 1.
+            start = offset - (offset % 3) - 2
+            end = offset + len(nuc_seq)
+            first_codon = offset // 3
+            for reading_frame in range(3):
+                frame_length = (reading_frame + end + 2) // 3
+                # An empty read on a codon boundary has no codons in frame 0.
+                if frame_length > first_codon:
+                    frame_lengths[reading_frame] = max(
+                        frame_lengths[reading_frame],
+                        frame_length)
+            padded_seq = '-' * (offset - start) + nuc_seq + '--'
+            missing_count = end + 2 - len(trigram_counts)
+            if missing_count > 0:
+                trigram_counts.extend({} for _ in range(missing_count))
+            for i, position_counts in enumerate(
+                    trigram_counts[start+2:end+2]):
+                trigram = padded_seq[i:i+3]
+                position_counts[trigram] = (
+                    position_counts.get(trigram, 0) + count)
+
+        for reading_frame in range(3 if self.seed_aminos else 0):
+            self.seed_aminos[reading_frame] = [
+                SeedAmino(codon_index)
+                for codon_index in range(frame_lengths[reading_frame])]
+        for index, position_counts in enumerate(trigram_counts):
+            if not position_counts:
+                continue
+            nuc_pos = index - 2
+            reading_frame = -nuc_pos % 3
+            codon_index = (nuc_pos + reading_frame) // 3
+            seed_amino = self.seed_aminos[reading_frame][codon_index]
+            for codon, count in position_counts.items():
+                seed_amino.count_aminos(codon, count)
 
         if self.callback:
             self.callback(progress=self.callback_max)
@@ -598,7 +626,10 @@ class SeedAmino(object):
                           position
         @param count: the number of times they were read
         """
-        amino = translate(codon_seq.upper())
+        codon = codon_seq.upper()
+        amino = amino_table.get(codon)
+        if amino is None:
+            amino = translate(codon)
         if amino in AMINO_ALPHABET:
             self.counts[amino] += count
 
@@ -832,7 +863,8 @@ def aln2counts(aligned_csv,
     """
     Analyze aligned reads for nucleotide and amino acid frequencies.
     Generate consensus sequences.
-    @param aligned_csv:         Open file handle containing aligned reads (from sam2aln)
+    @param aligned_csv:         Open file handle containing aligned reads (from sam2aln),
+                                in the plain or delta format
     @param nuc_csv:             Open file handle to write nucleotide frequencies.
     @param amino_csv:           Open file handle to write amino acid frequencies.
     @param coord_ins_csv:       Open file handle to write insertions relative to coordinate reference.
@@ -881,7 +913,7 @@ def aln2counts(aligned_csv,
             report.enable_callback(callback, file_size)
 
     # parse CSV file containing aligned reads, grouped by reference and quality cutoff
-    aligned_reader = csv.DictReader(aligned_csv)
+    aligned_reader = read_aligned_rows(aligned_csv)
     for _key, aligned_reads in groupby(aligned_reader,
                                        lambda row: (row['refname'], row['qcut'])):
         report.read(aligned_reads)
@@ -9,14 +9,18 @@ Convert to CSV format and write to file.
 """
 
 import argparse
-import csv
+import gzip as gzip_module
 import logging
+import math
 import os
 import sys
 
 from micall.core import miseq_logging
 from micall.core import project_config
+from micall.utils.amplicon_mapper import AmpliconMapper
+from micall.utils.cpu_budget import CpuBudget
 from micall.utils.externals import Bowtie2, Bowtie2Build, LineCounter
+from micall.utils.packed_sam import PackedSamWriter, create_sam_writer
 
 BOWTIE_THREADS = 4    # Bowtie performance roughly scales with number of threads
 BOWTIE_VERSION = '2.2.8'        # version of bowtie2, used for version control
@@ -37,13 +41,15 @@ def prelim_map(fastq1, fastq2, prelim_csv,
                bt2_path='bowtie2', bt2build_path='bowtie2-build-s',
                nthreads=BOWTIE_THREADS, callback=None,
                rdgopen=READ_GAP_OPEN, rfgopen=REF_GAP_OPEN, stderr=sys.stderr,
-               gzip=False, work_path='', keep=False, json=None):
+               gzip=False, work_path='', keep=False, json=None, max_pairs=None,
+               shard_count=1, mapper='bowtie2', cpu_budget=None):
     """ Run the preliminary mapping step.
 
     @param fastq1: the file name for the forward reads in FASTQ format
     @param fastq2: the file name for the reverse reads in FASTQ format
     @param prelim_csv: an open file object for the output file - all the reads
-        mapped to references in CSV version of the SAM format
+        mapped to references in CSV version of the SAM format, or in the
+        packed binary format if the file was opened in binary mode
     @param nthreads: the number of threads to use.
     @param callback: a function to report progress with three optional
         parameters - callback(message, progress, max_progress)
@@ -54,10 +60,22 @@ def prelim_map(fastq1, fastq2, prelim_csv,
     @param work_path:  optional path to store working files
     @param keep: if False, delete temporary files
     @param json: specify a custom JSON project file; None loads the default file.
+    @param max_pairs: if set, only map an evenly spaced sample of this many
+        read pairs. That is enough to choose seeds, and remap() will scale the
+        counts up when it is told that the preliminary map was subsampled.
+    @param shard_count: the number of bowtie2 processes to split the reads
+        and threads between.
+    @param mapper: 'bowtie2', or 'amplicon' to map in this process, which is
+        faster for small references. See AmpliconMapper.
+    @param cpu_budget: a CpuBudget to reserve bowtie2's threads from, shared
+        with other steps. If None, nthreads are used.
     """
 
-    bowtie2 = Bowtie2(execname=bt2_path)
-    bowtie2_build = Bowtie2Build(execname=bt2build_path, logger=logger)
+    if mapper == 'amplicon':
+        bowtie2 = bowtie2_build = AmpliconMapper(logger=logger)
+    else:
+        bowtie2 = Bowtie2(execname=bt2_path)
+        bowtie2_build = Bowtie2Build(execname=bt2build_path, logger=logger)
 
     # check that the inputs exist
     if not os.path.exists(fastq1):
@@ -86,13 +104,28 @@ def prelim_map(fastq1, fastq2, prelim_csv,
                 pass
             fastq2 += '.gz'
 
-    if callback:
+    if callback or max_pairs:
         # four lines per read, two files
         total_reads = line_counter.count(fastq1, gzip=gzip) / 2
+    if callback:
         callback(message='... preliminary mapping',
                  progress=0,
                  max_progress=total_reads)
 
+    sample_paths = []
+    if max_pairs and total_reads / 2 > max_pairs:
+        sample_paths = [os.path.join(work_path, 'prelim_sample_R1.fastq')]
+        if fastq2 is not None:
+            sample_paths.append(os.path.join(work_path, 'prelim_sample_R2.fastq'))
+        # keep every nth pair, so the sample covers all the tiles
+        step = int(math.ceil(total_reads / 2 / max_pairs))
+        sources = [fastq1] if fastq2 is None else [fastq1, fastq2]
+        for source, sample_path in zip(sources, sample_paths):
+            with open(sample_path, 'w') as sample:
+                write_fastq_sample(source, sample, step, max_pairs, gzip)
+        fastq1 = sample_paths[0]
+        fastq2 = sample_paths[1] if fastq2 is not None else None
+
     # generate initial reference files
     if json is None:
         projects = project_config.ProjectConfig.loadDefault()
@@ -114,41 +147,43 @@ def prelim_map(fastq1, fastq2, prelim_csv,
     bowtie_args = [
         '--wrapper', 'micall-0',
         '--quiet',
-        '-x', reffile_template
-    ]
-    
-    if fastq2 is None:
-        bowtie_args.extend(['-U', fastq1])
-    else:
-        bowtie_args.extend(['-1', fastq1, '-2', fastq2])
-    
-    bowtie_args.extend([
+        '-x', reffile_template,
         '--rdg', "{},{}".format(read_gap_open_penalty, READ_GAP_EXTEND),
         '--rfg', "{},{}".format(ref_gap_open_penalty, REF_GAP_EXTEND),
         '--no-hd',  # no header lines (start with @)
-        '-X', '1200',  # maximum fragment length
-        '-p', str(nthreads)
-    ])
-    
-
-    for i, line in enumerate(bowtie2.yield_output(bowtie_args, stderr=stderr)):
-        if callback and i % 1000 == 0:
-            callback(progress=i)
-        refname = line.split('\t')[2]  # read was mapped to this reference
-        if refname not in output:
-            output.update({refname: []})
-        output[refname].append(line.split('\t')[:11])  # discard optional items
+        '-X', '1200'  # maximum fragment length
+    ]
+    if cpu_budget is None:
+        cpu_budget = CpuBudget(nthreads)
+    with cpu_budget.reserve(nthreads) as mapping_threads:
+        mapped_lines = bowtie2.yield_mapping(bowtie_args,
+                                             fastq1,
+                                             fastq2,
+                                             nthreads=mapping_threads,
+                                             shard_count=shard_count,
+                                             work_path=work_path,
+                                             stderr=stderr)
+
+        for i, line in enumerate(mapped_lines):
+            if callback and i % 1000 == 0:
+                callback(progress=i)
+            refname = line.split('\t')[2]  # read was mapped to this reference
+            if refname not in output:
+                output.update({refname: []})
+            output[refname].append(line.split('\t')[:11])  # discard optional items
 
     fieldnames = [
         'qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext', 'pnext', 'tlen', 'seq', 'qual'
     ]
-    writer = csv.DictWriter(prelim_csv, fieldnames, lineterminator=os.linesep)
+    writer = create_sam_writer(prelim_csv, fieldnames)
     writer.writeheader()
 
     # lines grouped by refname
     for refname, lines in output.items():
         for line in lines:
             writer.writerow(dict(zip(fieldnames, line)))
+    if isinstance(writer, PackedSamWriter):
+        writer.close()
 
     if callback:
         # Track progress for second half
@@ -158,7 +193,35 @@ def prelim_map(fastq1, fastq2, prelim_csv,
     if not keep:
         os.remove(ref_path)
         for suffix in ['1', '2', '3', '4', 'rev.1', 'rev.2']:
-            os.remove('{}.{}.bt2'.format(reffile_template, suffix))
+            index_path = '{}.{}.bt2'.format(reffile_template, suffix)
+            if os.path.exists(index_path):
+                # not written by the amplicon mapper
+                os.remove(index_path)
+        for sample_path in sample_paths:
+            os.remove(sample_path)
+
+
+def write_fastq_sample(fastq, sample, step, max_reads, gzip=False):
+    """ Copy every nth read from a FASTQ file.
+
+    Taking reads at even steps is deterministic, so the forward and reverse
+    files stay in sync, and the sample isn't limited to the first tiles.
+    @param fastq: the path to the source FASTQ file
+    @param sample: an open file to write the sampled reads to
+    @param step: the distance between sampled reads
+    @param max_reads: the most reads to write
+    @param gzip: if True, the source FASTQ file is compressed
+    """
+    opener = gzip_module.open if gzip else open
+    with opener(fastq, 'rt') as source:
+        written = 0
+        for i, read in enumerate(zip(source, source, source, source)):
+            if i % step:
+                continue
+            sample.writelines(read)
+            written += 1
+            if written >= max_reads:
+                break
 
 
 def main():
@@ -176,6 +239,14 @@ def main():
     parser.add_argument("--gzip", action='store_true', help="<optional> FASTQs are compressed")
     parser.add_argument("--keep", action='store_true',
                         help="<optional> retain temporary files for debugging.")
+    parser.add_argument("--max_pairs", type=int, default=None,
+                        help="<optional> map only a sample of this many read pairs.")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="<optional> number of bowtie2 processes to run at once.")
+    parser.add_argument("--mapper", choices=['bowtie2', 'amplicon'],
+                        default='bowtie2',
+                        help="<optional> map with bowtie2, or in this process "
+                             "for small amplicon references.")
 
     args = parser.parse_args()
     prelim_map(fastq1=args.fastq1,
@@ -184,7 +255,10 @@ def main():
                rdgopen=args.rdgopen,
                rfgopen=args.rfgopen,
                gzip=args.gzip,
-               keep=args.keep)
+               keep=args.keep,
+               max_pairs=args.max_pairs,
+               shard_count=args.shards,
+               mapper=args.mapper)
 
 
 if __name__ == '__main__':
@@ -7,9 +7,11 @@ Also report the number of reads mapped before and after processing.
 """
 
 import argparse
-from collections import Counter, defaultdict
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from functools import partial
+from functools import lru_cache, partial
 import itertools
 import logging
 import multiprocessing
@@ -18,16 +20,24 @@ import os
 import re
 import shutil
 import sys
+import tempfile
 
 #from gotoh import align_it
 from micall.alignment.gotoh2 import Aligner
 import Levenshtein
 
 from micall.core import miseq_logging, project_config
-from micall.core.sam2aln import apply_cigar, merge_pairs, merge_inserts
+from micall.core.sam2aln import apply_cigar_batch, merge_pairs, \
+    merge_pairs_batch, merge_inserts
 from micall.core.prelim_map import BOWTIE_THREADS, READ_GAP_OPEN, READ_GAP_EXTEND, REF_GAP_OPEN, \
     REF_GAP_EXTEND
+from micall.utils.amplicon_mapper import AmpliconMapper
+from micall.utils.bam import BamWriter
+from micall.utils.conseq_store import ConseqStore
+from micall.utils.cpu_budget import CpuBudget
 from micall.utils.externals import Bowtie2, Bowtie2Build, LineCounter
+from micall.utils.mate_pairer import MatePairer
+from micall.utils.packed_sam import PackedSamWriter, create_sam_writer, read_sam_rows
 from micall.utils.translation import reverse_and_complement
 
 aligner = Aligner(gop=15, gep=3, is_global=True)
@@ -35,6 +45,11 @@ aligner = Aligner(gop=15, gep=3, is_global=True)
 CONSENSUS_Q_CUTOFF = 20         # Min Q for base to contribute to conseq (pileup2conseq)
 MIN_MAPPING_EFFICIENCY = 0.95   # Fraction of fastq reads mapped needed
 MAX_REMAPS = 3                  # Number of remapping attempts if mapping efficiency unsatisfied
+BATCH_SIZE = 5000               # Read pairs sent to a worker at a time
+MAX_CHANGE_WINDOW = 30          # Longest consensus change to reuse alignments around
+CHANGE_WINDOW_MARGIN = 5        # Reads this close to a changed window are remapped
+SEED_ANCHOR_SIZE = 20           # Unique seed k-mer that can anchor a consensus end
+MAX_WARM_START_DISTANCE = 0.25  # Fraction of a stored consensus that can differ from its seed
 
 
 # SAM file format
@@ -92,6 +107,64 @@ def merge_reads(quality_cutoff, read_pair):
     SAM file record
     @return: (rname, mseq, merged_inserts, qual1, qual2) or None to skip the pair
     """
+    aligned_pair = align_reads(read_pair)
+    if aligned_pair is None:
+        return None
+    rname, seq1, seq2, qual1, qual2, ins1, ins2 = aligned_pair
+    mseq = merge_pairs(seq1, seq2, qual1, qual2, q_cutoff=quality_cutoff)
+    merged_inserts = merge_inserts(ins1, ins2, quality_cutoff)
+    return rname, mseq, merged_inserts, qual1, qual2
+
+
+def align_reads(read_pair):
+    """ Apply the CIGAR strings to a pair of reads, ready to merge.
+
+    Skips reads that don't meet the same criteria as merge_reads().
+    @param read_pair: a sequence of two sequences, each with fields from a
+    SAM file record
+    @return: (rname, seq1, seq2, qual1, qual2, ins1, ins2) or None to skip
+        the pair. See apply_cigar() for the insertions.
+    """
+    return align_read_batch([read_pair])[0]
+
+
+def align_read_batch(read_pairs):
+    """ Apply the CIGAR strings to a batch of read pairs, like align_reads().
+
+    @param read_pairs: a sequence of read pairs, see align_reads()
+    @return: a list with an align_reads() result for each pair
+    """
+    filtered_pairs = list(map(filter_mapped_reads, read_pairs))
+    aligned_reads = iter(apply_cigar_batch(
+        (read['cigar'], read['seq'], read['qual'], read['pos']-1)
+        for filtered_pair in filtered_pairs
+        if filtered_pair is not None
+        for read in filtered_pair[1]))
+    aligned_pairs = []
+    for filtered_pair in filtered_pairs:
+        if filtered_pair is None:
+            aligned_pairs.append(None)
+            continue
+        rname, filtered_reads = filtered_pair
+        seq1, qual1, ins1 = next(aligned_reads)
+        if len(filtered_reads) == 1:
+            # this is an unpaired read
+            seq2 = qual2 = ''
+            ins2 = None
+        else:
+            seq2, qual2, ins2 = next(aligned_reads)
+        aligned_pairs.append((rname, seq1, seq2, qual1, qual2, ins1, ins2))
+    return aligned_pairs
+
+
+def filter_mapped_reads(read_pair):
+    """ Choose the mapped reads from a pair.
+
+    @param read_pair: a sequence of two sequences, each with fields from a
+    SAM file record
+    @return: (rname, [read]) with a dictionary of fields for each mapped read,
+        or None to skip the pair
+    """
     read1, read2 = read_pair
     if read2 and read1[2] != read2[2]:
         # region mismatch, ignore the read pair.
@@ -110,20 +183,35 @@ def merge_reads(quality_cutoff, read_pair):
     
     if not filtered_reads:
         return None  # neither of the reads were mapped
-    
-    read1 = filtered_reads[0]
-    seq1, qual1, ins1 = apply_cigar(read1['cigar'], read1['seq'], read1['qual'], read1['pos']-1)
-    if len(filtered_reads) == 1:
-        # this is an unpaired read
-        seq2 = qual2 = ''
-        ins2 = None
+    return rname, filtered_reads
+
+
+def pileup_batch(quality_cutoff, batch):
+    """ Merge a batch of read pairs, and count them in a pileup.
+
+    @param quality_cutoff: minimum quality score for a base to be counted
+    @param batch: (is_paired, text) from batch_read_pairs()
+    @return: a Pileup with the batch's counts, ready to merge
+    """
+    is_paired, text = batch
+    rows = [line.split('\t') for line in text.split('\n')[:-1]]
+    if is_paired:
+        pairs = zip(rows[0::2], rows[1::2])
     else:
-        read2 = filtered_reads[1]
-        seq2, qual2, ins2 = apply_cigar(read2['cigar'], read2['seq'], read2['qual'], read2['pos']-1)
-                                        
-    mseq = merge_pairs(seq1, seq2, qual1, qual2, q_cutoff=quality_cutoff)
-    merged_inserts = merge_inserts(ins1, ins2, quality_cutoff)
-    return rname, mseq, merged_inserts, qual1, qual2
+        pairs = ((row, None) for row in rows)
+    aligned_pairs = [aligned_pair
+                     for aligned_pair in align_read_batch(pairs)
+                     if aligned_pair is not None]
+    mseqs = merge_pairs_batch([aligned_pair[1:5]
+                               for aligned_pair in aligned_pairs],
+                              q_cutoff=quality_cutoff)
+    pileup = Pileup()
+    for aligned_pair, mseq in zip(aligned_pairs, mseqs):
+        rname, _seq1, _seq2, _qual1, _qual2, ins1, ins2 = aligned_pair
+        merged_inserts = merge_inserts(ins1, ins2, quality_cutoff)
+        pileup.add(rname, mseq, merged_inserts)
+    pileup.flush()
+    return pileup
 
 
 def extract_relevant_seed(aligned_conseq, aligned_seed):
@@ -138,9 +226,80 @@ def extract_relevant_seed(aligned_conseq, aligned_seed):
     return aligned_seed[match.start(1):match.end(1)].replace('-', '')
 
 
+@lru_cache(maxsize=256)
+def find_seed_anchors(seed_ref, anchor_size=SEED_ANCHOR_SIZE):
+    """ Index the k-mers that appear exactly once in a seed reference.
+
+    :param str seed_ref: the seed reference
+    :param int anchor_size: the length of the k-mers
+    :return: {kmer: position} for each unique k-mer
+    """
+    anchors = {}
+    repeats = set()
+    for pos in range(len(seed_ref) - anchor_size + 1):
+        kmer = seed_ref[pos:pos+anchor_size]
+        if kmer in anchors:
+            repeats.add(kmer)
+        anchors[kmer] = pos
+    for kmer in repeats:
+        del anchors[kmer]
+    return anchors
+
+
+@lru_cache(maxsize=1024)
+def find_relevant_seed(seed_ref, relevant_conseq):
+    """ Find the portion of a seed that is relevant to the consensus.
+
+    When both ends of the consensus match unique k-mers in the seed, the
+    alignment can only put them there, so the seed is sliced between those
+    anchors. Otherwise, fall back to a full alignment. Results are cached,
+    because the same consensus gets compared to every seed, and consensus
+    sequences barely change between remap iterations.
+    :param str seed_ref: the seed reference
+    :param str relevant_conseq: the consensus sequence, limited to the
+    portions with enough coverage
+    :return: the portion of the seed that mapped to or was surrounded by the
+    consensus.
+    """
+    if len(relevant_conseq) >= 2*SEED_ANCHOR_SIZE:
+        anchors = find_seed_anchors(seed_ref)
+        start = anchors.get(relevant_conseq[:SEED_ANCHOR_SIZE])
+        end = anchors.get(relevant_conseq[-SEED_ANCHOR_SIZE:])
+        if start is not None and end is not None and start < end:
+            return seed_ref[start:end+SEED_ANCHOR_SIZE]
+    aligned_seed, aligned_conseq, _score = aligner.align(seed_ref,
+                                                         relevant_conseq)
+    return extract_relevant_seed(aligned_conseq, aligned_seed)
+
+
+def calculate_seed_distance(seed_ref, relevant_conseq, max_distance=None):
+    """ Calculate the edit distance between a consensus and a seed.
+
+    :param str seed_ref: the seed reference
+    :param str relevant_conseq: the consensus sequence, limited to the
+    portions with enough coverage
+    :param int max_distance: if set, stop as soon as the distance is larger
+    than this, and return some value that is larger.
+    :return: the edit distance between the consensus and the relevant
+    portion of the seed
+    """
+    relevant_seed = find_relevant_seed(seed_ref, relevant_conseq)
+    if max_distance is None:
+        return Levenshtein.distance(relevant_seed, relevant_conseq)
+    if abs(len(relevant_seed) - len(relevant_conseq)) > max_distance:
+        return max_distance + 1
+    try:
+        return Levenshtein.distance(relevant_seed,
+                                    relevant_conseq,
+                                    score_cutoff=max_distance)
+    except TypeError:
+        # Older versions of python-Levenshtein have no cutoff.
+        return Levenshtein.distance(relevant_seed, relevant_conseq)
+
+
 def sam_to_conseqs(samfile, quality_cutoff=0, debug_reports=None, seeds=None,
                    is_filtered=False, worker_pool=None, filter_coverage=1,
-                   distance_report=None):
+                   distance_report=None, max_batches=None):
     """ Build consensus sequences for each reference from a SAM file.
 
     @param samfile: an open file in the SAM format containing reads with their
@@ -157,12 +316,15 @@ def sam_to_conseqs(samfile, quality_cutoff=0, debug_reports=None, seeds=None,
     @param is_filtered: if True, then any consensus that has migrated so far
         from its seed that it is closer to a different seed, will not be
         included as a new consensus.
-    @param worker_pool: a pool to do some distributed processing
+    @param worker_pool: a pool to merge and count batches of reads in. Not
+        used for debug reports.
     @param filter_coverage: when filtering on consensus distance, only include
         portions with at least this depth of coverage
     @param distance_report: empty dictionary or None. Dictionary will return:
         {rname: {'seed_dist': seed_dist, 'other_dist': other_dist,
         'other_seed': other_seed}}
+    @param max_batches: the most batches of reads to send to worker_pool at
+        once, or None for no limit. See imap_limited().
     @return: {reference_name: consensus_sequence}
     """
 
@@ -170,38 +332,32 @@ def sam_to_conseqs(samfile, quality_cutoff=0, debug_reports=None, seeds=None,
         for key in debug_reports.keys():
             debug_reports[key] = Counter()
 
-    # refmap structure: {refname: {pos: {nuc: count}}}
-    refmap = {}
+    pileup = Pileup(seeds, debug_reports)
 
-    pairs = matchmaker(samfile, include_singles=True)
-    if worker_pool is None:
-        merged_reads = map(
-            partial(merge_reads, quality_cutoff),
-            pairs)
+    if worker_pool is None or debug_reports:
+        mate_pairer = MatePairer()
+        pairs = matchmaker(samfile, include_singles=True,
+                           mate_pairer=mate_pairer)
+        for merged_read in map(partial(merge_reads, quality_cutoff), pairs):
+            if merged_read is None:
+                continue
+            rname, mseq, merged_inserts, qual1, qual2 = merged_read
+            pileup.add(rname, mseq, merged_inserts, qual1, qual2)
     else:
-        merged_reads = worker_pool.imap_unordered(
-            partial(merge_reads, quality_cutoff),
-            pairs,
-            chunksize=100)
-    read_counts = Counter()
-    for merged_read in merged_reads:
-        if merged_read is None:
-            continue
-        rname, mseq, merged_inserts, qual1, qual2 = merged_read
-        read_counts[rname] += 1
-        pos_nucs = refmap.get(rname)
-        if pos_nucs is None:
-            pos_nucs = refmap[rname] = defaultdict(Counter)
-            if seeds:
-                for i, nuc in enumerate(seeds[rname], 1):
-                    pos_nucs[i][nuc] = 0
-        update_counts(rname,
-                      qual1,
-                      qual2,
-                      mseq,
-                      merged_inserts,
-                      pos_nucs,
-                      debug_reports)
+        # Workers pile up whole batches, so only the batch text and the
+        # partial counts pass between processes.
+        mate_pairer = MatePairer(get_qname=get_line_qname)
+        partial_pileups = imap_limited(
+            worker_pool,
+            partial(pileup_batch, quality_cutoff),
+            batch_read_pairs(samfile, mate_pairer=mate_pairer),
+            max_batches)
+        for partial_pileup in partial_pileups:
+            pileup.merge(partial_pileup)
+    logger.debug('Found %d reads without mates, and spilled %d reads to '
+                 'disk while pairing.',
+                 mate_pairer.orphan_count,
+                 mate_pairer.spilled_count)
 
     if debug_reports:
         for key, counts in debug_reports.items():
@@ -224,33 +380,33 @@ def sam_to_conseqs(samfile, quality_cutoff=0, debug_reports=None, seeds=None,
                                                   ', '.join(mixture)))
             debug_reports[key] = ', '.join(mixtures)
 
-    new_conseqs = counts_to_conseqs(refmap)
+    new_conseqs = pileup.build_conseqs()
     if not (seeds and is_filtered) or len(new_conseqs) < 2:
         return new_conseqs
 
     filtered_conseqs = {}
     for name in sorted(new_conseqs.keys()):
         conseq = new_conseqs[name]
-        counts = refmap[name]
         relevant_conseq = u''
         for pos, c in enumerate(conseq, 1):
-            pos_counts = sum(counts[pos].values())
+            pos_counts = pileup.get_coverage(name, pos)
             if pos_counts >= filter_coverage:
                 relevant_conseq += c
         if not relevant_conseq:
             # None of the coverage was acceptable.
             continue
 
+        seed_dist = calculate_seed_distance(seeds[name], relevant_conseq)
         other_seed = other_dist = None
         for seed_name in sorted(new_conseqs.keys()):
-            seed_ref = seeds[seed_name]
-
-            aligned_seed, aligned_conseq, _score = aligner.align(seed_ref, relevant_conseq)
-            relevant_seed = extract_relevant_seed(aligned_conseq, aligned_seed)
-            d = Levenshtein.distance(relevant_seed, relevant_conseq)
             if seed_name == name:
-                seed_dist = d
-            elif other_dist is None or d < other_dist:
+                continue
+            # Only the closest other seed matters, so give up on any seed
+            # that is already further away.
+            d = calculate_seed_distance(seeds[seed_name],
+                                        relevant_conseq,
+                                        other_dist)
+            if other_dist is None or d < other_dist:
                 other_seed = seed_name
                 other_dist = d
 
@@ -263,74 +419,299 @@ def sam_to_conseqs(samfile, quality_cutoff=0, debug_reports=None, seeds=None,
                                          other_seed=other_seed)
     if not filtered_conseqs:
         # No reference had acceptable coverage, choose one with most reads.
-        best_ref = read_counts.most_common(1)[0][0]
+        best_ref = pileup.read_counts.most_common(1)[0][0]
         filtered_conseqs[best_ref] = new_conseqs[best_ref]
     return filtered_conseqs
 
 
-def update_counts(rname, qual1, qual2, mseq, merged_inserts, pos_nucs,
-                  debug_reports=None):
-    """ Update the counts for each position within a merged read.
+def imap_limited(pool, func, items, limit=None):
+    """ Like pool.imap(), but with only a few items in the pool at once.
 
-    @param rname: the reference name this read mapped to
-    @param qual1: the quality scores for the forward read
-    @param qual2: the quality scores for the reverse read
-    @param mseq: the merged sequence of the forward and reverse reads
-    @param merged_inserts: {pos: seq}
-    @param pos_nucs: {pos: {nuc: count}}
-    @param debug_reports: {(rname, pos): {nuc+qual: count}} a dictionary with
-        keys for all of the regions and positions that you want a report for.
+    pool.imap() sends items to the workers as fast as it can read them, so
+    every worker stays busy. Limiting the items in flight leaves the rest of
+    the workers idle, so their cores can go to another step, like bowtie2.
+    @param pool: a multiprocessing pool
+    @param func: the function to call on each item
+    @param items: a sequence of items
+    @param limit: the most items to send to the pool at once, or None to
+        use pool.imap()
+    @return: yields func(item) for each item, in order
     """
-    is_started = False
-    for pos, nuc in enumerate(mseq, 1):
-        if not is_started:
-            if nuc == '-':
-                continue
-            is_started = True
-        if nuc != 'n':
-            nuc_counts = pos_nucs[pos]
-            if nuc == 'N':
-                nuc_counts[nuc] = -1
-            elif nuc == '-':
-                nuc_counts[nuc] = -2
+    if limit is None:
+        for result in pool.imap(func, items):
+            yield result
+        return
+    pending = deque()
+    for item in items:
+        if len(pending) >= limit:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def map_and_build_conseqs(start_mapping, cpu_budget, nthreads,
+                          worker_pool=None, **kwargs):
+    """ Map reads, and build consensus sequences while the mapping streams.
+
+    bowtie2 and the worker pool run at the same time, so the cores reserved
+    from the budget are split between bowtie2's threads and the batches of
+    reads that the pool works on at once.
+    @param start_mapping: a function that takes bowtie2's thread count, and
+        returns the SAM lines as they are mapped, like stream_to_reference()
+    @param cpu_budget: the CpuBudget to reserve cores from
+    @param nthreads: the most cores to reserve
+    @param worker_pool: a pool to build consensus sequences in, or None
+    @param kwargs: passed on to sam_to_conseqs()
+    @return: {reference_name: consensus_sequence}
+    """
+    with cpu_budget.reserve_pipeline(nthreads) as (mapping_threads,
+                                                   batch_count):
+        sam_lines = start_mapping(mapping_threads)
+        if not batch_count:
+            # one core for everything, so build them in this process
+            worker_pool = None
+        return sam_to_conseqs(sam_lines,
+                              worker_pool=worker_pool,
+                              max_batches=batch_count,
+                              **kwargs)
+
+
+class Pileup(object):
+    """ Count the nucleotides at each position of each reference.
+
+    This replaces a dictionary of Counters for each position, because
+    updating those one base at a time was the slowest part of building the
+    consensus. Identical merged reads are buffered and counted once with
+    their multiplicity, and each unique read is counted by feeding
+    (position, nucleotide) pairs to Counter.update(), which does the
+    counting in C. The counts are copied into arrays indexed by position
+    when calling the consensus.
+    """
+    BUFFER_SIZE = 10000  # unique reads to hold before counting them
+    ARRAY_NUCS = 'ACGT'  # nucleotides counted in arrays, others in a table
+
+    def __init__(self, seeds=None, debug_reports=None,
+                 buffer_size=BUFFER_SIZE):
+        """ Initialize.
+
+        @param seeds: {name: sequence} If this is set, the seed's base at
+            each position is a candidate with a count of zero, so positions
+            without coverage get the seed's base.
+        @param debug_reports: {(rname, pos): Counter()} a dictionary with
+            keys for all of the regions and positions that you want a report
+            for. Each counter gets {nuc+qual: count}.
+        @param buffer_size: the number of unique reads to hold before
+            counting them
+        """
+        self.seeds = seeds
+        self.debug_reports = debug_reports
+        self.buffer_size = buffer_size
+        self.buffer = Counter()  # {(rname, start, read, inserts): count}
+        self.read_counts = Counter()  # {rname: count}, in order of first read
+        self.nuc_counts = {}  # {rname: Counter({(pos, nuc): count})}
+        self.max_positions = {}  # {rname: last position with coverage}
+        self.arrays = {}  # {rname: (nuc_arrays, other_counts)}
+
+    def add(self, rname, mseq, merged_inserts, qual1='', qual2=''):
+        """ Add a merged read to the pileup.
+
+        @param rname: the reference name this read mapped to
+        @param mseq: the merged sequence of the forward and reverse reads
+        @param merged_inserts: {pos: seq}
+        @param qual1: the quality scores for the forward read, only used by
+            debug reports
+        @param qual2: the quality scores for the reverse read
+        """
+        self.read_counts[rname] += 1
+        read = mseq.lstrip('-')
+        start = len(mseq) - len(read) + 1
+        inserts = ()
+        if merged_inserts:
+            inserts = tuple(sorted(
+                (pos, ins)
+                for pos, ins in merged_inserts.items()
+                if ins and len(ins) % 3 == 0))
+        if self.debug_reports:
+            self._add_debug_counts(rname, mseq, start, qual1, qual2)
+        self.buffer[(rname, start, read, inserts)] += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ Count all the buffered reads. """
+        for (rname, start, read, inserts), count in self.buffer.items():
+            nuc_counts = self.nuc_counts.get(rname)
+            if nuc_counts is None:
+                nuc_counts = self.nuc_counts[rname] = Counter()
+            covered_length = len(read.rstrip('n'))
+            if covered_length:
+                end = start + covered_length - 1
+                if end > self.max_positions.get(rname, 0):
+                    self.max_positions[rname] = end
+            keys = zip(itertools.count(start), read)
+            if count == 1:
+                nuc_counts.update(keys)
             else:
-                ins = merged_inserts.get(pos)
-                if ins and len(ins) % 3 == 0:
-                    nuc_counts[nuc + ins] += 1
+                for key in keys:
+                    nuc_counts[key] += count
+            for pos, ins in inserts:
+                offset = pos - start
+                if 0 <= offset < len(read):
+                    nuc = read[offset]
+                    if nuc not in 'Nn-':
+                        # codon insertions are counted with their base
+                        nuc_counts[(pos, nuc)] -= count
+                        nuc_counts[(pos, nuc + ins)] += count
+            self.arrays.pop(rname, None)
+        self.buffer.clear()
+
+    def merge(self, other):
+        """ Add all the counts from another pileup to this one. """
+        self.flush()
+        other.flush()
+        self.read_counts.update(other.read_counts)
+        for rname, other_counts in other.nuc_counts.items():
+            nuc_counts = self.nuc_counts.get(rname)
+            if nuc_counts is None:
+                self.nuc_counts[rname] = Counter(other_counts)
+            else:
+                for key, count in other_counts.items():
+                    nuc_counts[key] += count
+            self.arrays.pop(rname, None)
+        for rname, end in other.max_positions.items():
+            if end > self.max_positions.get(rname, 0):
+                self.max_positions[rname] = end
+        if self.debug_reports and other.debug_reports:
+            for key, counts in other.debug_reports.items():
+                self.debug_reports[key].update(counts)
+
+    @property
+    def rnames(self):
+        """ Reference names, in the order their first reads were added. """
+        return list(self.read_counts)
+
+    def get_token_counts(self, rname, pos):
+        """ Get the counts for each token at a position.
+
+        @return: {token: count} bases and codon insertions are counted, N
+            has -1 and a deletion has -2 if they were ever seen, and the
+            seed's base has zero if it wasn't seen.
+        """
+        nuc_arrays, other_counts = self._get_arrays(rname)
+        token_counts = {}
+        if self.seeds:
+            seed = self.seeds[rname]
+            if pos <= len(seed):
+                token_counts[seed[pos-1]] = 0
+        if pos < len(nuc_arrays[0]):
+            for nuc, counts in zip(self.ARRAY_NUCS, nuc_arrays):
+                count = counts[pos]
+                if count > 0:
+                    token_counts[nuc] = count
+        pos_counts = other_counts.get(pos)
+        if pos_counts:
+            token_counts.update(pos_counts)
+        return token_counts
+
+    def get_coverage(self, rname, pos):
+        """ Sum the token counts at a position. """
+        return sum(self.get_token_counts(rname, pos).values())
+
+    def get_end(self, rname):
+        """ Find the last position with a token, including the seed. """
+        end = self.max_positions.get(rname, 0)
+        if self.seeds:
+            end = max(end, len(self.seeds[rname]))
+        return end
+
+    def has_coverage(self, rname):
+        """ True if any read had a base counted on this reference. """
+        nuc_arrays, other_counts = self._get_arrays(rname)
+        if any(any(counts) for counts in nuc_arrays):
+            return True
+        return any(count > 0
+                   for pos_counts in other_counts.values()
+                   for count in pos_counts.values())
+
+    def get_top_token(self, rname, pos):
+        """ Choose the most common token at a position.
+
+        Ties go to the token that sorts first.
+        @return: the token, or None if there are no tokens at that position
+        """
+        top_token = None
+        top_count = None
+        for token, count in self.get_token_counts(rname, pos).items():
+            if (top_count is None or count > top_count or
+                    (count == top_count and token < top_token)):
+                top_token = token
+                top_count = count
+        return top_token
+
+    def build_conseqs(self):
+        """ Call the consensus for each reference.
+
+        Positions with no tokens get N, and deletions are only kept if
+        they would shift the reading frame.
+        @return: {reference_name: consensus_sequence}
+        """
+        self.flush()
+        conseqs = {}
+        for rname in self.rnames:
+            if not self.has_coverage(rname):
+                # Nothing mapped, so no consensus.
+                continue
+            conseq = ''
+            deletion = ''
+            for pos in range(1, self.get_end(rname) + 1):
+                most_common = self.get_top_token(rname, pos)
+                if most_common is None:
+                    conseq += 'N'
+                elif most_common == '-':
+                    deletion += '-'
                 else:
-                    nuc_counts[nuc] += 1
-                if debug_reports:
-                    counts = debug_reports.get((rname, pos))
-                    if counts is not None:
-                        q = qual1[pos-1] if pos <= len(qual1) else qual2[pos-1]
-                        counts[nuc + q] += 1
-
-
-def counts_to_conseqs(refmap):
-    conseqs = {}
-    for refname, pos_nucs in refmap.items():
-        if not any((any(n > 0 for n in counts.values())
-                    for counts in pos_nucs.values())):
-            # Nothing mapped, so no consensus.
-            continue
-        conseq = ''
-        deletion = ''
-        end = max(pos_nucs.keys())+1
-        for pos in range(1, end):
-            nuc_counts = pos_nucs[pos]
-            most_common = find_top_token(nuc_counts)
-            if most_common is None:
-                conseq += 'N'
-            elif most_common == '-':
-                deletion += '-'
+                    if deletion:
+                        if len(deletion) % 3 != 0:
+                            conseq += deletion
+                        deletion = ''
+                    conseq += most_common
+            conseqs[rname] = conseq
+        return conseqs
+
+    def _get_arrays(self, rname):
+        self.flush()
+        arrays = self.arrays.get(rname)
+        if arrays is not None:
+            return arrays
+        size = self.max_positions.get(rname, 0) + 1
+        nuc_arrays = [array('l', [0]) * size for _ in self.ARRAY_NUCS]
+        array_indexes = {nuc: i for i, nuc in enumerate(self.ARRAY_NUCS)}
+        other_counts = defaultdict(dict)  # {pos: {token: count}}
+        for (pos, token), count in self.nuc_counts.get(rname, {}).items():
+            if count <= 0 or token == 'n':
+                continue
+            nuc_index = array_indexes.get(token)
+            if nuc_index is not None:
+                nuc_arrays[nuc_index][pos] = count
+            elif token == 'N':
+                other_counts[pos][token] = -1
+            elif token == '-':
+                other_counts[pos][token] = -2
             else:
-                if deletion:
-                    if len(deletion) % 3 != 0:
-                        conseq += deletion
-                    deletion = ''
-                conseq += most_common
-        conseqs[refname] = conseq
-    return conseqs
+                other_counts[pos][token] = count
+        arrays = self.arrays[rname] = (nuc_arrays, other_counts)
+        return arrays
+
+    def _add_debug_counts(self, rname, mseq, start, qual1, qual2):
+        for (report_rname, pos), counts in self.debug_reports.items():
+            if report_rname != rname or not start <= pos <= len(mseq):
+                continue
+            nuc = mseq[pos-1]
+            if nuc in 'Nn-':
+                continue
+            q = qual1[pos-1] if pos <= len(qual1) else qual2[pos-1]
+            counts[nuc + q] += 1
 
 
 def build_conseqs(samfilename, seeds=None, is_filtered=False, worker_pool=None, 
@@ -370,10 +751,72 @@ def build_conseqs(samfilename, seeds=None, is_filtered=False, worker_pool=None,
     return conseqs
 
 
-def write_remap_counts(remap_counts_writer, counts, title, distance_report=None):
+def stream_prelim(prelim_csv, refseqs, prelim_counts, prelim_stats,
+                  remap_counts_writer=None, callback=None, raw_count=None):
+    """ Yield the preliminary mapping as SAM lines, and count the reads.
+
+    @param prelim_csv: the preliminary mapping in CSV or packed format
+    @param refseqs: {name: sequence} the references to list in the header
+    @param prelim_counts: a dictionary that gets {refname: filtered_count}
+        for each reference that reads mapped to
+    @param prelim_stats: a dictionary that gets 'row_count' set when all the
+        lines have been yielded
+    @param remap_counts_writer: a DictWriter to report preliminary counts to
+    @param callback: a function to report progress with three optional
+        parameters - callback(message, progress, max_progress)
+    @param raw_count: the progress to report when a reference is finished
+    """
+    yield '@HD\tVN:1.0\tSO:unsorted\n'
+    for rname, refseq in refseqs.items():
+        yield '@SQ\tSN:%s\tLN:%d\n' % (rname, len(refseq))
+
+    reader = read_sam_rows(prelim_csv)
+    row_count = 0
+    for refname, group in itertools.groupby(reader, itemgetter('rname')):
+        count = 0
+        filtered_count = 0
+        for row in group:
+            if callback and row_count % 1000 == 0:
+                callback(message=refname, progress=row_count)
+
+            count += 1
+            row_count += 1
+
+            yield '\t'.join([row[field] for field in fieldnames]) + '\n'
+
+            if is_unmapped_read(row['flag']):
+                continue
+            if is_short_read(row, max_primer_length=50):
+                # exclude short reads
+                continue
+
+            filtered_count += 1
+        if callback:
+            callback(progress=raw_count)
+
+        # report preliminary counts to file
+        if remap_counts_writer:
+            remap_counts_writer.writerow(
+                dict(type='prelim %s' % refname, count=count,
+                     filtered_count=filtered_count)
+            )
+
+        if refname == '*':
+            continue
+        prelim_counts[refname] = filtered_count
+    prelim_stats['row_count'] = row_count
+
+
+def write_remap_counts(remap_counts_writer,
+                       counts,
+                       title,
+                       distance_report=None,
+                       change_report=None):
     distance_report = distance_report or {}
+    change_report = change_report or {}
     for refname in sorted(counts.keys()):
         row = distance_report.get(refname, {})
+        row.update(change_report.get(refname, {}))
         row.update(type=title + ' ' + refname, count=counts[refname])
         remap_counts_writer.writerow(row)
 
@@ -383,15 +826,20 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
           bt2_path='bowtie2', bt2build_path='bowtie2-build-s',
           nthreads=BOWTIE_THREADS, callback=None, count_threshold=10,
           rdgopen=READ_GAP_OPEN, rfgopen=REF_GAP_OPEN, stderr=sys.stderr,
-          gzip=False, debug_file_prefix=None, keep=False, json=None):
+          gzip=False, debug_file_prefix=None, keep=False, json=None,
+          prelim_subsampled=False, shard_count=1, worker_pool=None,
+          incremental=False, convergence_threshold=None, mapper='bowtie2',
+          conseq_store=None, conseq_key=None, cpu_budget=None):
     """
     Iterative re-map reads from raw paired FASTQ files to a reference sequence set that
     is being updated as the consensus of the reads that were mapped to the last set.
 
     @param fastq1: input R1 FASTQ
     @param fastq2: input R2 FASTQ <optional>
-    @param prelim_csv: input CSV output from prelim_csv()
-    @param remap_csv:  output CSV, contents of bowtie2 SAM output
+    @param prelim_csv: input CSV output from prelim_csv(), or the packed
+        binary format if the file was opened in binary mode
+    @param remap_csv:  output CSV, contents of bowtie2 SAM output. Files opened
+        in binary mode get the packed binary format.
     @param remap_counts_csv:  output CSV, counts of reads mapped to regions
     @param remap_conseq_csv:  output CSV, sample- and region-specific consensus sequences
                                 generated while remapping reads
@@ -405,12 +853,47 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
     @param rdgopen: read gap open penalty
     @param rfgopen: reference gap open penalty
     @param json:  specify a custom JSON project file; None loads the default file.
+    @param prelim_subsampled: True if prelim_csv only holds a sample of the
+        read pairs, so its counts are scaled up to the raw read count before
+        choosing seeds.
+    @param shard_count: the number of bowtie2 processes to split the reads
+        and threads between.
+    @param worker_pool: a multiprocessing pool to build consensus sequences
+        in. Pass the same pool for several samples to avoid starting new
+        processes each time. If None, a pool is created for this sample when
+        nthreads is more than one.
+    @param incremental: if True, remap iterations after the first only map
+        the reads whose consensus changed or that didn't map. Faster, but
+        reads on an unchanged consensus don't get a chance to move.
+    @param convergence_threshold: if set, a consensus is frozen once an
+        iteration changes it and its coverage by no more than this many
+        positions, and iterating stops when all of them are frozen. If None,
+        every consensus is rebuilt until the other stopping criteria are met.
+    @param mapper: 'bowtie2', or 'amplicon' to map in this process, which is
+        faster for small references. See AmpliconMapper.
+    @param conseq_store: a ConseqStore with consensus sequences from earlier
+        runs. Any that are still close to their seeds replace the
+        preliminary consensus, and the final consensus sequences are saved
+        in it. Unless convergence_threshold is set, a consensus is frozen
+        as soon as an iteration doesn't change it, so a warm start can stop
+        after one iteration.
+    @param conseq_key: the sample or patient identifier to load and save
+        consensus sequences under, required with conseq_store
+    @param cpu_budget: a CpuBudget to reserve bowtie2's threads and the
+        worker pool's batches from. Pass the same budget to steps that run
+        at the same time, so they share the processors instead of each
+        using nthreads. If None, a budget of nthreads is used.
     """
+    if conseq_store is not None and conseq_key is None:
+        raise ValueError('A conseq_key is required with a conseq_store.')
 
     reffile = os.path.join(work_path, 'temp.fasta')
     samfile = os.path.join(work_path, 'temp.sam')
-    bowtie2 = Bowtie2(execname=bt2_path)
-    bowtie2_build = Bowtie2Build(execname=bt2build_path, logger=logger)
+    if mapper == 'amplicon':
+        bowtie2 = bowtie2_build = AmpliconMapper(logger=logger)
+    else:
+        bowtie2 = Bowtie2(execname=bt2_path)
+        bowtie2_build = Bowtie2Build(execname=bt2build_path, logger=logger)
 
     # check that the inputs exist
     if not os.path.exists(fastq1):
@@ -439,7 +922,11 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
                 pass
             fastq2 += '.gz'
 
-    worker_pool = multiprocessing.Pool(processes=nthreads) if nthreads > 1 else None
+    if cpu_budget is None:
+        cpu_budget = CpuBudget(nthreads)
+    is_pool_owned = worker_pool is None and nthreads > 1
+    if is_pool_owned:
+        worker_pool = multiprocessing.Pool(processes=nthreads)
 
     # retrieve reference sequences used for preliminary mapping
     if json is None:
@@ -459,7 +946,8 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
     if remap_counts_csv:
         remap_counts_writer = csv.DictWriter(
             remap_counts_csv,
-            'type count filtered_count seed_dist other_dist other_seed'.split(),
+            'type count filtered_count seed_dist other_dist other_seed '
+            'conseq_diff coverage_gain'.split(),
             lineterminator=os.linesep
         )
         remap_counts_writer.writeheader()
@@ -471,65 +959,48 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
                  progress=0,
                  max_progress=raw_count)
 
-    with open(samfile, 'w') as f:
-        # write SAM header
-        f.write('@HD\tVN:1.0\tSO:unsorted\n')
-        for rname, refseq in conseqs.items():
-            f.write('@SQ\tSN:%s\tLN:%d\n' % (rname, len(refseq)))
-        f.write('@PG\tID:bowtie2\tPN:bowtie2\tVN:2.2.3\tCL:""\n')
-
-        # iterate through prelim CSV and record counts, transfer rows to SAM
-        refgroups = {}  # { group_name: (refname, count) }
-        reader = csv.DictReader(prelim_csv)
-        row_count = 0
-        for refname, group in itertools.groupby(reader, itemgetter('rname')):
-            #if callback:
-            #    callback(message=refname)
-            count = 0
-            filtered_count = 0
-            for row in group:
-                if callback and row_count % 1000 == 0:
-                    callback(message=refname, progress=row_count)
-
-                count += 1
-                row_count += 1
-
-                # write SAM row
-                f.write('\t'.join([row[field] for field in fieldnames]) + '\n')
-
-                if is_unmapped_read(row['flag']):
-                    continue
-                if is_short_read(row, max_primer_length=50):
-                    # exclude short reads
-                    continue
-
-                filtered_count += 1
-            if callback:
-                callback(progress=raw_count)
-
-            # report preliminary counts to file
-            if remap_counts_csv:
-                remap_counts_writer.writerow(
-                    dict(type='prelim %s' % refname, count=count,
-                         filtered_count=filtered_count)
-                )
-
-            if refname == '*':
-                continue
+    # iterate through prelim CSV and record counts, while the rows stream
+    # into the consensus builder
+    prelim_counts = {}  # { refname: filtered_count }
+    prelim_stats = {}
+    prelim_lines = stream_prelim(prelim_csv,
+                                 seeds,
+                                 prelim_counts,
+                                 prelim_stats,
+                                 remap_counts_writer=(remap_counts_writer
+                                                      if remap_counts_csv
+                                                      else None),
+                                 callback=callback,
+                                 raw_count=raw_count)
 
-            refgroup = projects.getSeedGroup(refname)
-            seed_count_threshold = 1 if refname == 'HIV1B-env-seed' else count_threshold
-            _best_ref, best_count = refgroups.get(refgroup,
-                                                  (None, seed_count_threshold-1))
-            if filtered_count > best_count:
-                refgroups[refgroup] = (refname, filtered_count)
+    # regenerate consensus sequences based on preliminary map
+    with cpu_budget.reserve(nthreads) as batch_count:
+        conseqs = sam_to_conseqs(prelim_lines,
+                                 CONSENSUS_Q_CUTOFF,
+                                 seeds=seeds,
+                                 worker_pool=worker_pool,
+                                 max_batches=batch_count)
+    row_count = prelim_stats['row_count']
+
+    prelim_scale = 1.0
+    if prelim_subsampled and row_count:
+        # every read in the sample is in the prelim CSV, mapped or not
+        total_rows = raw_count if fastq2 is not None else raw_count / 2
+        prelim_scale = max(1.0, total_rows / float(row_count))
+
+    refgroups = {}  # { group_name: (refname, count) }
+    for refname, filtered_count in prelim_counts.items():
+        filtered_count = int(round(filtered_count * prelim_scale))
+        refgroup = projects.getSeedGroup(refname)
+        seed_count_threshold = 1 if refname == 'HIV1B-env-seed' else count_threshold
+        _best_ref, best_count = refgroups.get(refgroup,
+                                              (None, seed_count_threshold-1))
+        if filtered_count > best_count:
+            refgroups[refgroup] = (refname, filtered_count)
 
     seed_counts = {best_ref: best_count
                    for best_ref, best_count in refgroups.values()}
 
-    # regenerate consensus sequences based on preliminary map
-    conseqs = build_conseqs(samfile, seeds=seeds, worker_pool=worker_pool)
-
     # exclude references with low counts (post filtering)
     new_conseqs = {}
     map_counts = {}
@@ -540,45 +1011,111 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
             new_conseqs[rname] = conseq
     conseqs = new_conseqs
 
+    if conseq_store is not None:
+        warm_conseqs = choose_warm_conseqs(conseq_store.load(conseq_key),
+                                           seeds,
+                                           conseqs)
+        for rname in sorted(warm_conseqs):
+            logger.debug('Starting %s from stored consensus for %s.',
+                         rname,
+                         conseq_key)
+        conseqs.update(warm_conseqs)
+        if convergence_threshold is None:
+            convergence_threshold = 0
 
     # start remapping loop
     n_remaps = 0
+    mapped_conseqs = None  # what the last iteration mapped to
+    frozen_names = set()  # references whose consensus has converged
+    old_samfile = os.path.join(work_path, 'temp.prev.sam')
     new_counts = Counter()
     unmapped_count = raw_count
     while conseqs:
         if callback:
             callback(message='... remap iteration %d' % n_remaps, progress=0)
 
-        # reset unmapped files with each iteration
-        if unmapped1:
-            unmapped1.seek(0)
-            unmapped1.truncate()
-        if unmapped2:
-            unmapped2.seek(0)
-            unmapped2.truncate()
-
         if debug_file_prefix is None:
             next_debug_prefix = None
         else:
             next_debug_prefix = '{}_remap{}'.format(debug_file_prefix,
                                                     n_remaps+1)
 
-        # call bowtie2 to map raw reads to current reference
-        unmapped_count = map_to_reference(fastq1, fastq2, conseqs, reffile, samfile,
-                                          unmapped1, unmapped2, bowtie2, bowtie2_build,
-                                          raw_count, rdgopen, rfgopen, nthreads,
-                                          new_counts, stderr, callback,
-                                          debug_file_prefix=next_debug_prefix)
+        # call bowtie2 to map raw reads to current reference, and regenerate
+        # consensus sequences from its output as it streams. Unmapped reads
+        # are only counted, and get written from the last iteration's SAM
+        # file when it's split below.
+        mapping_stats = {}
+        if incremental and mapped_conseqs is not None:
+            os.rename(samfile, old_samfile)
+            start_mapping = partial(stream_incremental,
+                                    fastq2 is not None,
+                                    conseqs,
+                                    mapped_conseqs,
+                                    old_samfile,
+                                    reffile,
+                                    samfile,
+                                    None,
+                                    None,
+                                    bowtie2,
+                                    bowtie2_build,
+                                    raw_count,
+                                    rdgopen,
+                                    rfgopen,
+                                    new_counts=new_counts,
+                                    stderr=stderr,
+                                    callback=callback,
+                                    debug_file_prefix=next_debug_prefix,
+                                    shard_count=shard_count,
+                                    mapping_stats=mapping_stats)
+        else:
+            start_mapping = partial(stream_to_reference,
+                                    fastq1,
+                                    fastq2,
+                                    conseqs,
+                                    reffile,
+                                    samfile,
+                                    None,
+                                    None,
+                                    bowtie2,
+                                    bowtie2_build,
+                                    raw_count,
+                                    rdgopen,
+                                    rfgopen,
+                                    new_counts=new_counts,
+                                    stderr=stderr,
+                                    callback=callback,
+                                    debug_file_prefix=next_debug_prefix,
+                                    shard_count=shard_count,
+                                    mapping_stats=mapping_stats)
+        mapped_conseqs = conseqs
 
         old_seed_names = set(conseqs.keys())
-        # regenerate consensus sequences
         distance_report = {}
-        conseqs = build_conseqs(samfile,
-                                seeds=seeds,
-                                is_filtered=True,
-                                worker_pool=worker_pool,
-                                filter_coverage=count_threshold/2,  # pairs
-                                distance_report=distance_report)
+        conseqs = map_and_build_conseqs(start_mapping,
+                                        cpu_budget,
+                                        nthreads,
+                                        worker_pool,
+                                        quality_cutoff=CONSENSUS_Q_CUTOFF,
+                                        seeds=seeds,
+                                        is_filtered=True,
+                                        # pairs
+                                        filter_coverage=count_threshold/2,
+                                        distance_report=distance_report)
+        unmapped_count = mapping_stats['unmapped_count']
+        change_report = measure_conseq_changes(mapped_conseqs, conseqs)
+        if convergence_threshold is not None:
+            for rname, changes in change_report.items():
+                if (changes['conseq_diff'] <= convergence_threshold and
+                        changes['coverage_gain'] <= convergence_threshold):
+                    frozen_names.add(rname)
+            for rname in frozen_names.intersection(conseqs):
+                conseqs[rname] = mapped_conseqs[rname]
+        if 'reused_count' in mapping_stats:
+            os.remove(old_samfile)
+            logger.debug('Reused %d of %d alignments in remap iteration %d.',
+                         mapping_stats['reused_count'],
+                         sum(new_counts.values()) + unmapped_count,
+                         n_remaps + 1)
         new_seed_names = set(conseqs.keys())
         n_remaps += 1
 
@@ -586,9 +1123,15 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
             write_remap_counts(remap_counts_writer,
                                new_counts,
                                title='remap-{}'.format(n_remaps),
-                               distance_report=distance_report)
+                               distance_report=distance_report,
+                               change_report=change_report)
 
         if new_seed_names == old_seed_names:
+            # stopping criterion 0 - every consensus has converged
+            if (convergence_threshold is not None and
+                    frozen_names.issuperset(new_seed_names)):
+                break
+
             # stopping criterion 1 - none of the regions gained reads
             if all((count <= map_counts[refname])
                    for refname, count in new_counts.items()):
@@ -606,41 +1149,71 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
         map_counts = dict(new_counts)
 
     # finished iterative phase
-    if worker_pool is not None:
+    if is_pool_owned:
         worker_pool.close()
 
     # generate SAM CSV output
-    remap_writer = csv.DictWriter(remap_csv, fieldnames, lineterminator=os.linesep)
+    remap_writer = create_sam_writer(remap_csv,
+                                     fieldnames,
+                                     references=get_reference_lengths(
+                                         conseqs,
+                                         mapped_conseqs),
+                                     threads=cpu_budget.total)
     remap_writer.writeheader()
-    if new_counts:
-        splitter = MixedReferenceSplitter()
-        split_counts = Counter()
-
-        # At least one read was mapped, so samfile has relevant data
+    splitter = MixedReferenceSplitter()
+    if n_remaps:
+        # write the unmapped reads from the last iteration
+        for unmapped in (unmapped1, unmapped2):
+            if unmapped:
+                unmapped.seek(0)
+                unmapped.truncate()
         with open(samfile, 'rU') as f:
-            for fields in splitter.split(f):
-                remap_writer.writerow(dict(zip(fieldnames, fields)))
-
-        for rname, (split_file1, split_file2) in splitter.splits.items():
-            refseqs = {rname: conseqs[rname]}
-            unmapped_count += map_to_reference(
-                split_file1.name, split_file2.name, refseqs, reffile, samfile,
-                unmapped1, unmapped2, bowtie2, bowtie2_build, raw_count,
-                rdgopen, rfgopen, nthreads, split_counts, stderr, callback
-            )
-            new_counts.update(split_counts)
-            with open(samfile, 'rU') as f:
-                for fields in splitter.walk(f):
+            if new_counts:
+                # At least one read was mapped, so samfile has relevant data
+                rows = splitter.split(f)
+            else:
+                rows = splitter.walk(f)
+            for fields in rows:
+                if is_unmapped_read(fields[1]):
+                    write_unmapped_read(fields, unmapped1, unmapped2)
+                if new_counts:
                     remap_writer.writerow(dict(zip(fieldnames, fields)))
+    if new_counts:
+        split_counts, split_unmapped_count = remap_splits(splitter,
+                                                          conseqs,
+                                                          remap_writer,
+                                                          fieldnames,
+                                                          unmapped1,
+                                                          unmapped2,
+                                                          work_path,
+                                                          bowtie2,
+                                                          bowtie2_build,
+                                                          raw_count,
+                                                          rdgopen,
+                                                          rfgopen,
+                                                          stderr,
+                                                          shard_count,
+                                                          cpu_budget,
+                                                          callback,
+                                                          keep)
+        new_counts.update(split_counts)
+        unmapped_count += split_unmapped_count
+    if isinstance(remap_writer, (PackedSamWriter, BamWriter)):
+        remap_writer.close()
 
     # write consensus sequences and counts
+    final_conseqs = {}
+    for refname in new_counts.keys():
+        # NOTE this is the consensus sequence to which the reads were mapped, NOT the
+        # current consensus!
+        final_conseqs[refname] = (conseqs.get(refname) or
+                                  projects.getReference(refname))
     if remap_conseq_csv:
         remap_conseq_csv.write('region,sequence\n')  # record consensus sequences for later use
-        for refname in new_counts.keys():
-            # NOTE this is the consensus sequence to which the reads were mapped, NOT the
-            # current consensus!
-            conseq = conseqs.get(refname) or projects.getReference(refname)
+        for refname, conseq in final_conseqs.items():
             remap_conseq_csv.write('%s,%s\n' % (refname, conseq))
+    if conseq_store is not None and final_conseqs:
+        conseq_store.save(conseq_key, final_conseqs)
     
     if remap_counts_csv:
         write_remap_counts(remap_counts_writer,
@@ -654,13 +1227,43 @@ def remap(fastq1, fastq2, prelim_csv, remap_csv, remap_counts_csv=None,
         # delete temporary files created by this job
         os.remove(reffile)
         for suffix in ['1', '2', '3', '4', 'rev.1', 'rev.2']:
-            os.remove('{}.{}.bt2'.format(reffile, suffix))
-        os.remove(samfile)
+            index_path = '{}.{}.bt2'.format(reffile, suffix)
+            if os.path.exists(index_path):
+                # not written by the amplicon mapper
+                os.remove(index_path)
+        if os.path.exists(samfile):
+            # not written if the preliminary map found nothing to remap
+            os.remove(samfile)
+
+
+def choose_warm_conseqs(stored_conseqs,
+                        seeds,
+                        rnames,
+                        max_distance=MAX_WARM_START_DISTANCE):
+    """ Choose stored consensus sequences that are still close to their seeds.
+
+    @param stored_conseqs: {rname: conseq} from an earlier run
+    @param seeds: {rname: seed_sequence}
+    @param rnames: the references to start remapping with
+    @param max_distance: the largest edit distance from the seed, as a
+        fraction of the stored consensus length
+    @return: {rname: conseq} for the stored consensus sequences to start with
+    """
+    warm_conseqs = {}
+    for rname in rnames:
+        stored_conseq = stored_conseqs.get(rname)
+        if not stored_conseq:
+            continue
+        distance = calculate_seed_distance(seeds[rname], stored_conseq)
+        if distance <= max_distance * len(stored_conseq):
+            warm_conseqs[rname] = stored_conseq
+    return warm_conseqs
 
 
 def map_to_reference(fastq1, fastq2, refseqs, reffile, samfile, unmapped1, unmapped2,
                      bowtie2, bowtie2_build, raw_count, rdgopen, rfgopen, nthreads,
-                     new_counts, stderr, callback, debug_file_prefix=None):
+                     new_counts, stderr, callback, debug_file_prefix=None,
+                     shard_count=1):
     """ Map a pair of FASTQ files to a set of reference sequences.
 
     @param fastq1: FASTQ file with the forward reads
@@ -684,13 +1287,192 @@ def map_to_reference(fastq1, fastq2, refseqs, reffile, samfile, unmapped1, unmap
     @param debug_file_prefix: the prefix for the file path to write debug files.
         If not None, this will be used to write a copy of the reference FASTA
         file and the output SAM file.
+    @param shard_count: the number of bowtie2 processes to split the reads
+        and threads between.
+    @return: the number of unmapped reads
     """
-    # generate reference file from current set of consensus sequences
+    mapping_stats = {}
+    for _ in stream_to_reference(fastq1, fastq2, refseqs, reffile, samfile,
+                                 unmapped1, unmapped2, bowtie2, bowtie2_build,
+                                 raw_count, rdgopen, rfgopen, nthreads,
+                                 new_counts, stderr, callback,
+                                 debug_file_prefix=debug_file_prefix,
+                                 shard_count=shard_count,
+                                 mapping_stats=mapping_stats):
+        pass
+    return mapping_stats['unmapped_count']
+
+
+def get_reference_lengths(conseqs, mapped_conseqs=None):
+    """ Find the reference lengths to declare in the remap file's header.
+
+    Reads were mapped to the last iteration's consensus sequences, but split
+    reads get mapped to the new ones, so a reference's length has to cover
+    both of the sequences its reads were mapped to.
+    @param conseqs: {rname: consensus} that the split reads get mapped to
+    @param mapped_conseqs: {rname: consensus} that the last iteration mapped
+        to, or None if there were no iterations
+    @return: {rname: length}
+    """
+    references = {name: len(seq) for name, seq in conseqs.items()}
+    for name, seq in (mapped_conseqs or {}).items():
+        references[name] = max(len(seq), references.get(name, 0))
+    return references
+
+
+def remap_splits(splitter, conseqs, remap_writer, fieldnames, unmapped1,
+                 unmapped2, work_path, bowtie2, bowtie2_build, raw_count,
+                 rdgopen, rfgopen, stderr, shard_count, cpu_budget,
+                 callback=None, keep=False):
+    """ Remap each reference's split reads at the same time.
+
+    Each reference gets its own workspace, see remap_split(), and the results
+    are collected in the original order. The workspaces are removed when
+    they're collected, or if any of the remaps fail, unless keep is True.
+    @param splitter: the MixedReferenceSplitter that wrote the split reads
+    @param conseqs: {rname: consensus} to map the split reads to
+    @param remap_writer: where to write the remapped reads
+    @param fieldnames: the SAM field names for remap_writer
+    @param unmapped1: where to copy the forward reads that didn't map, or
+        None
+    @param unmapped2: where to copy the reverse reads that didn't map, or
+        None
+    @param work_path: the folder to create the workspaces in
+    @param cpu_budget: a CpuBudget to share between the remaps
+    @return: (split_counts, unmapped_count), where split_counts is
+        {rname: mapped_count}
+    See remap() for the other parameters.
+    """
+    split_counts = Counter()
+    unmapped_count = 0
+    split_count = len(splitter.splits)
+    split_workers = max(1, min(split_count, cpu_budget.total))
+    split_threads = max(1, cpu_budget.total // split_workers)
+    split_jobs = []
+    workspaces = []
+    try:
+        with ThreadPoolExecutor(max_workers=split_workers) as executor:
+            for rname, (split_file1, split_file2) in splitter.splits.items():
+                workspace = tempfile.mkdtemp(prefix='temp.split_',
+                                             dir=work_path or os.curdir)
+                workspaces.append(workspace)
+                future = executor.submit(remap_split,
+                                         split_file1.name,
+                                         split_file2.name,
+                                         {rname: conseqs[rname]},
+                                         workspace,
+                                         bowtie2,
+                                         bowtie2_build,
+                                         raw_count,
+                                         rdgopen,
+                                         rfgopen,
+                                         split_threads,
+                                         stderr,
+                                         shard_count=shard_count,
+                                         cpu_budget=cpu_budget)
+                split_jobs.append((rname, workspace, future))
+            for rname, workspace, future in split_jobs:
+                rname_counts, rname_unmapped_count = future.result()
+                split_counts.update(rname_counts)
+                unmapped_count += rname_unmapped_count
+                with open(os.path.join(workspace, 'temp.sam'), 'rU') as f:
+                    for fields in splitter.walk(f):
+                        remap_writer.writerow(dict(zip(fieldnames, fields)))
+                for unmapped, name in ((unmapped1, 'temp_unmapped_R1.fastq'),
+                                       (unmapped2, 'temp_unmapped_R2.fastq')):
+                    if unmapped:
+                        with open(os.path.join(workspace, name), 'rU') as f:
+                            shutil.copyfileobj(f, unmapped)
+                if callback:
+                    callback(message='... remapped split reads for ' + rname)
+                if not keep:
+                    shutil.rmtree(workspace)
+    finally:
+        if not keep:
+            # the executor has finished all the jobs, so nothing else is
+            # writing in the workspaces
+            for workspace in workspaces:
+                if os.path.isdir(workspace):
+                    shutil.rmtree(workspace)
+    return split_counts, unmapped_count
+
+
+def remap_split(fastq1, fastq2, refseqs, workspace, bowtie2, bowtie2_build,
+                raw_count, rdgopen, rfgopen, nthreads, stderr, shard_count=1,
+                cpu_budget=None):
+    """ Map split reads to their reference in a separate workspace.
+
+    Several of these can run at once, because all the working files are
+    written in the workspace: temp.fasta and its index, temp.sam, and
+    the unmapped reads in temp_unmapped_R1.fastq and temp_unmapped_R2.fastq.
+    See map_to_reference() for the other parameters.
+    @param workspace: a folder for all the working files
+    @param cpu_budget: a CpuBudget to reserve up to nthreads from while
+        mapping, so the splits that run at the same time share the
+        processors that are left. If None, nthreads are used.
+    @return: (split_counts, unmapped_count) split_counts is a Counter of
+        mapped reads for each reference, and unmapped_count is the number of
+        unmapped reads
+    """
+    reffile = os.path.join(workspace, 'temp.fasta')
+    samfile = os.path.join(workspace, 'temp.sam')
+    split_counts = Counter()
+    if cpu_budget is None:
+        cpu_budget = CpuBudget(nthreads)
+    with open(os.path.join(workspace, 'temp_unmapped_R1.fastq'), 'w') as unmapped1, \
+            open(os.path.join(workspace, 'temp_unmapped_R2.fastq'), 'w') as unmapped2, \
+            cpu_budget.reserve(nthreads) as mapping_threads:
+        unmapped_count = map_to_reference(
+            fastq1, fastq2, refseqs, reffile, samfile, unmapped1, unmapped2,
+            bowtie2, bowtie2_build, raw_count, rdgopen, rfgopen,
+            mapping_threads, split_counts, stderr, callback=None,
+            shard_count=shard_count)
+    return split_counts, unmapped_count
+
+
+def stream_to_reference(fastq1, fastq2, refseqs, reffile, samfile, unmapped1,
+                        unmapped2, bowtie2, bowtie2_build, raw_count, rdgopen,
+                        rfgopen, nthreads, new_counts, stderr, callback,
+                        debug_file_prefix=None, shard_count=1,
+                        mapping_stats=None):
+    """ Map reads like map_to_reference(), and yield the SAM lines.
+
+    The SAM lines are yielded, header first, as bowtie2 writes them, so
+    the caller can build consensus sequences without reading the SAM file
+    again. The SAM file is still written, because it holds the final
+    mapping once the remap loop stops. The parameters are the same as
+    map_to_reference(), plus:
+    @param mapping_stats: a dictionary that gets 'unmapped_count' set when
+        all the lines have been yielded
+    """
+    mapped_lines = run_bowtie2(fastq1, fastq2, refseqs, reffile, bowtie2,
+                               bowtie2_build, rdgopen, rfgopen, nthreads,
+                               stderr, shard_count=shard_count)
+    return record_mapping(mapped_lines, refseqs, reffile, samfile, unmapped1,
+                          unmapped2, raw_count, new_counts, callback,
+                          debug_file_prefix=debug_file_prefix,
+                          mapping_stats=mapping_stats)
+
+
+def write_reference(refseqs, reffile):
+    """ Write reference sequences to a FASTA file. """
     outfile = open(reffile, 'w')
     for region, conseq in refseqs.items():
         outfile.write('>%s\n%s\n' % (region, conseq))
     outfile.close()
 
+
+def run_bowtie2(fastq1, fastq2, refseqs, reffile, bowtie2, bowtie2_build,
+                rdgopen, rfgopen, nthreads, stderr, shard_count=1,
+                extra_args=()):
+    """ Build the index for a set of references, and yield bowtie2's output.
+
+    See map_to_reference() for most of the parameters.
+    @param extra_args: more command-line arguments for bowtie2
+    """
+    # generate reference file from current set of consensus sequences
+    write_reference(refseqs, reffile)
+
     # regenerate bowtie2 index files
     bowtie2_build.build(reffile, reffile)
 
@@ -705,50 +1487,57 @@ def map_to_reference(fastq1, fastq2, refseqs, reffile, samfile, unmapped1, unmap
         '--rdg', "{},{}".format(read_gap_open_penalty,
                                 READ_GAP_EXTEND),
         '--rfg', "{},{}".format(ref_gap_open_penalty,
-                                REF_GAP_EXTEND)
-    ]
-    
-    if fastq2 is None:
-        bowtie_args.extend(['-U', fastq1])
-    else:
-        bowtie_args.extend(['-1', fastq1, '-2', fastq2])
-        
-    bowtie_args.extend([
+                                REF_GAP_EXTEND),
         '--no-hd',  # no header lines (start with @)
         '--local',
-        '-X', '1200',
-        '-p', str(nthreads)
-    ])  
-
+        '-X', '1200'
+    ]
+    bowtie_args.extend(extra_args)
+    for line in bowtie2.yield_mapping(bowtie_args,
+                                      fastq1,
+                                      fastq2,
+                                      nthreads=nthreads,
+                                      shard_count=shard_count,
+                                      work_path=os.path.dirname(reffile),
+                                      stderr=stderr):
+        yield line
+
+
+def record_mapping(mapped_lines, refseqs, reffile, samfile, unmapped1,
+                   unmapped2, raw_count, new_counts, callback,
+                   debug_file_prefix=None, mapping_stats=None):
+    """ Write mapped SAM lines to a file, count them, and yield them.
+
+    See stream_to_reference() for the parameters.
+    @param mapped_lines: SAM lines without the header
+    """
     new_counts.clear()
     unmapped_count = 0
 
     with open(samfile, 'w') as f:
         # write SAM header
-        f.write('@HD\tVN:1.0\tSO:unsorted\n')
+        header = ['@HD\tVN:1.0\tSO:unsorted\n']
         for rname, refseq in refseqs.items():
-            f.write('@SQ\tSN:%s\tLN:%d\n' % (rname, len(refseq)))
-        f.write('@PG\tID:bowtie2\tPN:bowtie2\tVN:2.2.3\tCL:""\n')
+            header.append('@SQ\tSN:%s\tLN:%d\n' % (rname, len(refseq)))
+        header.append('@PG\tID:bowtie2\tPN:bowtie2\tVN:2.2.3\tCL:""\n')
+        for line in header:
+            f.write(line)
+            yield line
 
         # capture stdout stream to count reads before writing to file
-        for i, line in enumerate(bowtie2.yield_output(bowtie_args, stderr=stderr)):
+        for i, line in enumerate(mapped_lines):
             if callback and i % 1000 == 0:
                 callback(progress=i)  # progress monitoring in GUI
 
             f.write(line)
+            yield line
 
             items = line.split('\t')
-            qname, bitflag, rname, _, _, _, _, _, _, seq, qual = items[:11]
+            bitflag, rname = items[1:3]
 
             if is_unmapped_read(bitflag):
                 # did not map to any reference
-                if is_first_read(bitflag):
-                    if unmapped1:
-                        unmapped1.write('@%s\n%s\n+\n%s\n' % (qname, seq, qual))
-                else:
-                    if unmapped2:
-                        unmapped2.write('@%s\n%s\n+\n%s\n' % (qname, seq, qual))
-
+                write_unmapped_read(items, unmapped1, unmapped2)
                 unmapped_count += 1
                 continue
 
@@ -758,7 +1547,261 @@ def map_to_reference(fastq1, fastq2, refseqs, reffile, samfile, unmapped1, unmap
     if debug_file_prefix is not None:
         shutil.copy(reffile, debug_file_prefix + '_debug_ref.fasta')
         shutil.copy(samfile, debug_file_prefix + '_debug.sam')
-    return unmapped_count
+    if mapping_stats is not None:
+        mapping_stats['unmapped_count'] = unmapped_count
+
+
+def write_unmapped_read(fields, unmapped1, unmapped2):
+    """ Write an unmapped read in FASTQ format.
+
+    @param fields: the fields from a SAM record
+    @param unmapped1: an open file for forward reads, or None to skip them
+    @param unmapped2: an open file for reverse reads, or None to skip them
+    """
+    qname, bitflag = fields[:2]
+    seq, qual = fields[9:11]
+    unmapped = unmapped1 if is_first_read(bitflag) else unmapped2
+    if unmapped:
+        unmapped.write('@%s\n%s\n+\n%s\n' % (qname, seq, qual))
+
+
+def stream_incremental(is_paired, refseqs, old_refseqs, old_samfile, reffile,
+                       samfile, unmapped1, unmapped2, bowtie2, bowtie2_build,
+                       raw_count, rdgopen, rfgopen, nthreads, new_counts,
+                       stderr, callback, debug_file_prefix=None,
+                       shard_count=1, mapping_stats=None):
+    """ Map reads like stream_to_reference(), reusing the last mapping.
+
+    Reads that mapped to a reference with the same consensus as the last
+    mapping keep their alignments. If a consensus only changed in a small
+    window, reads that don't overlap the window keep their alignments, and
+    are shifted if the window changed length. All the other reads are mapped
+    again against all the references, and the SAM lines are yielded in the
+    same order as the last mapping.
+    @param is_paired: True if the reads are paired
+    @param old_refseqs: the references that old_samfile was mapped to
+    @param old_samfile: the last mapping's SAM file
+    @param mapping_stats: a dictionary that gets 'unmapped_count' and
+        'reused_count' set when all the lines have been yielded
+    See map_to_reference() for the other parameters.
+    """
+    changes = find_conseq_changes(old_refseqs, refseqs)
+    group_size = 2 if is_paired else 1
+    work_path = os.path.dirname(reffile)
+    kept_path = os.path.join(work_path, 'temp.kept.sam')
+    subset_paths = [os.path.join(work_path, 'temp.remap_R{}.fastq'.format(i))
+                    for i in range(1, group_size+1)]
+    is_kept = bytearray()  # one entry for each read or pair in old_samfile
+    with open(old_samfile, 'r') as old_sam, open(kept_path, 'w') as kept:
+        subsets = [open(path, 'w') for path in subset_paths]
+        lines = (line for line in old_sam if not line.startswith('@'))
+        for group in zip(*[lines]*group_size):
+            kept_lines = reuse_alignment(group, changes)
+            if kept_lines is None:
+                is_kept.append(0)
+                write_original_reads(group, subsets)
+            else:
+                is_kept.append(1)
+                kept.writelines(kept_lines)
+        for subset in subsets:
+            subset.close()
+
+    reused_count = sum(is_kept)
+    if reused_count < len(is_kept):
+        # keep bowtie2's output in the same order as the subset files
+        mapped_lines = run_bowtie2(subset_paths[0],
+                                   subset_paths[1] if is_paired else None,
+                                   refseqs, reffile, bowtie2, bowtie2_build,
+                                   rdgopen, rfgopen, nthreads, stderr,
+                                   shard_count=shard_count,
+                                   extra_args=['--reorder'])
+    else:
+        write_reference(refseqs, reffile)
+        mapped_lines = iter([])
+    merged_lines = merge_reused_lines(is_kept,
+                                      kept_path,
+                                      mapped_lines,
+                                      group_size,
+                                      subset_paths)
+    if mapping_stats is not None:
+        mapping_stats['reused_count'] = reused_count * group_size
+    return record_mapping(merged_lines, refseqs, reffile, samfile, unmapped1,
+                          unmapped2, raw_count, new_counts, callback,
+                          debug_file_prefix=debug_file_prefix,
+                          mapping_stats=mapping_stats)
+
+
+def find_conseq_changes(old_conseqs, new_conseqs,
+                        max_window=MAX_CHANGE_WINDOW):
+    """ Find how each consensus changed, to see which alignments can be reused.
+
+    @param old_conseqs: {rname: conseq} that reads were mapped to
+    @param new_conseqs: {rname: conseq} that reads will be mapped to
+    @param max_window: the longest change that alignments can be reused
+        around
+    @return: {rname: change} for each reference that can reuse alignments,
+        where change is None if the consensus didn't change, or
+        (start, end, shift) if the old consensus changed from start to end,
+        1-based and inclusive, and positions after end move by shift.
+    """
+    changes = {}
+    for rname, new_conseq in new_conseqs.items():
+        old_conseq = old_conseqs.get(rname)
+        if old_conseq is None:
+            continue
+        if old_conseq == new_conseq:
+            changes[rname] = None
+            continue
+        prefix_size, suffix_size = find_common_ends(old_conseq, new_conseq)
+        old_window = len(old_conseq) - prefix_size - suffix_size
+        new_window = len(new_conseq) - prefix_size - suffix_size
+        if max(old_window, new_window) > max_window:
+            continue
+        changes[rname] = (prefix_size + 1,
+                          len(old_conseq) - suffix_size,
+                          new_window - old_window)
+    return changes
+
+
+def find_common_ends(old_conseq, new_conseq):
+    """ Find how much two sequences have in common at each end.
+
+    @return: (prefix_size, suffix_size) the lengths of the matching start
+        and end, without overlapping each other
+    """
+    common_size = min(len(old_conseq), len(new_conseq))
+    prefix_size = 0
+    while (prefix_size < common_size and
+           old_conseq[prefix_size] == new_conseq[prefix_size]):
+        prefix_size += 1
+    suffix_size = 0
+    while (suffix_size < common_size - prefix_size and
+           old_conseq[-suffix_size-1] == new_conseq[-suffix_size-1]):
+        suffix_size += 1
+    return prefix_size, suffix_size
+
+
+def measure_conseq_changes(old_conseqs, new_conseqs):
+    """ Measure how much each consensus changed in a remap iteration.
+
+    @param old_conseqs: {rname: conseq} that reads were mapped to
+    @param new_conseqs: {rname: conseq} built from the mapped reads
+    @return: {rname: {'conseq_diff': diff, 'coverage_gain': gain}} for each
+        reference in both sets, where diff is the length of the window that
+        changed between the two consensus sequences, and gain is the change
+        in the number of positions that aren't N.
+    """
+    change_report = {}
+    for rname, new_conseq in new_conseqs.items():
+        old_conseq = old_conseqs.get(rname)
+        if old_conseq is None:
+            continue
+        if old_conseq == new_conseq:
+            conseq_diff = 0
+        else:
+            prefix_size, suffix_size = find_common_ends(old_conseq, new_conseq)
+            conseq_diff = max(len(old_conseq), len(new_conseq)) - (
+                prefix_size + suffix_size)
+        coverage_gain = ((len(new_conseq) - new_conseq.count('N')) -
+                         (len(old_conseq) - old_conseq.count('N')))
+        change_report[rname] = dict(conseq_diff=conseq_diff,
+                                    coverage_gain=coverage_gain)
+    return change_report
+
+
+def get_read_span(fields):
+    """ Find the reference positions a read covers, including soft clips.
+
+    @param fields: the fields from a SAM record
+    @return: (start, end) 1-based and inclusive
+    """
+    start = end = int(fields[3])
+    is_clip_start = True
+    for token in cigar_re.findall(fields[5]):
+        length = int(token[:-1])
+        operation = token[-1]
+        if operation == 'S':
+            if is_clip_start:
+                start -= length
+            else:
+                end += length
+        elif operation in 'MDN=X':
+            end += length
+        is_clip_start = False
+    return start, end - 1
+
+
+def reuse_alignment(lines, changes, margin=CHANGE_WINDOW_MARGIN):
+    """ Decide whether a read or pair can keep its alignment.
+
+    @param lines: SAM lines for a read, or for both reads in a pair
+    @param changes: {rname: change} from find_conseq_changes()
+    @param margin: how close to a changed window the reads can be
+    @return: a list of SAM lines to keep, with positions shifted past any
+        change, or None if the reads have to be mapped again.
+    """
+    rows = [line.split('\t') for line in lines]
+    rname = rows[0][2]
+    if rname not in changes:
+        return None
+    for row in rows:
+        if is_unmapped_read(row[1]) or row[2] != rname:
+            return None
+    change = changes[rname]
+    if change is None:
+        return list(lines)
+    change_start, change_end, shift = change
+    spans = [get_read_span(row) for row in rows]
+    reads_start = min(start for start, _ in spans)
+    reads_end = max(end for _, end in spans)
+    if reads_end < change_start - margin:
+        return list(lines)
+    if reads_start <= change_end + margin:
+        return None
+    for row in rows:
+        row[3] = str(int(row[3]) + shift)
+        if row[6] == '=':
+            row[7] = str(int(row[7]) + shift)
+    return ['\t'.join(row) for row in rows]
+
+
+def write_original_reads(lines, fastqs):
+    """ Write SAM records back to FASTQ in their original orientation.
+
+    @param lines: SAM lines for a read, or for both reads in a pair
+    @param fastqs: a list of open files, one for each read in a pair
+    """
+    IS_REVERSED = 0x10
+    for line in lines:
+        qname, flag, _, _, _, _, _, _, _, seq, qual = line.split('\t')[:11]
+        qual = qual.rstrip('\n')
+        if int(flag) & IS_REVERSED:
+            seq = reverse_and_complement(seq)
+            qual = qual[::-1]
+        fastq = fastqs[0] if len(fastqs) == 1 or is_first_read(flag) else fastqs[1]
+        fastq.write('@{}\n{}\n+\n{}\n'.format(qname, seq, qual))
+
+
+def merge_reused_lines(is_kept, kept_path, mapped_lines, group_size,
+                       temp_paths):
+    """ Merge the reused SAM lines with the new ones, in the original order.
+
+    @param is_kept: one entry for each read or pair, 1 if it was kept
+    @param kept_path: the SAM file with the kept lines
+    @param mapped_lines: the new SAM lines, in order
+    @param group_size: the number of SAM lines in each read or pair
+    @param temp_paths: more files to remove when finished
+    """
+    try:
+        with open(kept_path, 'r') as kept:
+            for is_read_kept in is_kept:
+                source = kept if is_read_kept else mapped_lines
+                for _ in range(group_size):
+                    yield next(source)
+    finally:
+        for path in [kept_path] + list(temp_paths):
+            if os.path.exists(path):
+                os.remove(path)
 
 
 class MixedReferenceSplitter(object):
@@ -850,23 +1893,17 @@ class MixedReferenceSplitter(object):
         fastq.write('@{}\n{}\n+\n{}\n'.format(qname, seq, quality))
 
 
-def matchmaker(samfile, include_singles):
+def read_mapped_lines(samfile):
     """
-    An iterator that returns pairs of reads sharing a common qname from a SAM file.
-    Note that unpaired reads will be left in the cached_rows dictionary and
-    discarded.
-    @param samfile: open file handle to a SAM file
-    @param include_singles: True if unpaired reads should be returned, paired
-        with a None value: ([qname, flag, rname, ...], None)
-    @return: yields a tuple for each read pair with fields split by tab chars:
-        ([qname, flag, rname, ...], [qname, flag, rname, ...])
+    Skip the header lines in a SAM file, and any lines that weren't mapped to
+    one of the references in the header.
+    @param samfile: open file handle to a SAM file, or SAM lines
+    @return: yields the SAM lines, each ending with a newline
     """
     ref_names = set()
-    cached_rows = {}
     for line in samfile:
-        row = line.strip('\n').split('\t')
-
         if line.startswith('@'):
+            row = line.strip('\n').split('\t')
             if row[0] == '@SQ':
                 for field in row[1:]:
                     field_name, value = field.split(':', 1)
@@ -874,32 +1911,73 @@ def matchmaker(samfile, include_singles):
                         ref_names.add(value)
             continue
 
-        qname = row[0]
-        ref_name = row[2]
+        if not line.endswith('\n'):
+            line += '\n'
+        ref_name = line.split('\t', 3)[2]
         if ref_name in ref_names:
-            old_row = cached_rows.pop(qname, None)
-            if old_row is None:
-                cached_rows[qname] = row
-            else:
-                # current row should be the second read of the pair
-                yield old_row, row
-                
-    if include_singles:
-        for row in cached_rows.values():
-            yield row, None
-
-
-def find_top_token(base_counts):
-    top_count = top_token = None
-    for token, count in base_counts.most_common():
-        if top_count is None:
-            top_token = token
-            top_count = count
-        elif count < top_count:
-            break
-        if token < top_token:
-            top_token = token
-    return top_token
+            yield line
+
+
+def get_line_qname(line):
+    return line.split('\t', 1)[0]
+
+
+def matchmaker(samfile, include_singles, mate_pairer=None):
+    """
+    An iterator that returns pairs of reads sharing a common qname from a SAM file.
+    @param samfile: open file handle to a SAM file
+    @param include_singles: True if unpaired reads should be returned, paired
+        with a None value: ([qname, flag, rname, ...], None), otherwise they
+        are discarded.
+    @param mate_pairer: a MatePairer to match the reads, so the caller can
+        check its statistics, or None for a default one
+    @return: yields a tuple for each read pair with fields split by tab chars:
+        ([qname, flag, rname, ...], [qname, flag, rname, ...])
+    """
+    if mate_pairer is None:
+        mate_pairer = MatePairer()
+    rows = (line.strip('\n').split('\t')
+            for line in read_mapped_lines(samfile))
+    return mate_pairer.pair(rows, include_singles)
+
+
+def batch_read_pairs(samfile, batch_size=BATCH_SIZE, mate_pairer=None):
+    """
+    Group the reads in a SAM file into batches of text to send to workers.
+    Pairs are found the same way as matchmaker(), but the lines are not
+    split into fields.
+    @param samfile: open file handle to a SAM file, or SAM lines
+    @param batch_size: the number of read pairs in each batch
+    @param mate_pairer: a MatePairer to match the reads, or None for a
+        default one
+    @return: yields (is_paired, text) for each batch. The text holds whole
+        SAM lines, two lines for each pair if is_paired is True, otherwise
+        one line for each unpaired read. Unpaired reads come last.
+    """
+    if mate_pairer is None:
+        mate_pairer = MatePairer(get_qname=get_line_qname)
+    batch = []
+    singles = []
+    pairs = mate_pairer.pair(read_mapped_lines(samfile), include_singles=True)
+    for line1, line2 in pairs:
+        if line2 is not None:
+            batch.append(line1)
+            batch.append(line2)
+            if len(batch) >= 2*batch_size:
+                yield True, ''.join(batch)
+                batch = []
+        else:
+            singles.append(line1)
+            if len(singles) >= batch_size:
+                if batch:
+                    yield True, ''.join(batch)
+                    batch = []
+                yield False, ''.join(singles)
+                singles = []
+    if batch:
+        yield True, ''.join(batch)
+    if singles:
+        yield False, ''.join(singles)
 
 
 def parse_args():
@@ -952,6 +2030,23 @@ def parse_args():
                         action='store_true')
     parser.add_argument("--keep", help="<optional> retain temporary files for debugging",
                         action='store_true')
+    parser.add_argument("--prelim_subsampled", action='store_true',
+                        help="<optional> prelim_csv only maps a sample of the read pairs")
+    parser.add_argument("--incremental", action='store_true',
+                        help="<optional> only remap reads whose consensus changed")
+    parser.add_argument("--convergence_threshold", type=int, default=None,
+                        help="<optional> stop rebuilding a consensus once it "
+                             "changes by no more than this many positions")
+    parser.add_argument("--mapper", choices=['bowtie2', 'amplicon'],
+                        default='bowtie2',
+                        help="<optional> map with bowtie2, or in this process "
+                             "for small amplicon references.")
+    parser.add_argument("--conseq_store",
+                        help="<optional> folder of consensus sequences from "
+                             "earlier runs to start from and update")
+    parser.add_argument("--conseq_key",
+                        help="<optional> sample or patient identifier in the "
+                             "consensus store")
     
     return parser.parse_args()
 
@@ -974,7 +2069,15 @@ def main():
           unmapped2=args.unmapped2,
           callback=my_callback if args.verbose else None,
           gzip=args.gzip,
-          keep=args.keep)
+          keep=args.keep,
+          prelim_subsampled=args.prelim_subsampled,
+          incremental=args.incremental,
+          convergence_threshold=args.convergence_threshold,
+          mapper=args.mapper,
+          conseq_store=(ConseqStore(args.conseq_store)
+                        if args.conseq_store
+                        else None),
+          conseq_key=args.conseq_key)
 
 
 if __name__ == '__main__':
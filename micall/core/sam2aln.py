@@ -8,9 +8,12 @@ clips).
 """
 
 import argparse
+from io import StringIO
 import collections
+import csv
 from csv import DictReader, DictWriter
-#import itertools
+from functools import lru_cache, partial
+import itertools
 
 try:
     import multiprocessing.forking  # Python 2.x
@@ -18,12 +21,29 @@ except:
     import multiprocessing.popen_fork as forking  # Python 3.x
 
 import multiprocessing.pool
+from operator import itemgetter
 import os
 import re
 import sys
 
+from micall.utils.aligned_deltas import DeltaWriter
+from micall.utils.bam import BamReader, find_chunk_ranges, is_bam, load_index
+from micall.utils.mate_pairer import MatePairer
+from micall.utils.packed_sam import is_binary, read_sam_rows
+from micall.utils.spilling_counter import SpillingCounter
+
 SAM2ALN_Q_CUTOFFS = [15]  # Q-cutoff for base censoring
 MAX_PROP_N = 0.5          # Drop reads with more censored bases than this proportion
+MERGE_MEMO_SIZE = 10000   # Read pairs to remember merges for, 0 to disable
+# Lowest Phred score in each bin when qualities are binned. The bins split at
+# each cutoff, so binning never moves a base across a cutoff.
+QUALITY_BIN_EDGES = sorted({0, 2, 10, 20, 25, 30, 35, 40}.union(
+    qcut+1 for qcut in SAM2ALN_Q_CUTOFFS))
+PARSE_CHUNK_SIZE = 100  # Read pairs to send to a worker process at once
+MIN_RANGE_SIZE = 1 << 20  # Bytes of remap CSV to send to a worker at least
+MIN_RANGE_RECORDS = 10000  # BAM records to send to a worker at least
+RANGES_PER_THREAD = 4     # More ranges than workers, to balance the load
+MAX_COUNTED_SEQS = 1000000  # Distinct merged sequences to hold before spilling
 
 
 def parseArgs():
@@ -42,6 +62,16 @@ def parseArgs():
                         type=argparse.FileType('w'),
                         help='<output> CSV containing reads that failed to merge')
     parser.add_argument('-p', type=int, default=None, help='(optional) number of threads')
+    parser.add_argument('--memo_size', type=int, default=MERGE_MEMO_SIZE,
+                        help='(optional) number of read pairs to remember '
+                             'merges for, 0 to disable')
+    parser.add_argument('--bin_qualities', action='store_true',
+                        help='(optional) bin quality scores, so more read '
+                             'pairs share a merge')
+    parser.add_argument('--delta', action='store_true',
+                        help='(optional) write each merged sequence as its '
+                             'differences from a reference built up from the '
+                             'earlier rows for its region and cutoff')
 
     return parser.parse_args()
 
@@ -78,7 +108,9 @@ class Process(multiprocessing.Process):
 
 
 class Pool(multiprocessing.pool.Pool):
-    Process = Process
+    @staticmethod
+    def Process(ctx, *args, **kwds):
+        return Process(*args, **kwds)
 
 
 def apply_cigar(cigar, seq, qual, pos=0, clip_from=0, clip_to=None):
@@ -107,50 +139,100 @@ def apply_cigar(cigar, seq, qual, pos=0, clip_from=0, clip_to=None):
         the value. If none of the read was within the clipped range, then both
         strings will be blank and the dictionary will be empty.
     """
-    newseq = '-' * int(pos)  # pad on left
-    newqual = '!' * int(pos)
-    insertions = {}
-    is_valid = re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar)
-    tokens = re.findall(r'  (\d+)([MIDNSHPX=])', cigar, re.VERBOSE)
-    if not is_valid:
-        raise RuntimeError('Invalid CIGAR string: {!r}.'.format(cigar))
-    end = None if clip_to is None else clip_to + 1
-    left = 0
-    for token in tokens:
-        length, operation = token
-        length = int(length)
-        # Matching sequence: carry it over
-        if operation == 'M':
-            newseq += seq[left:(left+length)]
-            newqual += qual[left:(left+length)]
-            left += length
-        # Deletion relative to reference: pad with gaps
-        elif operation == 'D':
-            newseq += '-'*length
-            newqual += ' '*length  # Assign fake placeholder score (Q=-1)
-        # Insertion relative to reference
-        elif operation == 'I':
-            if end is None or left+pos < end:
-                insertions[left+pos-clip_from] = (seq[left:(left+length)],
-                                                  qual[left:(left+length)])
-            left += length
-        # Soft clipping leaves the sequence in the SAM - so we should skip it
-        elif operation == 'S':
-            left += length
-        else:
-            raise RuntimeError('Unsupported CIGAR token: {!r}.'.format(
-                ''.join(token)))
-        if left > len(seq):
-            raise RuntimeError(
-                'CIGAR string {!r} is too long for sequence {!r}.'.format(cigar,
-                                                                          seq))
+    return compile_cigar(cigar).apply(seq, qual, pos, clip_from, clip_to)
+
+
+def apply_cigar_batch(reads):
+    """ Apply CIGAR strings to many reads, like apply_cigar().
 
-    if left < len(seq):
-        raise RuntimeError(
-            'CIGAR string {!r} is too short for sequence {!r}.'.format(cigar,
-                                                                       seq))
+    @param reads: a sequence of tuples with apply_cigar() arguments:
+        (cigar, seq, qual), optionally followed by pos, clip_from, and clip_to
+    @return: a list of apply_cigar() results, in the same order as reads
+    """
+    return [compile_cigar(cigar).apply(seq, qual, *clipping)
+            for cigar, seq, qual, *clipping in reads]
 
-    return newseq[clip_from:end], newqual[clip_from:end], insertions
+
+@lru_cache(maxsize=1024)
+def compile_cigar(cigar):
+    """ Parse a CIGAR string once, because the same few are used by most reads.
+
+    @return: a CompiledCigar
+    """
+    return CompiledCigar(cigar)
+
+
+class CompiledCigar(object):
+    def __init__(self, cigar):
+        """ Parse a CIGAR string into the pieces that build an aligned read.
+
+        @param cigar: a string in the CIGAR format
+        """
+        if not re.match(r'^((\d+)([MIDNSHPX=]))*$', cigar):
+            raise RuntimeError('Invalid CIGAR string: {!r}.'.format(cigar))
+        self.cigar = cigar
+        self.seq_parts = []  # slices of the read, or gaps for deletions
+        self.qual_parts = []
+        self.insertions = []  # [(start, end)] offsets in the read
+        self.unsupported_token = None
+        left = 0
+        for length_text, operation in re.findall(r'(\d+)([MIDNSHPX=])', cigar):
+            length = int(length_text)
+            # Matching sequence: carry it over
+            if operation == 'M':
+                self.seq_parts.append(slice(left, left+length))
+                self.qual_parts.append(slice(left, left+length))
+                left += length
+            # Deletion relative to reference: pad with gaps
+            elif operation == 'D':
+                self.seq_parts.append('-'*length)
+                self.qual_parts.append(' '*length)  # Assign fake placeholder score (Q=-1)
+            # Insertion relative to reference
+            elif operation == 'I':
+                self.insertions.append((left, left+length))
+                left += length
+            # Soft clipping leaves the sequence in the SAM - so we should skip it
+            elif operation == 'S':
+                left += length
+            else:
+                self.unsupported_token = length_text + operation
+                break
+        # read length used by the tokens before any unsupported one
+        self.read_length = left
+        self.is_simple = self.seq_parts == [slice(0, left)]
+
+    def apply(self, seq, qual, pos=0, clip_from=0, clip_to=None):
+        """ Apply the CIGAR to a read. See apply_cigar(). """
+        if self.read_length > len(seq):
+            raise RuntimeError(
+                'CIGAR string {!r} is too long for sequence {!r}.'.format(
+                    self.cigar,
+                    seq))
+        if self.unsupported_token is not None:
+            raise RuntimeError('Unsupported CIGAR token: {!r}.'.format(
+                self.unsupported_token))
+        if self.read_length < len(seq):
+            raise RuntimeError(
+                'CIGAR string {!r} is too short for sequence {!r}.'.format(
+                    self.cigar,
+                    seq))
+
+        pad_size = int(pos)
+        if self.is_simple:
+            newseq = '-'*pad_size + seq
+            newqual = '!'*pad_size + qual[:len(seq)]
+        else:
+            newseq = '-'*pad_size + ''.join([
+                seq[part] if part.__class__ is slice else part
+                for part in self.seq_parts])
+            newqual = '!'*pad_size + ''.join([
+                qual[part] if part.__class__ is slice else part
+                for part in self.qual_parts])
+        end = None if clip_to is None else clip_to + 1
+        insertions = {left+pos-clip_from: (seq[left:right], qual[left:right])
+                      for left, right in self.insertions
+                      if end is None or left+pos < end}
+        return newseq[clip_from:end], newqual[clip_from:end], insertions
 
 
 def merge_pairs(seq1, seq2, qual1, qual2, ins1=None, ins2=None, q_cutoff=10,
@@ -177,6 +259,253 @@ def merge_pairs(seq1, seq2, qual1, qual2, ins1=None, ins2=None, q_cutoff=10,
         will be reported as an N.
     @return: the merged sequence of base calls in a string
     """
+    pairs = [(seq1, seq2, qual1, qual2, ins1, ins2)]
+    return merge_pairs_batch(pairs, q_cutoff, minimum_q_delta)[0]
+
+
+def merge_pairs_batch(pairs, q_cutoff=10, minimum_q_delta=5):
+    """ Merge many read pairs, with the same results as merge_pairs().
+
+    @param pairs: a sequence of tuples with merge_pairs() arguments:
+        (seq1, seq2, qual1, qual2), optionally followed by ins1 and ins2
+    @param q_cutoff: see merge_pairs()
+    @param minimum_q_delta: see merge_pairs()
+    @return: a list of merged sequences, in the same order as pairs
+    """
+    return [mseqs[q_cutoff]
+            for mseqs in merge_pairs_cutoffs(pairs,
+                                             [q_cutoff],
+                                             minimum_q_delta)]
+
+
+def merge_pairs_cutoffs(pairs, q_cutoffs, minimum_q_delta=5):
+    """ Merge many read pairs at several quality cutoffs in a single pass.
+
+    Instead of looping over each position in Python, the base calls and
+    quality scores of all the pairs are packed into long integers with a
+    16-bit lane for each character. Then a few integer operations compare
+    every position at once, and choose a base call with the quality score
+    that backs it up. Each cutoff only has to compare those scores with its
+    threshold to decide which bases become N.
+    @param pairs: a sequence of tuples with merge_pairs() arguments:
+        (seq1, seq2, qual1, qual2), optionally followed by ins1 and ins2
+    @param q_cutoffs: a sequence of q_cutoff values, see merge_pairs()
+    @param minimum_q_delta: see merge_pairs()
+    @return: a list of {q_cutoff: merged_sequence}, in the same order as
+        pairs
+    """
+    pairs = list(pairs)
+    q_cutoffs = list(q_cutoffs)
+    q_cutoff_codes = [ord(chr(q_cutoff+33)) for q_cutoff in q_cutoffs]
+    merged = []
+    overlaps = []  # [(seq1, seq2, qual1, qual2)] where both reads overlap
+    tails = []  # [(seq2, qual2)] past the end of the shorter read
+    for seq1, seq2, qual1, qual2, *inserts in pairs:
+        # force second read to be longest of the two
+        if len(seq1) > len(seq2):
+            seq1, seq2 = seq2, seq1
+            qual1, qual2 = qual2, qual1
+        if len(qual1) < len(seq1) or len(qual2) < len(seq2):
+            # not worth packing, just fail the same way
+            merged.append({q_cutoff: merge_pairs_by_char(
+                seq1, seq2, qual1, qual2,
+                *inserts,
+                q_cutoff=q_cutoff,
+                minimum_q_delta=minimum_q_delta)
+                for q_cutoff in q_cutoffs})
+            continue
+        size1 = len(seq1)
+        overlaps.append((seq1, seq2[:size1], qual1[:size1], qual2[:size1]))
+        tails.append((seq2[size1:], qual2[size1:len(seq2)]))
+        merged.append((seq1, seq2, inserts))
+
+    try:
+        merged_overlaps = _merge_overlaps(overlaps,
+                                          q_cutoff_codes,
+                                          minimum_q_delta)
+        merged_tails = _merge_tails(tails, q_cutoff_codes)
+    except UnicodeEncodeError:
+        # Only ASCII text can be packed.
+        return [{q_cutoff: merge_pairs_by_char(*pair,
+                                               q_cutoff=q_cutoff,
+                                               minimum_q_delta=minimum_q_delta)
+                 for q_cutoff in q_cutoffs}
+                for pair in pairs]
+
+    overlap_start = tail_start = 0
+    for i, entry in enumerate(merged):
+        if isinstance(entry, dict):
+            continue
+        seq1, seq2, inserts = entry
+        size1 = len(seq1)
+        size2 = len(seq2)
+        reverse_start = size2 - len(seq2.lstrip('-'))
+        # Forward read never started: drop the gaps both reads share.
+        is_forward_empty = reverse_start >= size1 and not seq1.strip('-')
+        interval_size = max(0, reverse_start - size1)
+        mseqs = {}
+        for q_cutoff, overlap_text, tail_text in zip(q_cutoffs,
+                                                     merged_overlaps,
+                                                     merged_tails):
+            if is_forward_empty:
+                mseq = ''
+            else:
+                mseq = overlap_text[overlap_start:overlap_start+size1]
+            tail = tail_text[tail_start:tail_start+size2-size1]
+            mseq += 'n'*interval_size + tail[interval_size:]  # interval between reads
+
+            if any(inserts):
+                merged_inserts = merge_inserts(*inserts,
+                                               q_cutoff=q_cutoff,
+                                               minimum_q_delta=minimum_q_delta)
+                mseq = insert_merged_inserts(mseq, merged_inserts)
+            mseqs[q_cutoff] = mseq
+        overlap_start += size1
+        tail_start += size2-size1
+        merged[i] = mseqs
+    return merged
+
+
+class _Lanes(object):
+    """ Compare characters packed in 16-bit lanes of long integers.
+
+    Characters are all below 0x8000, so adding or subtracting two lanes
+    never carries into the next lane. Comparisons return masks with the
+    high bit set in each lane where the comparison is true.
+    """
+    MAX_CODE = 0x7FFF
+
+    def __init__(self, size):
+        self.size = size
+        self.ones = int.from_bytes(b'\x01\x00' * size, 'little')
+        self.high = self.ones << 15
+        self.low = self.ones * self.MAX_CODE
+
+    def pack(self, text):
+        raw = text.encode('ascii')
+        lanes = bytearray(2 * len(raw))
+        lanes[::2] = raw
+        return int.from_bytes(lanes, 'little')
+
+    def unpack(self, lanes):
+        return lanes.to_bytes(2 * self.size, 'little')[::2].decode('ascii')
+
+    def fill(self, code):
+        return self.ones * code
+
+    def greater(self, a, b):
+        return (a + (self.low - b)) & self.high
+
+    def equal(self, a, b):
+        return (((a ^ b) + self.low) & self.high) ^ self.high
+
+    def select(self, lanes, mask):
+        return lanes & ((mask >> 15) * 0xFFFF)
+
+    def censor(self, calls, quals, q_cutoff_codes):
+        """ Replace base calls with N unless their quality beats a cutoff.
+
+        @param calls: packed base calls
+        @param quals: packed quality scores for the calls, MAX_CODE to keep
+            a call at any cutoff
+        @param q_cutoff_codes: a quality score character code for each cutoff
+        @return: a list of the censored text for each cutoff
+        """
+        n_lanes = self.fill(ord('N'))
+        censored_texts = []
+        for q_cutoff_code in q_cutoff_codes:
+            cutoff_lanes = self.fill(min(q_cutoff_code, self.MAX_CODE - 1))
+            keep = self.greater(quals, cutoff_lanes)
+            censored_texts.append(self.unpack(
+                self.select(calls, keep) |
+                self.select(n_lanes, self.high ^ keep)))
+        return censored_texts
+
+
+def _merge_overlaps(overlaps, q_cutoff_codes, minimum_q_delta):
+    """ Merge the positions where both reads are, for a batch of pairs.
+
+    @return: a list with the merged positions of all the pairs in a single
+        string for each cutoff
+    """
+    seqs1, seqs2, quals1, quals2 = zip(*overlaps) if overlaps else ([],)*4
+    lanes = _Lanes(sum(map(len, seqs1)))
+    c1 = lanes.pack(''.join(seqs1))
+    c2 = lanes.pack(''.join(seqs2))
+    q1 = lanes.pack(''.join(quals1))
+    q2 = lanes.pack(''.join(quals2))
+
+    agree = lanes.equal(c1, c2)
+    disagree = agree ^ lanes.high
+    both_gaps = agree & lanes.equal(c1, lanes.fill(ord('-')))
+    higher1 = lanes.greater(q1, q2)
+    higher2 = lanes.greater(q2, q1)
+    if minimum_q_delta <= 0:
+        resolvable = lanes.high
+    elif minimum_q_delta > 0x7F:
+        resolvable = 0  # ASCII scores can't be that far apart
+    else:
+        delta = lanes.fill(minimum_q_delta - 1)
+        resolvable = lanes.greater(q1, q2 + delta) | lanes.greater(q2, q1 + delta)
+
+    # Matching calls are backed by the better score, and a disagreement is
+    # won by the better score if it's far enough ahead. The rest are N.
+    pick1 = agree | higher1
+    decided = agree | (disagree & resolvable & (higher1 | higher2))
+    calls = lanes.select(c1, pick1) | lanes.select(c2, lanes.high ^ pick1)
+    best_quals = lanes.select(q1, higher1) | lanes.select(q2, lanes.high ^ higher1)
+    quals = (lanes.select(best_quals, decided ^ both_gaps) |
+             lanes.select(lanes.fill(lanes.MAX_CODE), both_gaps))
+    return lanes.censor(calls, quals, q_cutoff_codes)
+
+
+def _merge_tails(tails, q_cutoff_codes):
+    """ Censor the positions past the end of the shorter read.
+
+    @return: a list with the censored positions of all the pairs in a single
+        string for each cutoff
+    """
+    seqs2, quals2 = zip(*tails) if tails else ([], [])
+    lanes = _Lanes(sum(map(len, seqs2)))
+    c2 = lanes.pack(''.join(seqs2))
+    q2 = lanes.pack(''.join(quals2))
+    gaps = lanes.equal(c2, lanes.fill(ord('-')))
+    quals = (lanes.select(q2, lanes.high ^ gaps) |
+             lanes.select(lanes.fill(lanes.MAX_CODE), gaps))
+    return lanes.censor(c2, quals, q_cutoff_codes)
+
+
+def insert_merged_inserts(mseq, merged_inserts):
+    """ Add merged insertions to a merged sequence.
+
+    @param mseq: the merged sequence
+    @param merged_inserts: {pos: seq} from merge_inserts()
+    @return: the merged sequence with the insertions added before each
+        zero-based position
+    """
+    positions = sorted(merged_inserts)
+    if positions and positions[-1] > len(mseq):
+        # Insertions past the end stack up in reverse order.
+        for pos in reversed(positions):
+            mseq = mseq[:pos] + merged_inserts[pos] + mseq[pos:]
+        return mseq
+    parts = []
+    start = 0
+    for pos in positions:
+        parts.append(mseq[start:pos])
+        parts.append(merged_inserts[pos])
+        start = pos
+    parts.append(mseq[start:])
+    return ''.join(parts)
+
+
+def merge_pairs_by_char(seq1, seq2, qual1, qual2, ins1=None, ins2=None,
+                        q_cutoff=10, minimum_q_delta=5):
+    """ Merge a pair of reads one position at a time.
+
+    This is the original version of merge_pairs(), kept for text that can't
+    be packed into lanes. See merge_pairs() for the parameters.
+    """
     mseq = ''
     # force second read to be longest of the two
     if len(seq1) > len(seq2):
@@ -289,34 +618,153 @@ def is_first_read(flag):
     return (int(flag) & IS_FIRST_SEGMENT) != 0
 
 
-def matchmaker(remap_csv):
+def matchmaker(remap_csv, mate_pairer=None, threads=1):
     """
     An iterator that returns pairs of reads sharing a common qname from a remap CSV.
     Note that unpaired reads will be yielded paired with None.
-    :param remap_csv: open file handle to CSV generated by remap.py
+    :param remap_csv: open file handle to CSV generated by remap.py, or to the
+        packed binary format if opened in binary mode
+    :param mate_pairer: a MatePairer to match the reads, so the caller can
+        check its statistics, or None for a default one
+    :param threads: the number of threads to decompress BAM blocks in
     :return: yields pairs of rows from DictReader corresponding to paired reads
     """
-    reader = DictReader(remap_csv)
-    cached_rows = {}
-    for row in reader:
-        qname = row['qname']
-        old_row = cached_rows.pop(qname, None)
-        if old_row is None:
-            cached_rows[qname] = row
+    if mate_pairer is None:
+        mate_pairer = MatePairer(get_qname=itemgetter('qname'))
+    return mate_pairer.pair(read_sam_rows(remap_csv, threads))
+
+
+def add_pairing_stats(merge_stats, mate_pairer):
+    """ Add a MatePairer's orphan and spill counts to sam2aln()'s stats. """
+    merge_stats['orphan_count'] += mate_pairer.orphan_count
+    merge_stats['spilled_count'] += mate_pairer.spilled_count
+
+
+class MergeMemo(object):
+    def __init__(self, max_size=MERGE_MEMO_SIZE, quality_bins=None):
+        """ Remember the merges of recent read pairs.
+
+        Amplicon samples have many read pairs with exactly the same
+        alignments, so their merges can be reused.
+        @param max_size: the most read pairs to remember, dropping the least
+            recently used ones
+        @param quality_bins: the lowest Phred score in each bin, or None to
+            leave the quality scores alone. Binned scores change the merged
+            sequences a little, but let similar read pairs share a merge.
+            Insertions still report their original quality scores. See
+            QUALITY_BIN_EDGES.
+        """
+        self.max_size = max_size
+        self.quality_bins = quality_bins
+        self.merges = collections.OrderedDict()
+        self.hit_count = self.miss_count = 0
+        if quality_bins is None:
+            self.quality_table = None
         else:
-            # current row should be the second read of the pair
-            yield old_row, row
+            self.quality_table = {}
+            for score in range(94):
+                bin_start = max(edge for edge in quality_bins if edge <= score)
+                self.quality_table[score+33] = bin_start+33
+
+    def merge(self, read1, read2=None):
+        """ Merge a read pair, or reuse the merge of an identical one.
+
+        See merge_alignments() for the parameters and return value.
+        """
+        if self.quality_table is None:
+            key = (read1, read2)
+        else:
+            key = (self.bin_qualities(read1),
+                   read2 and self.bin_qualities(read2))
+        merged = self.merges.get(key)
+        if merged is not None:
+            self.hit_count += 1
+            self.merges.move_to_end(key)
+        else:
+            self.miss_count += 1
+            merged = merge_alignments(*key)
+            self.merges[key] = merged
+            if len(self.merges) > self.max_size:
+                self.merges.popitem(last=False)
+        if self.quality_table is not None and merged[1]:
+            # The insertions have binned qualities, maybe from another pair.
+            mseqs, _inserts, failure_cause = merged
+            merged = mseqs, find_inserts(read1, read2), failure_cause
+        return merged
+
+    def bin_qualities(self, read):
+        pos, cigar, seq, qual, fwd_rev = read
+        return pos, cigar, seq, qual.translate(self.quality_table), fwd_rev
+
+
+def find_inserts(read1, read2=None):
+    """ Find the insertions in a read pair, without merging it.
+
+    See merge_alignments() for the parameters.
+    @return: [(fwd_rev, pos, insertion_sequence, insertion_quality)]
+    """
+    inserts = []
+    for pos_text, cigar, seq, qual, fwd_rev in filter(None, (read1, read2)):
+        pos = int(pos_text)-1  # convert 1-index to 0-index
+        _seq, _qual, read_inserts = apply_cigar(cigar, seq, qual)
+        for left, (iseq, iqual) in read_inserts.items():
+            inserts.append((fwd_rev, pos+left, iseq, iqual))
+    return inserts
+
+
+def merge_alignments(read1, read2=None):
+    """ Apply the CIGAR strings to a read pair, and merge the reads.
+
+    @param read1: (pos, cigar, seq, qual, fwd_rev) for the first read, where
+        pos is the one-based position text from the SAM file, and fwd_rev is
+        'F' or 'R'
+    @param read2: the same for the mate, or None if the read isn't paired
+    @return: (merged_seqs, inserts, failure_cause) where merged_seqs is
+        {qcut: seq} the merged sequence for each cutoff level, inserts is
+        [(fwd_rev, pos, insertion_sequence, insertion_quality)], and
+        failure_cause is None or the reason the merge failed.
+    """
+    mseqs = {}
+    inserts = []
+    failure_cause = None
+    aligned_reads = []
+    for pos_text, cigar, seq, qual, fwd_rev in filter(None, (read1, read2)):
+        pos = int(pos_text)-1  # convert 1-index to 0-index
+        seq, qual, read_inserts = apply_cigar(cigar, seq, qual)
 
-    # Unmatched reads
-    for old_row in cached_rows.values():
-        yield old_row, None
+        # report insertions relative to sample consensus
+        for left, (iseq, iqual) in read_inserts.items():
+            inserts.append((fwd_rev, pos+left, iseq, iqual))
+
+        seq = '-'*pos + seq  # pad sequence on left
+        qual = '!'*pos + qual  # assign lowest quality to gap prefix so it does not override mate
+        aligned_reads.append((seq, qual))
+
+    # merge reads at all the cutoff levels at once
+    seq1, qual1 = aligned_reads[0]
+    if read2 is not None:
+        seq2, qual2 = aligned_reads[1]
+        merged_seqs = merge_pairs_cutoffs([(seq1, seq2, qual1, qual2)],
+                                          SAM2ALN_Q_CUTOFFS)[0]
+    else:
+        merged_seqs = {qcut: seq1 for qcut in SAM2ALN_Q_CUTOFFS}
+    for qcut in SAM2ALN_Q_CUTOFFS:
+        mseq = merged_seqs[qcut]
+        prop_N = mseq.count('N') / float(len(mseq.strip('-')))
+        if prop_N > MAX_PROP_N:
+            # fail read pair
+            failure_cause = 'manyNs'
+        else:
+            mseqs[qcut] = mseq
+    return mseqs, inserts, failure_cause
 
 
-def parse_sam(rows, unpaired=False):
+def parse_sam(rows, unpaired=False, merge_memo=None):
     """ Merge two matched reads into a single aligned read.
 
     Also report insertions and failed merges.
     @param rows: tuple holding a pair of matched rows - forward and reverse reads
+    @param merge_memo: a MergeMemo to look up identical read pairs in, or None
     @return: (refname, merged_seqs, insert_list, failed_list) where
         merged_seqs is {qcut: seq} the merged sequence for each cutoff level
         insert_list is [{'qname': query_name,
@@ -358,49 +806,27 @@ def parse_sam(rows, unpaired=False):
         failure_cause = '2refs'
 
     if not failure_cause:
-        pos1 = int(row1['pos'])-1  # convert 1-index to 0-index
-        seq1, qual1, inserts = apply_cigar(cigar1, row1['seq'], row1['qual'])
-
-        # report insertions relative to sample consensus
-        for left, (iseq, iqual) in inserts.items():
+        reads = [(row['pos'],
+                  row['cigar'],
+                  row['seq'],
+                  row['qual'],
+                  'F' if is_first_read(row['flag']) else 'R')
+                 for row in (row1, row2 if is_paired else None)
+                 if row is not None]
+        if merge_memo is None:
+            merged = merge_alignments(*reads)
+        else:
+            merged = merge_memo.merge(*reads)
+        merged_seqs, inserts, failure_cause = merged
+        mseqs.update(merged_seqs)
+        for fwd_rev, pos, iseq, iqual in inserts:
             insert_list.append({'qname': qname,
-                                'fwd_rev': 'F' if is_first_read(row1['flag']) else 'R',
+                                'fwd_rev': fwd_rev,
                                 'refname': rname,
-                                'pos': pos1+left,
+                                'pos': pos,
                                 'insert': iseq,
                                 'qual': iqual})
 
-        seq1 = '-'*pos1 + seq1  # pad sequence on left
-        qual1 = '!'*pos1 + qual1  # assign lowest quality to gap prefix so it does not override mate
-
-        # now process the mate
-        if is_paired:
-            pos2 = int(row2['pos'])-1  # convert 1-index to 0-index
-            seq2, qual2, inserts = apply_cigar(cigar2, row2['seq'], row2['qual'])
-            for left, (iseq, iqual) in inserts.items():
-                insert_list.append({'qname': qname,
-                                    'fwd_rev': 'F' if is_first_read(row2['flag']) else 'R',
-                                    'refname': rname,
-                                    'pos': pos2+left,
-                                    'insert': iseq,
-                                    'qual': iqual})
-            seq2 = '-'*pos2 + seq2
-            qual2 = '!'*pos2 + qual2
-
-        # merge reads
-        for qcut in SAM2ALN_Q_CUTOFFS:
-            if is_paired:
-                mseq = merge_pairs(seq1, seq2, qual1, qual2, q_cutoff=qcut)
-            else:
-                mseq = seq1
-
-            prop_N = mseq.count('N') / float(len(mseq.strip('-')))
-            if prop_N > MAX_PROP_N:
-                # fail read pair
-                failure_cause = 'manyNs'
-            else:
-                mseqs[qcut] = mseq
-
     if failure_cause:
         failed_list.append({'qname': qname,
                             'cause': failure_cause})
@@ -408,23 +834,474 @@ def parse_sam(rows, unpaired=False):
     return rname, mseqs, insert_list, failed_list
 
 
-def parse_sam_in_threads(remap_csv, nthreads):
+def parse_sam_in_threads(remap_csv,
+                         nthreads,
+                         memo_size=MERGE_MEMO_SIZE,
+                         quality_bins=None,
+                         merge_stats=None,
+                         worker_pool=None):
     """ Call parse_sam() in multiple processes.
 
     Launch a multiprocessing pool, walk through the iterator, and then be sure
-    to close the pool at the end.
+    to close the pool at the end. Each process keeps its own MergeMemo.
+    See sam2aln() for the other parameters.
     """
-    pool = Pool(processes=nthreads)
+    is_pool_owned = worker_pool is None
+    pool = Pool(processes=nthreads) if is_pool_owned else worker_pool
+    mate_pairer = MatePairer(get_qname=itemgetter('qname'))
     try:
-        reads = pool.imap(parse_sam, iterable=matchmaker(remap_csv), chunksize=100)
-        for read in reads:
-            yield read
+        pairs = matchmaker(remap_csv, mate_pairer, nthreads)
+        chunks = iter(lambda: list(itertools.islice(pairs, PARSE_CHUNK_SIZE)),
+                      [])
+        parse_chunk = partial(parse_sam_chunk,
+                              memo_size=memo_size,
+                              quality_bins=quality_bins)
+        for reads, hit_count, miss_count in pool.imap(parse_chunk, chunks):
+            if merge_stats is not None:
+                merge_stats['hit_count'] += hit_count
+                merge_stats['miss_count'] += miss_count
+            for read in reads:
+                yield read
+        if merge_stats is not None:
+            add_pairing_stats(merge_stats, mate_pairer)
     finally:
-        pool.close()
-        pool.join()
+        if is_pool_owned:
+            pool.close()
+            pool.join()
+
 
+worker_merge_memo = None
 
-def sam2aln(remap_csv, aligned_csv, insert_csv=None, failed_csv=None, nthreads=None):
+
+def get_worker_memo(memo_size, quality_bins):
+    """ Find or create the MergeMemo for a worker process.
+
+    The memo is kept between tasks, and even between samples when the pool
+    is shared, because merges don't depend on the sample.
+    @return: a MergeMemo, or None if memo_size is 0
+    """
+    global worker_merge_memo
+    if memo_size <= 0:
+        return None
+    memo = worker_merge_memo
+    if (memo is None or
+            memo.max_size != memo_size or
+            memo.quality_bins != quality_bins):
+        memo = worker_merge_memo = MergeMemo(memo_size, quality_bins)
+    return memo
+
+
+def parse_sam_chunk(pairs, memo_size=MERGE_MEMO_SIZE, quality_bins=None):
+    """ Call parse_sam() on read pairs in a worker process.
+
+    @return: (reads, hit_count, miss_count) the parse_sam() results, and the
+        worker's MergeMemo counts for this chunk
+    """
+    memo = get_worker_memo(memo_size, quality_bins)
+    if memo is None:
+        return [parse_sam(rows) for rows in pairs], 0, 0
+    old_hit_count = memo.hit_count
+    old_miss_count = memo.miss_count
+    reads = [parse_sam(rows, merge_memo=memo) for rows in pairs]
+    return (reads,
+            memo.hit_count - old_hit_count,
+            memo.miss_count - old_miss_count)
+
+
+class MergedCounts(object):
+    def __init__(self):
+        """ Count merged reads from part of a remap file, ready to combine.
+
+        Row numbers record where each result would come out of parse_sam()
+        in a single process, so combined results keep that order.
+        """
+        self.counts = {}  # {rname: {qcut: Counter({mseq: count})}}
+        self.first_rows = {}  # {rname: row_number}
+        self.events = []  # [(row_number, insert_list, failed_list)]
+
+    def add(self, row_number, parsed):
+        """ Add a parse_sam() result. """
+        rname, mseqs, insert_list, failed_list = parsed
+        self.set_first_row(rname, row_number)
+        region = self.counts.setdefault(rname, {})
+        for qcut, mseq in mseqs.items():
+            mseq_counter = region.get(qcut)
+            if mseq_counter is None:
+                mseq_counter = region[qcut] = collections.Counter()
+            mseq_counter[mseq] += 1
+        if insert_list or failed_list:
+            self.events.append((row_number, insert_list, failed_list))
+
+    def set_first_row(self, rname, row_number):
+        first_row = self.first_rows.get(rname)
+        if first_row is None or row_number < first_row:
+            self.first_rows[rname] = row_number
+
+    def extend(self, other, row_offset=0):
+        """ Add the counts from a later part of the remap file. """
+        for rname, row_number in other.first_rows.items():
+            self.set_first_row(rname, row_number + row_offset)
+        for rname, other_region in other.counts.items():
+            region = self.counts.setdefault(rname, {})
+            for qcut, other_counter in other_region.items():
+                mseq_counter = region.get(qcut)
+                if mseq_counter is None:
+                    region[qcut] = other_counter
+                else:
+                    mseq_counter.update(other_counter)
+        self.events.extend((row_number + row_offset, insert_list, failed_list)
+                           for row_number, insert_list, failed_list
+                           in other.events)
+
+    def merge_into(self, aligned):
+        """ Add the counts to an AlignedCounts, in order of appearance. """
+        for rname in sorted(self.first_rows, key=self.first_rows.get):
+            aligned.add_region(rname)
+            for qcut, mseq_counter in self.counts.get(rname, {}).items():
+                aligned.update(rname, qcut, mseq_counter)
+
+    def iter_events(self):
+        """ Yield (insert_list, failed_list) in order of appearance. """
+        self.events.sort(key=itemgetter(0))
+        for _row_number, insert_list, failed_list in self.events:
+            yield insert_list, failed_list
+
+
+class AlignedCounts(object):
+    def __init__(self, max_seqs=MAX_COUNTED_SEQS, work_path=None):
+        """ Count identical merged sequences for each region and cutoff.
+
+        If there are too many distinct sequences to hold in memory, the
+        counts are spilled to disk. See SpillingCounter.
+        @param max_seqs: the most distinct sequences to hold in memory
+        @param work_path: the folder to create spill files in, or None for
+            the system's temporary folder
+        """
+        self.regions = collections.OrderedDict()  # {rname: {qcut: group}}
+        self.region_numbers = {}  # {rname: number in order of appearance}
+        self.counter = SpillingCounter(max_seqs, work_path)
+
+    def add_region(self, rname):
+        """ Add a region, so regions are written in order of appearance. """
+        region = self.regions.get(rname)
+        if region is None:
+            region = self.regions[rname] = collections.OrderedDict()
+            self.region_numbers[rname] = len(self.region_numbers)
+        return region
+
+    def get_group(self, rname, qcut):
+        """ Find the counter group that sorts in order of appearance. """
+        region = self.add_region(rname)
+        group = region.get(qcut)
+        if group is None:
+            group = region[qcut] = (self.region_numbers[rname], len(region))
+        return group
+
+    def add(self, rname, qcut, mseq, count=1):
+        self.counter.add(self.get_group(rname, qcut), mseq, count)
+
+    def update(self, rname, qcut, mseq_counts):
+        self.counter.update(self.get_group(rname, qcut), mseq_counts)
+
+    def close(self):
+        self.counter.close()
+
+    def iter_ranked(self):
+        """ Rank the sequences for each region and cutoff.
+
+        @return: yields (rname, qcut, ranked_seqs) in order of appearance,
+            where ranked_seqs yields (count, offset, seq) from most common to
+            least, with ties broken by the offset and then the sequence
+        """
+        group_names = {group: (rname, qcut)
+                       for rname, region in self.regions.items()
+                       for qcut, group in region.items()}
+        for group, ranked_items in self.counter.iter_groups(rank_merged_seq):
+            rname, qcut = group_names[group]
+            ranked_seqs = ((count, len_gap_prefix(mseq), mseq)
+                           for mseq, count in ranked_items)
+            yield rname, qcut, ranked_seqs
+
+
+def rank_merged_seq(mseq, count):
+    return count, len_gap_prefix(mseq), mseq
+
+
+def find_pair_ranges(remap_path, range_count, min_range_size=MIN_RANGE_SIZE):
+    """ Split a remap CSV file into byte ranges without splitting up mates.
+
+    Each range ends between two lines with different query names, so mates
+    that are next to each other stay in the same range.
+    @param remap_path: the path to a remap CSV file
+    @param range_count: the number of ranges to aim for
+    @param min_range_size: the smallest range, in bytes
+    @return: (fieldnames, [(start, end)]) the CSV header, and the byte range
+        of each chunk of rows
+    """
+    with open(remap_path, 'rb') as f:
+        header = f.readline()
+        fieldnames = next(csv.reader([header.decode('utf8')]))
+        data_start = f.tell()
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        range_size = max(min_range_size,
+                         (file_size - data_start) // range_count + 1)
+        boundaries = [data_start]
+        while boundaries[-1] + range_size < file_size:
+            f.seek(boundaries[-1] + range_size)
+            f.readline()  # skip to the start of a line
+            boundary = find_qname_change(f)
+            if boundary >= file_size:
+                break
+            boundaries.append(boundary)
+    boundaries.append(file_size)
+    return fieldnames, list(zip(boundaries, boundaries[1:]))
+
+
+def find_qname_change(f):
+    """ Find the next line that has a different query name than the one before.
+
+    @param f: a remap CSV file open in binary mode, positioned at the start
+        of a line
+    @return: the position of the line, or the end of the file
+    """
+    previous_qname = None
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            return position
+        qname = next(csv.reader([line.decode('utf8')]))[0]
+        if previous_qname is not None and qname != previous_qname:
+            return position
+        previous_qname = qname
+
+
+def read_range_rows(byte_range, remap_path, fieldnames):
+    """ Read the rows in part of a remap file.
+
+    @param byte_range: (start, end) from find_pair_ranges(), or
+        (offset, record_count) from find_chunk_ranges() for a BAM file
+    @param remap_path: the path to the remap CSV or BAM file
+    @param fieldnames: the remap CSV header, or None for a BAM file
+    @return: a list of row dictionaries
+    """
+    if fieldnames is None:
+        offset, record_count = byte_range
+        with open(remap_path, 'rb') as f:
+            return list(BamReader(f).iter_chunk_rows(offset, record_count))
+    start, end = byte_range
+    with open(remap_path, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf8')
+    return list(DictReader(StringIO(text), fieldnames))
+
+
+def parse_sam_range(byte_range,
+                    remap_path,
+                    fieldnames,
+                    memo_size=MERGE_MEMO_SIZE,
+                    quality_bins=None):
+    """ Merge and count the read pairs in part of a remap file.
+
+    Runs in a worker process, so only the counts go back to the parent.
+    See read_range_rows() for the first three parameters.
+    @return: (pair_counts, single_counts, orphans, row_count, single_count,
+        hit_count, miss_count) where pair_counts and single_counts are
+        MergedCounts with row numbers counted from the start of the range.
+        Singles are reads that weren't sequenced in pairs, and orphans are
+        [(row_number, row)] for reads whose mate is outside the range.
+    """
+    rows = read_range_rows(byte_range, remap_path, fieldnames)
+    memo = get_worker_memo(memo_size, quality_bins)
+    if memo is not None:
+        old_hit_count = memo.hit_count
+        old_miss_count = memo.miss_count
+    pair_counts = MergedCounts()
+    single_counts = MergedCounts()
+    orphans = []
+    cached_rows = {}  # {qname: (row_number, row)}
+    row_count = single_count = 0
+    for row_number, row in enumerate(rows):
+        row_count += 1
+        old_row = cached_rows.pop(row['qname'], None)
+        if old_row is None:
+            cached_rows[row['qname']] = (row_number, row)
+        else:
+            pair_counts.add(row_number,
+                            parse_sam((old_row[1], row), merge_memo=memo))
+    for row_number, row in cached_rows.values():
+        if int(row['flag']) & 1:
+            orphans.append((row_number, row))
+        else:
+            single_count += 1
+            single_counts.add(row_number,
+                              parse_sam((row, None), merge_memo=memo))
+    if memo is None:
+        hit_count = miss_count = 0
+    else:
+        hit_count = memo.hit_count - old_hit_count
+        miss_count = memo.miss_count - old_miss_count
+    return (pair_counts,
+            single_counts,
+            orphans,
+            row_count,
+            single_count,
+            hit_count,
+            miss_count)
+
+
+def merge_ranges(remap_path,
+                 aligned,
+                 nthreads,
+                 memo_size=MERGE_MEMO_SIZE,
+                 quality_bins=None,
+                 merge_stats=None,
+                 worker_pool=None,
+                 min_range_size=MIN_RANGE_SIZE,
+                 min_range_records=MIN_RANGE_RECORDS):
+    """ Merge and count read pairs in parallel ranges of a remap file.
+
+    Workers count the merged reads in each range with parse_sam_range(),
+    and this process adds up the counts, and pairs up any mates that were
+    in different ranges. Results come out in the same order as a single
+    process would produce them, unless the single process would have
+    spilled mates to disk.
+    @param remap_path: the path to the remap CSV file, or to a BAM file
+        with an index next to it
+    @param aligned: sam2aln()'s AlignedCounts to add the counts to
+    @param min_range_size: the smallest range of a CSV file, in bytes
+    @param min_range_records: the fewest records in a range of a BAM file
+    @return: yields (insert_list, failed_list) for each read pair that had
+        insertions or failed. See sam2aln() for the other parameters.
+    """
+    range_count = nthreads * RANGES_PER_THREAD
+    with open(remap_path, 'rb') as f:
+        index = load_index(remap_path) if is_bam(f) else None
+    if index is None:
+        fieldnames, byte_ranges = find_pair_ranges(remap_path,
+                                                   range_count,
+                                                   min_range_size)
+    else:
+        # The index counts the records in each chunk, so the running total
+        # gives each range's row offset, just like the CSV ranges.
+        fieldnames = None
+        byte_ranges = find_chunk_ranges(index, range_count, min_range_records)
+    merge_memo = MergeMemo(memo_size, quality_bins) if memo_size > 0 else None
+    is_pool_owned = worker_pool is None
+    pool = Pool(processes=nthreads) if is_pool_owned else worker_pool
+    try:
+        parse_range = partial(parse_sam_range,
+                              remap_path=remap_path,
+                              fieldnames=fieldnames,
+                              memo_size=memo_size,
+                              quality_bins=quality_bins)
+        all_singles = MergedCounts()
+        orphan_rows = {}  # {qname: (row_number, row)} from earlier ranges
+        row_offset = 0
+        for range_counts in pool.imap(parse_range, byte_ranges):
+            (pair_counts,
+             single_counts,
+             orphans,
+             row_count,
+             single_count,
+             hit_count,
+             miss_count) = range_counts
+            if merge_stats is not None:
+                merge_stats['hit_count'] += hit_count
+                merge_stats['miss_count'] += miss_count
+                merge_stats['orphan_count'] += single_count
+            for row_number, row in orphans:
+                old_row = orphan_rows.pop(row['qname'], None)
+                if old_row is None:
+                    orphan_rows[row['qname']] = (row_number + row_offset, row)
+                else:
+                    pair_counts.add(row_number,
+                                    parse_sam((old_row[1], row),
+                                              merge_memo=merge_memo))
+            pair_counts.merge_into(aligned)
+            for event in pair_counts.iter_events():
+                yield event
+            all_singles.extend(single_counts, row_offset)
+            row_offset += row_count
+    finally:
+        if is_pool_owned:
+            pool.close()
+            pool.join()
+
+    # mates that never showed up
+    if merge_stats is not None:
+        merge_stats['orphan_count'] += len(orphan_rows)
+    for row_number, row in orphan_rows.values():
+        all_singles.add(row_number, parse_sam((row, None), merge_memo=merge_memo))
+    all_singles.merge_into(aligned)
+    for event in all_singles.iter_events():
+        yield event
+    if merge_memo is not None and merge_stats is not None:
+        merge_stats['hit_count'] += merge_memo.hit_count
+        merge_stats['miss_count'] += merge_memo.miss_count
+
+
+def count_merged_reads(parsed_reads, aligned):
+    """ Count identical merged sequences from parse_sam().
+
+    @param parsed_reads: a sequence of parse_sam() results
+    @param aligned: an AlignedCounts to add the counts to
+    @return: yields (insert_list, failed_list) for each read pair
+    """
+    for rname, mseqs, insert_list, failed_list in parsed_reads:
+        aligned.add_region(rname)
+
+        for qcut, mseq in mseqs.items():
+            # collect identical merged sequences
+            aligned.add(rname, qcut, mseq)
+        yield insert_list, failed_list
+
+
+def get_range_path(remap_csv):
+    """ Find the path of a remap file that can be split into ranges.
+
+    @return: the path, or None if remap_csv isn't a CSV file on disk, or a
+        BAM file with an index next to it
+    """
+    remap_path = getattr(remap_csv, 'name', None)
+    if not isinstance(remap_path, str) or not os.path.isfile(remap_path):
+        return None
+    if is_binary(remap_csv):
+        if not is_bam(remap_csv) or load_index(remap_path) is None:
+            return None
+    return remap_path
+
+
+def sam2aln(remap_csv, aligned_csv, insert_csv=None, failed_csv=None, nthreads=None,
+            memo_size=MERGE_MEMO_SIZE, quality_bins=None, merge_stats=None,
+            worker_pool=None, max_counted_seqs=MAX_COUNTED_SEQS,
+            delta_encoded=False):
+    """ Merge read pairs, and count identical merged sequences.
+
+    @param nthreads: the number of processes to merge reads in, or None to
+        merge them in this process. If remap_csv is a CSV file on disk, or a
+        BAM file with its index, each process reads its own ranges of the
+        file. See merge_ranges(). Otherwise, BAM blocks are decompressed in
+        this many threads.
+    @param memo_size: the number of read pairs to remember merges for, so
+        identical read pairs are only merged once. 0 to merge every pair.
+    @param quality_bins: the lowest Phred score in each quality bin, like
+        QUALITY_BIN_EDGES, or None to leave quality scores alone. See
+        MergeMemo.
+    @param merge_stats: a dictionary that gets 'hit_count' and 'miss_count'
+        set to the number of read pairs that reused a merge, or were merged,
+        'orphan_count' set to the number of reads whose mate never showed
+        up, and 'spilled_count' set to the number of reads that were spilled
+        to disk while looking for their mates. See MatePairer.
+    @param worker_pool: a multiprocessing pool to use when nthreads is set,
+        or None to start one
+    @param max_counted_seqs: the most distinct merged sequences to count in
+        memory, before spilling the counts to disk. See AlignedCounts.
+    @param delta_encoded: True if aligned_csv should hold each merged
+        sequence as its differences from a reference that the earlier rows
+        for its region and cutoff extend. See micall.utils.aligned_deltas.
+    """
     # prepare outputs
     if insert_csv:
         insert_fields = ['qname', 'fwd_rev', 'refname', 'pos', 'insert', 'qual']
@@ -436,46 +1313,70 @@ def sam2aln(remap_csv, aligned_csv, insert_csv=None, failed_csv=None, nthreads=N
         failed_writer = DictWriter(failed_csv, failed_fields, lineterminator=os.linesep)
         failed_writer.writeheader()
 
-    empty_region = collections.defaultdict(collections.Counter)
-    aligned = collections.defaultdict(empty_region.copy)
-    if nthreads:
-        iter = parse_sam_in_threads(remap_csv, nthreads)
+    aligned = AlignedCounts(max_counted_seqs)
+    if merge_stats is None:
+        merge_stats = {}
+    merge_stats.update(hit_count=0, miss_count=0, orphan_count=0,
+                       spilled_count=0)
+    mate_pairer = None
+    merge_memo = None
+    remap_path = get_range_path(remap_csv) if nthreads else None
+    if remap_path is not None:
+        # workers count the merged reads, and only send back the counts
+        events = merge_ranges(remap_path,
+                              aligned,
+                              nthreads,
+                              memo_size,
+                              quality_bins,
+                              merge_stats,
+                              worker_pool)
     else:
-        iter = map(parse_sam, matchmaker(remap_csv))
+        if nthreads:
+            iter = parse_sam_in_threads(remap_csv,
+                                        nthreads,
+                                        memo_size,
+                                        quality_bins,
+                                        merge_stats,
+                                        worker_pool)
+        else:
+            if memo_size > 0:
+                merge_memo = MergeMemo(memo_size, quality_bins)
+            mate_pairer = MatePairer(get_qname=itemgetter('qname'))
+            iter = map(partial(parse_sam, merge_memo=merge_memo),
+                       matchmaker(remap_csv, mate_pairer))
+        events = count_merged_reads(iter, aligned)
 
-    for rname, mseqs, insert_list, failed_list in iter:
-        region = aligned[rname]
+    try:
+        for insert_list, failed_list in events:
+            # write out inserts to CSV
+            if insert_csv: insert_writer.writerows(insert_list)
 
-        for qcut, mseq in mseqs.items():
-            # collect identical merged sequences
-            mseq_counter = region[qcut]
-            mseq_counter[mseq] += 1
+            # write out failed read mergers to CSV
+            if failed_csv: failed_writer.writerows(failed_list)
 
-        # write out inserts to CSV
-        if insert_csv: insert_writer.writerows(insert_list)
-
-        # write out failed read mergers to CSV
-        if failed_csv: failed_writer.writerows(failed_list)
-
-    # write out merged sequences to file
-    aligned_fields = ['refname', 'qcut', 'rank', 'count', 'offset', 'seq']
-    aligned_writer = DictWriter(aligned_csv, aligned_fields,
-                                lineterminator=os.linesep)
-    aligned_writer.writeheader()
-
-    for rname, data in aligned.items():
-        for qcut, data2 in data.items():
-            # sort variants by count
-            intermed = [
-                (count, len_gap_prefix(s), s)
-                for s, count in data2.items()
-            ]
-            intermed.sort(reverse=True)
-            for rank, (count, offset, seq) in enumerate(intermed):
+        # write out merged sequences to file
+        if delta_encoded:
+            aligned_writer = DeltaWriter(aligned_csv, lineterminator=os.linesep)
+        else:
+            aligned_fields = ['refname', 'qcut', 'rank', 'count', 'offset', 'seq']
+            aligned_writer = DictWriter(aligned_csv, aligned_fields,
+                                        lineterminator=os.linesep)
+        aligned_writer.writeheader()
+
+        for rname, qcut, ranked_seqs in aligned.iter_ranked():
+            # variants are sorted by count
+            for rank, (count, offset, seq) in enumerate(ranked_seqs):
                 aligned_writer.writerow(
                     dict(refname=rname, qcut=qcut, rank=rank, count=count,
                          offset=offset, seq=seq.strip('-'))
                 )
+    finally:
+        aligned.close()  # remove any spill files
+    if merge_memo is not None:
+        merge_stats.update(hit_count=merge_memo.hit_count,
+                           miss_count=merge_memo.miss_count)
+    if mate_pairer is not None:
+        add_pairing_stats(merge_stats, mate_pairer)
 
 
 def main():
@@ -484,7 +1385,10 @@ def main():
             aligned_csv=args.aligned_csv,
             insert_csv=args.insert_csv,
             failed_csv=args.failed_csv,
-            nthreads=args.p)
+            nthreads=args.p,
+            memo_size=args.memo_size,
+            quality_bins=QUALITY_BIN_EDGES if args.bin_qualities else None,
+            delta_encoded=args.delta)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,106 @@
+from csv import DictReader
+from io import StringIO
+import random
+import unittest
+
+from micall.utils.aligned_deltas import encode_delta, decode_delta, \
+    DeltaReference, DeltaWriter, read_aligned_rows
+
+
+class DeltaTest(unittest.TestCase):
+    def testSubstitutions(self):
+        delta = encode_delta('CTATT', 2, 'ACGTACGT', 0)
+        seq = decode_delta(delta, 2, 5, 'ACGTACGT', 0)
+
+        self.assertEqual('0C2TT', delta)
+        self.assertEqual('CTATT', seq)
+
+    def testSameAsReference(self):
+        self.assertEqual('', encode_delta('GTAC', 2, 'ACGTACGT', 0))
+        self.assertEqual('GTAC', decode_delta('', 2, 4, 'ACGTACGT', 0))
+
+    def testOutsideReference(self):
+        """ Positions outside the reference are gaps. """
+        delta = encode_delta('TTAC-GTAA', 2, 'ACGT', 4)
+
+        self.assertEqual('0TT2-GTAA', delta)
+        self.assertEqual('TTAC-GTAA', decode_delta(delta, 2, 9, 'ACGT', 4))
+
+    def testEmptyReference(self):
+        delta = encode_delta('AC--GT', 10, '', 0)
+
+        self.assertEqual('0AC2GT', delta)
+        self.assertEqual('AC--GT', decode_delta(delta, 10, 6, '', 0))
+
+    def testRandomSequences(self):
+        rand = random.Random(47)
+        for _ in range(1000):
+            reference = ''.join(rand.choice('ACN-')
+                                for _ in range(rand.randint(0, 80)))
+            reference_offset = rand.randint(0, 50)
+            seq = ''.join(rand.choice('ACN-')
+                          for _ in range(rand.randint(0, 80)))
+            offset = rand.randint(0, 50)
+
+            delta = encode_delta(seq, offset, reference, reference_offset)
+            decoded = decode_delta(delta,
+                                   offset,
+                                   len(seq),
+                                   reference,
+                                   reference_offset)
+
+            self.assertEqual(seq, decoded)
+
+    def testReferenceGrows(self):
+        reference = DeltaReference()
+
+        reference.add('ACGT', 4)
+        reference.add('TT', 0)
+        reference.add('GTCCA', 6)
+
+        self.assertEqual(0, reference.offset)
+        self.assertEqual('TT--ACGTCCA', reference.seq)
+
+
+class DeltaFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.aligned_text = """\
+refname,qcut,rank,count,offset,seq
+R1,15,0,9,0,AAATTTCCC
+R1,15,1,5,3,TTTCCCGGG
+R1,15,2,1,0,AAANTTCCCGGA
+R1,30,0,4,0,AAATTTCCC
+R2,15,0,3,2,GG
+"""
+        self.delta_text = """\
+refname,qcut,rank,count,offset,length,delta
+R1,15,0,9,0,9,0AAATTTCCC
+R1,15,1,5,3,9,6GGG
+R1,15,2,1,0,12,3N7A
+R1,30,0,4,0,9,0AAATTTCCC
+R2,15,0,3,2,2,0GG
+"""
+
+    def testWrite(self):
+        delta_csv = StringIO()
+        writer = DeltaWriter(delta_csv, lineterminator='\n')
+
+        writer.writeheader()
+        for row in DictReader(StringIO(self.aligned_text)):
+            writer.writerow(row)
+
+        self.assertMultiLineEqual(self.delta_text, delta_csv.getvalue())
+
+    def testRead(self):
+        expected_rows = list(DictReader(StringIO(self.aligned_text)))
+
+        rows = list(read_aligned_rows(StringIO(self.delta_text)))
+
+        self.assertEqual(expected_rows, rows)
+
+    def testReadPlain(self):
+        expected_rows = list(DictReader(StringIO(self.aligned_text)))
+
+        rows = list(read_aligned_rows(StringIO(self.aligned_text)))
+
+        self.assertEqual(expected_rows, rows)
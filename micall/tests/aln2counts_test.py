@@ -1315,6 +1315,80 @@ R1-seed,15,R1b,0,9,AAATTT
         self.assertMultiLineEqual(expected_text, self.report_file.getvalue())
 
 
+class CountReadsTest(unittest.TestCase):
+    def setUp(self):
+        self.report = SequenceReport(InsertionWriter(insert_file=StringIO()),
+                                     project_config.ProjectConfig(),
+                                     conseq_mixture_cutoffs=[0.1])
+        self.report.seed_aminos = {}
+
+    def prepareReads(self, aligned_reads_text):
+        full_text = "refname,qcut,rank,count,offset,seq\n" + aligned_reads_text
+        return csv.DictReader(StringIO(full_text))
+
+    def describe_codons(self):
+        """ List the nucleotides counted in each codon of each frame. """
+        return [[''.join(''.join(nuc.counts) for nuc in seed_amino.nucleotides)
+                 for seed_amino in self.report.seed_aminos[reading_frame]]
+                for reading_frame in range(3)]
+
+    def testCountReadsWithOffset(self):
+        # refname,qcut,rank,count,offset,seq
+        aligned_reads = """\
+R1-seed,15,0,9,4,AAATTT
+"""
+        expected_codons = [['', '-AA', 'ATT', 'T--'],
+                           ['', '--A', 'AAT', 'TT-'],
+                           ['', '---', 'AAA', 'TTT']]
+
+        self.report._count_reads(list(self.prepareReads(aligned_reads)))
+
+        self.assertEqual(expected_codons, self.describe_codons())
+
+    def testCountReadsEndingMidCodon(self):
+        # refname,qcut,rank,count,offset,seq
+        aligned_reads = """\
+R1-seed,15,0,9,0,AAAT
+"""
+        expected_codons = [['AAA', 'T--'],
+                           ['-AA', 'AT-'],
+                           ['--A', 'AAT']]
+
+        self.report._count_reads(list(self.prepareReads(aligned_reads)))
+
+        self.assertEqual(expected_codons, self.describe_codons())
+
+    def testCountEmptyRead(self):
+        """ A read with no bases still counts gaps in frames 1 and 2. """
+        # refname,qcut,rank,count,offset,seq
+        aligned_reads = """\
+R1-seed,15,0,9,0,AAA
+R1-seed,15,1,1,12,
+"""
+        expected_codons = [['AAA'],
+                           ['-AA', 'A--', '', '', '---'],
+                           ['--A', 'AA-', '', '', '---']]
+
+        self.report._count_reads(list(self.prepareReads(aligned_reads)))
+
+        self.assertEqual(expected_codons, self.describe_codons())
+
+    def testCountReadsTieOrder(self):
+        """ Tied amino acids are chosen in the order they were read. """
+        # refname,qcut,rank,count,offset,seq
+        aligned_reads = """\
+R1-seed,15,0,1,0,AAACCC
+R1-seed,15,1,1,0,CCCAAA
+"""
+
+        self.report._count_reads(list(self.prepareReads(aligned_reads)))
+        frame_aminos = self.report.seed_aminos[0]
+
+        self.assertEqual(['K', 'P'],
+                         [seed_amino.get_consensus()
+                          for seed_amino in frame_aminos])
+
+
 class InsertionWriterTest(unittest.TestCase):
     def setUp(self):
         self.insert_file = StringIO.StringIO()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from micall.utils.amplicon_mapper import AmpliconMapper, MapperSettings, \
+    ReferenceIndex
+from micall.utils.translation import reverse_and_complement
+from micall.alignment.gotoh2 import Aligner
+
+REFERENCE = ('ACCTGAGGATCCAGTTAAGCTTGCATGCCTGCAGGTCGACTCTAGAGGATCCCCGGGTACCGAGCT'
+             'CGAATTCACTGGCCGTCGTTTTACAACGTCGTGACTGGGAAAACCC')
+
+
+class ReferenceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ReferenceIndex({'R1': REFERENCE})
+        self.settings = MapperSettings(['-x', 'ref',
+                                        '--local',
+                                        '--rdg', '10,3',
+                                        '--rfg', '10,3'])
+        self.aligner = Aligner(gop=10, gep=3, is_global=False)
+
+    def assertMapping(self, seq, expected_pos, expected_cigar):
+        for is_reversed, read in ((False, seq),
+                                  (True, reverse_and_complement(seq))):
+            alignment = self.index.map_read(read, self.settings, self.aligner)
+
+            self.assertEqual(
+                ('R1', expected_pos, expected_cigar, is_reversed),
+                (alignment.rname,
+                 alignment.pos,
+                 alignment.cigar,
+                 alignment.is_reversed))
+
+    def testExactMatch(self):
+        self.assertMapping(REFERENCE[10:60], 11, '50M')
+
+    def testInsertion(self):
+        self.assertMapping(REFERENCE[10:40] + 'TTT' + REFERENCE[40:70],
+                           11,
+                           '33M3I27M')
+
+    def testDeletion(self):
+        self.assertMapping(REFERENCE[10:40] + REFERENCE[45:80],
+                           11,
+                           '30M5D35M')
+
+    def testSoftClipAtStart(self):
+        self.assertMapping('GGGGG' + REFERENCE[:40], 1, '5S40M')
+
+    def testSoftClipAtEnd(self):
+        self.assertMapping(REFERENCE[70:] + 'AAAAAAAA', 71, '42M8S')
+
+    def testScore(self):
+        alignment = self.index.map_read(REFERENCE[10:60],
+                                        self.settings,
+                                        self.aligner)
+
+        self.assertEqual(100, alignment.score)  # 2 for each match
+
+    def testUnmapped(self):
+        alignment = self.index.map_read('T' * 50, self.settings, self.aligner)
+
+        self.assertIsNone(alignment)
+
+
+class AmpliconMapperTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.ref_path = os.path.join(self.work_path, 'ref.fasta')
+        with open(self.ref_path, 'w') as ref_file:
+            ref_file.write('>R1 description\n{}\n{}\n'.format(REFERENCE[:60],
+                                                              REFERENCE[60:]))
+        self.mapper = AmpliconMapper()
+        self.mapper.build(self.ref_path, self.ref_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def write_fastq(self, name, reads):
+        path = os.path.join(self.work_path, name)
+        with open(path, 'w') as fastq:
+            for qname, seq in reads:
+                fastq.write('@{}\n{}\n+\n{}\n'.format(qname, seq, 'J'*len(seq)))
+        return path
+
+    def testPairedReads(self):
+        fastq1 = self.write_fastq('r1.fastq',
+                                  [('pair1/1', REFERENCE[0:50]),
+                                   ('pair2 x', 'T' * 50)])
+        fastq2 = self.write_fastq('r2.fastq',
+                                  [('pair1/2',
+                                    reverse_and_complement(REFERENCE[40:90])),
+                                   ('pair2 y', 'T' * 50)])
+        expected_fields = [
+            ['pair1', '99', 'R1', '1', '42', '50M', '=', '41', '90'],
+            ['pair1', '147', 'R1', '41', '42', '50M', '=', '1', '-90'],
+            ['pair2', '77', '*', '0', '0', '*', '*', '0', '0'],
+            ['pair2', '141', '*', '0', '0', '*', '*', '0', '0']]
+
+        lines = list(self.mapper.yield_mapping(
+            ['-x', self.ref_path, '--local', '--no-hd'],
+            fastq1,
+            fastq2))
+
+        fields = [line.split('\t') for line in lines]
+        self.assertEqual(expected_fields, [row[:9] for row in fields])
+        self.assertEqual(REFERENCE[40:90], fields[1][9])
+        self.assertEqual(['AS:i:100', 'YT:Z:CP\n'], fields[0][11:])
+        self.assertEqual(['YT:Z:UP\n'], fields[2][11:])
+
+    def testHeader(self):
+        fastq1 = self.write_fastq('r1.fastq', [('read1', REFERENCE[0:50])])
+
+        lines = list(self.mapper.yield_mapping(['-x', self.ref_path],
+                                               fastq1))
+
+        self.assertEqual(['@HD\tVN:1.0\tSO:unsorted\n',
+                          '@SQ\tSN:R1\tLN:112\n'],
+                         lines[:2])
+        self.assertEqual(['read1', '0', 'R1', '1', '42', '50M'],
+                         lines[2].split('\t')[:6])
+
+    def testMissingIndex(self):
+        fastq1 = self.write_fastq('r1.fastq', [('read1', REFERENCE[0:50])])
+
+        with self.assertRaisesRegex(ValueError, 'No index was built'):
+            list(self.mapper.yield_mapping(['-x', 'other'], fastq1))
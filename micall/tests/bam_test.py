@@ -0,0 +1,237 @@
+from io import BytesIO
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from micall.utils.bam import BamReader, BamWriter, BgzfReader, BgzfWriter, \
+    EOF_BLOCK, decode_seq, encode_seq, find_chunk_ranges, is_bam, reg2bin
+from micall.utils.packed_sam import create_sam_writer, read_sam_rows
+
+
+class BgzfTest(unittest.TestCase):
+    def write(self, chunks, threads=1):
+        handle = BytesIO()
+        writer = BgzfWriter(handle, threads)
+        for i, chunk in enumerate(chunks):
+            writer.write_chunk(chunk, label=i)
+        writer.close()
+        return handle, writer
+
+    def testGzipCompatible(self):
+        handle, _writer = self.write([b'Hello, ', b'World!'])
+
+        self.assertEqual(b'Hello, World!', gzip.decompress(handle.getvalue()))
+        self.assertTrue(handle.getvalue().endswith(EOF_BLOCK))
+
+    def testLargeChunkSplitsIntoBlocks(self):
+        data = bytes(range(256)) * 1000
+        handle, writer = self.write([data, b'tail'])
+        handle.seek(0)
+
+        blocks = list(BgzfReader(handle).iter_blocks())
+
+        self.assertEqual(data + b'tail', b''.join(blocks))
+        # four for data, one for the tail, and the empty end marker
+        self.assertEqual(6, len(blocks))
+        self.assertEqual(0, writer.chunk_offsets[0][0])
+        self.assertEqual(1, writer.chunk_offsets[1][1])
+
+    def testThreads(self):
+        chunks = [str(i).encode() * 50000 for i in range(10)]
+        serial_handle, _writer = self.write(chunks)
+        parallel_handle, _writer = self.write(chunks, threads=3)
+        parallel_handle.seek(0)
+
+        blocks = list(BgzfReader(parallel_handle, threads=3).iter_blocks())
+
+        self.assertEqual(serial_handle.getvalue(), parallel_handle.getvalue())
+        self.assertEqual(b''.join(chunks), b''.join(blocks))
+
+    def testCorruptBlock(self):
+        handle, _writer = self.write([b'Hello, World!'])
+        data = bytearray(handle.getvalue())
+        data[-len(EOF_BLOCK) - 8] ^= 0xff  # break the CRC
+
+        with self.assertRaisesRegex(ValueError, 'Corrupt BGZF block'):
+            list(BgzfReader(BytesIO(bytes(data))).iter_blocks())
+
+
+class SeqTest(unittest.TestCase):
+    def testRoundTrip(self):
+        packed = encode_seq('ACGTN')
+
+        self.assertEqual(b'\x12\x48\xf0', packed)
+        self.assertEqual('ACGTN', decode_seq(packed, 5))
+
+    def testAmbiguous(self):
+        self.assertEqual('RYKM', decode_seq(encode_seq('RYKM'), 4))
+
+    def testEmpty(self):
+        self.assertEqual('', decode_seq(encode_seq(''), 0))
+
+
+class Reg2BinTest(unittest.TestCase):
+    def testSmallestBin(self):
+        self.assertEqual(4681, reg2bin(0, 100))
+
+    def testCrossesSmallestBin(self):
+        self.assertEqual(585, reg2bin(16380, 16390))
+
+    def testUnmapped(self):
+        self.assertEqual(4680, reg2bin(-1, 0))
+
+
+class BamTest(unittest.TestCase):
+    def setUp(self):
+        self.references = {'R1': 100, 'R2': 50}
+        self.rows = [
+            ['Example_read_1', '99', 'R1', '1', '44', '5M', '=', '1', '5',
+             'ACGTA', 'AAAAA'],
+            ['Example_read_2', '77', '*', '0', '0', '*', '*', '0', '0',
+             'ACNNT', 'AA#AA'],
+            ['Example_read_1', '147', 'R1', '1', '44', '2M1D3M', '=', '1',
+             '-5', 'ACGTA', 'BBBBB'],
+            ['Example_read_3', '99', 'R2', '10', '44', '2S3M', 'R1', '8', '0',
+             'GGTTT', '*']]
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def write(self, rows=None, threads=1):
+        handle = BytesIO()
+        writer = BamWriter(handle, self.references, threads)
+        writer.writeheader()
+        for fields in (self.rows if rows is None else rows):
+            writer.write_fields(fields)
+        writer.close()
+        handle.seek(0)
+        return handle, writer
+
+    def testRoundTrip(self):
+        handle, _writer = self.write()
+
+        reader = BamReader(handle)
+
+        self.assertEqual(self.rows, list(reader.iter_fields()))
+        self.assertEqual([('R1', 100), ('R2', 50)], reader.references)
+        self.assertIn('@SQ\tSN:R2\tLN:50\n', reader.header_text)
+
+    def testNoRecords(self):
+        handle, _writer = self.write(rows=[])
+
+        self.assertEqual([], list(BamReader(handle).iter_fields()))
+
+    def testUnknownReference(self):
+        writer = BamWriter(BytesIO(), self.references)
+
+        with self.assertRaisesRegex(ValueError, "'R3' is not in the BAM"):
+            writer.write_fields(['read', '0', 'R3', '1', '44', '1M', '*',
+                                 '0', '0', 'A', 'A'])
+
+    def testRows(self):
+        handle, _writer = self.write()
+
+        rows = list(BamReader(handle).iter_rows())
+
+        self.assertEqual('Example_read_3', rows[3]['qname'])
+        self.assertEqual('2S3M', rows[3]['cigar'])
+
+    def testManyBlocks(self):
+        rows = [['read{}'.format(i), '0', 'R{}'.format(i % 2 + 1), '1', '44',
+                 '150M', '*', '0', '0', 'ACGT' * 37 + 'AC', 'A' * 150]
+                for i in range(2000)]
+        expected_r2 = [fields for fields in rows if fields[2] == 'R2']
+        handle, writer = self.write(rows, threads=3)
+
+        index = writer.get_index()
+        reader = BamReader(handle, threads=3, index=index)
+
+        self.assertEqual(rows, list(reader.iter_fields()))
+        self.assertGreater(len(index['chunks']), 2)
+        self.assertEqual(2000, sum(count for _, count, _ in index['chunks']))
+        self.assertEqual(expected_r2, list(reader.fetch('R2')))
+
+    def testFetchSkipsChunks(self):
+        rows = [['read_r2', '0', 'R2', '1', '44', '5M', '*', '0', '0',
+                 'ACGTA', 'AAAAA']]
+        rows.extend(['read{}'.format(i), '0', 'R1', '1', '44', '150M', '*',
+                     '0', '0', 'ACGT' * 37 + 'AC', 'A' * 150]
+                    for i in range(1000))
+        handle, writer = self.write(rows)
+        index = writer.get_index()
+        reader = BamReader(handle, index=index)
+
+        fetched = list(reader.fetch('R2'))
+
+        self.assertEqual([rows[0]], fetched)
+        self.assertEqual([0, 1], index['chunks'][0][2])
+        self.assertEqual([0], index['chunks'][1][2])
+        # only read the first chunk
+        self.assertLessEqual(handle.tell(), index['chunks'][1][0])
+
+    def testChunkRanges(self):
+        rows = [['read{}'.format(i), '0', 'R1', '1', '44', '150M', '*', '0',
+                 '0', 'ACGT' * 37 + 'AC', 'A' * 150]
+                for i in range(2000)]
+        handle, writer = self.write(rows)
+        index = writer.get_index()
+        reader = BamReader(handle, index=index)
+
+        ranges = find_chunk_ranges(index, range_count=2)
+        range_rows = [list(reader.iter_chunk_fields(offset, record_count))
+                      for offset, record_count in ranges]
+
+        self.assertEqual(2, len(ranges))
+        self.assertEqual(index['chunks'][0][0], ranges[0][0])
+        self.assertEqual(rows, range_rows[0] + range_rows[1])
+
+    def testChunkRangesMinimumSize(self):
+        index = dict(chunks=[[100, 10, [0]], [200, 10, [0]], [300, 10, [1]]])
+
+        ranges = find_chunk_ranges(index, range_count=3, min_range_size=15)
+
+        self.assertEqual([(100, 20), (300, 10)], ranges)
+
+    def testFetchUnmapped(self):
+        handle, _writer = self.write()
+
+        reader = BamReader(handle, index=None)
+        fetched = list(reader.fetch('*'))
+
+        self.assertEqual([self.rows[1]], fetched)
+
+    def testFetchUnknownReference(self):
+        handle, writer = self.write()
+
+        reader = BamReader(handle, index=writer.get_index())
+
+        self.assertEqual([], list(reader.fetch('R3')))
+
+    def testIsBam(self):
+        handle, _writer = self.write()
+
+        self.assertTrue(is_bam(handle))
+        self.assertEqual(0, handle.tell())
+        self.assertFalse(is_bam(BytesIO(b'MSAM\x01')))
+
+    def testCreateWriterFromPath(self):
+        bam_path = os.path.join(self.work_path, 'remap.bam')
+        with open(bam_path, 'wb') as handle:
+            writer = create_sam_writer(handle, references=self.references)
+            writer.writeheader()
+            for fields in self.rows:
+                writer.write_fields(fields)
+            writer.close()
+
+        with open(bam_path, 'rb') as handle:
+            rows = list(read_sam_rows(handle))
+        with open(bam_path, 'rb') as handle:
+            fetched = list(BamReader(handle).fetch('R1'))
+
+        self.assertIsInstance(writer, BamWriter)
+        self.assertTrue(os.path.exists(bam_path + '.json'))
+        self.assertEqual(self.rows[3][0], rows[3]['qname'])
+        self.assertEqual([self.rows[0], self.rows[2]], fetched)
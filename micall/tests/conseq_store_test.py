@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from micall.utils.conseq_store import ConseqStore
+
+
+class ConseqStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store_path = os.path.join(tempfile.mkdtemp(), 'store')
+        self.store = ConseqStore(self.store_path)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.store_path))
+
+    def testRoundTrip(self):
+        conseqs = {'R1': 'ACGT', 'R2': 'TTGA'}
+
+        self.store.save('patient1', conseqs)
+
+        self.assertEqual(conseqs, self.store.load('patient1'))
+
+    def testMissingKey(self):
+        self.assertEqual({}, self.store.load('patient1'))
+
+    def testReplace(self):
+        self.store.save('patient1', {'R1': 'ACGT', 'R2': 'TTGA'})
+        self.store.save('patient1', {'R1': 'ACCT'})
+
+        self.assertEqual({'R1': 'ACCT'}, self.store.load('patient1'))
+        self.assertEqual(['patient1.csv'], os.listdir(self.store_path))
+
+    def testUnsafeKey(self):
+        self.store.save('../patient/1', {'R1': 'ACGT'})
+
+        self.assertEqual({'R1': 'ACGT'}, self.store.load('../patient/1'))
+        self.assertEqual(['.._patient_1.csv'], os.listdir(self.store_path))
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from micall.utils.cpu_budget import CpuBudget, count_available_cpus, \
+    read_cgroup_quota, read_numa_cpu_sets, parse_cpu_list
+
+
+class CgroupQuotaTest(unittest.TestCase):
+    def setUp(self):
+        self.cgroup_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cgroup_path)
+
+    def write(self, name, text):
+        path = os.path.join(self.cgroup_path, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def testNoCgroup(self):
+        self.assertIsNone(read_cgroup_quota(self.cgroup_path))
+
+    def testVersion2(self):
+        self.write('cpu.max', '250000 100000\n')
+
+        self.assertEqual(3, read_cgroup_quota(self.cgroup_path))
+
+    def testVersion2Unlimited(self):
+        self.write('cpu.max', 'max 100000\n')
+
+        self.assertIsNone(read_cgroup_quota(self.cgroup_path))
+
+    def testVersion1(self):
+        self.write(os.path.join('cpu', 'cpu.cfs_quota_us'), '200000\n')
+        self.write(os.path.join('cpu', 'cpu.cfs_period_us'), '100000\n')
+
+        self.assertEqual(2, read_cgroup_quota(self.cgroup_path))
+
+    def testVersion1Unlimited(self):
+        self.write(os.path.join('cpu', 'cpu.cfs_quota_us'), '-1\n')
+        self.write(os.path.join('cpu', 'cpu.cfs_period_us'), '100000\n')
+
+        self.assertIsNone(read_cgroup_quota(self.cgroup_path))
+
+    def testQuotaLimitsCount(self):
+        self.write('cpu.max', '50000 100000\n')
+
+        self.assertEqual(1, count_available_cpus(self.cgroup_path))
+
+
+class NumaCpuSetsTest(unittest.TestCase):
+    def setUp(self):
+        self.node_path = tempfile.mkdtemp()
+        patcher = patch('os.sched_getaffinity',
+                        return_value=set(range(8)),
+                        create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.node_path)
+
+    def write_node(self, name, cpu_list):
+        os.makedirs(os.path.join(self.node_path, name))
+        with open(os.path.join(self.node_path, name, 'cpulist'), 'w') as f:
+            f.write(cpu_list + '\n')
+
+    def testParseCpuList(self):
+        self.assertEqual({0, 1, 2, 3, 8, 10, 11},
+                         parse_cpu_list('0-3,8,10-11\n'))
+
+    def testTwoNodes(self):
+        self.write_node('node0', '0-3')
+        self.write_node('node1', '4-7')
+
+        self.assertEqual([{0, 1, 2, 3}, {4, 5, 6, 7}],
+                         read_numa_cpu_sets(self.node_path))
+
+    def testNodeOrder(self):
+        self.write_node('node10', '6-7')
+        self.write_node('node2', '0-5')
+
+        self.assertEqual([{0, 1, 2, 3, 4, 5}, {6, 7}],
+                         read_numa_cpu_sets(self.node_path))
+
+    def testSingleNode(self):
+        self.write_node('node0', '0-7')
+
+        self.assertIsNone(read_numa_cpu_sets(self.node_path))
+
+    def testUnavailableNode(self):
+        self.write_node('node0', '0-7')
+        self.write_node('node1', '8-15')
+
+        self.assertIsNone(read_numa_cpu_sets(self.node_path))
+
+    def testNoNodes(self):
+        self.assertIsNone(read_numa_cpu_sets(
+            os.path.join(self.node_path, 'missing')))
+
+
+class CpuBudgetTest(unittest.TestCase):
+    def testReserve(self):
+        budget = CpuBudget(4)
+
+        with budget.reserve(3) as granted:
+            self.assertEqual(3, granted)
+            self.assertEqual(1, budget.available)
+        self.assertEqual(4, budget.available)
+
+    def testReserveMoreThanTotal(self):
+        budget = CpuBudget(4)
+
+        with budget.reserve(10) as granted:
+            self.assertEqual(4, granted)
+
+    def testReservePipeline(self):
+        budget = CpuBudget(5)
+
+        with budget.reserve_pipeline(5) as (producer_count, consumer_count):
+            self.assertEqual((3, 2), (producer_count, consumer_count))
+            self.assertEqual(0, budget.available)
+        self.assertEqual(5, budget.available)
+
+    def testReservePipelineOneCore(self):
+        budget = CpuBudget(4)
+
+        with budget.reserve(3):
+            with budget.reserve_pipeline(4) as counts:
+                self.assertEqual((1, 0), counts)
+
+    def testShareWhatIsLeft(self):
+        budget = CpuBudget(4)
+
+        with budget.reserve(3):
+            with budget.reserve(3) as granted:
+                self.assertEqual(1, granted)
+
+    def testReleaseAfterError(self):
+        budget = CpuBudget(4)
+
+        with self.assertRaises(ZeroDivisionError):
+            with budget.reserve(3):
+                1 / 0
+        self.assertEqual(4, budget.available)
+
+    def testWaitForMinimum(self):
+        budget = CpuBudget(4)
+        granted_counts = []
+
+        def reserve_later():
+            with budget.reserve(4, minimum=2) as granted:
+                granted_counts.append(granted)
+
+        with budget.reserve(3):
+            thread = threading.Thread(target=reserve_later)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual([], granted_counts)
+        thread.join()
+
+        self.assertEqual([4], granted_counts)
+
+    def testDefaultTotal(self):
+        budget = CpuBudget()
+
+        self.assertEqual(count_available_cpus(), budget.total)
@@ -0,0 +1,175 @@
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from micall.utils.externals import Bowtie2, CommandWrapper
+
+# Writes one SAM line for each read, with the mate number in the flag, and
+# marks the lines if --reorder was passed. Takes longer on the first shard,
+# so later shards finish first. Fails on a read named fail.
+STUB_BOWTIE2 = '''\
+#!{python}
+import sys
+import time
+
+args = sys.argv[1:]
+if '--version' in args:
+    print('/stub/bowtie2 version 2.2.8')
+    sys.exit(0)
+if '-U' in args:
+    paths = [args[args.index('-U') + 1]]
+else:
+    paths = [args[args.index('-1') + 1], args[args.index('-2') + 1]]
+tag = '\\tXR:Z:1' if '--reorder' in args else ''
+if 'shard0_' in paths[0]:
+    time.sleep(0.2)
+files = [open(path) for path in paths]
+while True:
+    records = [[f.readline() for _ in range(4)] for f in files]
+    if not records[0][0]:
+        break
+    for mate, record in enumerate(records, 1):
+        name = record[0][1:].split()[0]
+        if name == 'fail':
+            sys.exit(3)
+        print('{{}}\\t{{}}\\t*\\t0\\t0\\t*\\t*\\t0\\t0\\t{{}}\\t{{}}{{}}'.format(
+            name, 64 * mate, record[1].strip(), record[3].strip(), tag))
+'''
+
+
+class ShardedBowtie2Test(unittest.TestCase):
+    def setUp(self):
+        self.stdin_patcher = patch('sys.stdin', open(os.devnull))
+        self.stdin_patcher.start()
+        self.bin_path = tempfile.mkdtemp()
+        self.work_path = tempfile.mkdtemp()
+        self.input_path = tempfile.mkdtemp()
+        stub_path = os.path.join(self.bin_path, 'bowtie2')
+        with open(stub_path, 'w') as f:
+            f.write(STUB_BOWTIE2.format(python=sys.executable))
+        os.chmod(stub_path, os.stat(stub_path).st_mode | stat.S_IEXEC)
+        self.bowtie2 = Bowtie2(execname=stub_path)
+
+    def tearDown(self):
+        sys.stdin.close()
+        self.stdin_patcher.stop()
+        for path in (self.bin_path, self.work_path, self.input_path):
+            shutil.rmtree(path)
+
+    def write_fastqs(self, names):
+        paths = []
+        for direction in (1, 2):
+            path = os.path.join(self.input_path,
+                                'reads_R{}.fastq'.format(direction))
+            with open(path, 'w') as f:
+                for name in names:
+                    f.write('@{} {}:N\nACGT\n+\nAAAA\n'.format(name,
+                                                              direction))
+            paths.append(path)
+        return paths
+
+    def map(self, names, **kwargs):
+        fastq1, fastq2 = self.write_fastqs(names)
+        return self.bowtie2.yield_sharded_output([],
+                                                 fastq1,
+                                                 fastq2,
+                                                 shard_count=3,
+                                                 work_path=self.work_path,
+                                                 shard_size=3,
+                                                 **kwargs)
+
+    def testChunkOrder(self):
+        names = ['read{}'.format(i) for i in range(10)]
+        expected_names = [name for name in names for _ in range(2)]
+
+        lines = list(self.map(names))
+
+        self.assertEqual(expected_names,
+                         [line.split('\t')[0] for line in lines])
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testMatesAdjacent(self):
+        names = ['read{}'.format(i) for i in range(10)]
+
+        lines = list(self.map(names))
+
+        flags = [line.split('\t')[1] for line in lines]
+        self.assertEqual(['64', '128'] * 10, flags)
+
+    def testReorder(self):
+        lines = list(self.map(['read1', 'read2'], reorder=True))
+
+        self.assertTrue(all(line.rstrip('\n').endswith('XR:Z:1')
+                            for line in lines))
+
+    def testNoReorder(self):
+        lines = list(self.map(['read1', 'read2']))
+
+        self.assertFalse(any('XR:Z:1' in line for line in lines))
+
+    def testStopEarly(self):
+        names = ['read{}'.format(i) for i in range(20)]
+        lines = self.map(names)
+
+        self.assertEqual('read0', next(lines).split('\t')[0])
+        lines.close()
+
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testFailedProcess(self):
+        names = ['read{}'.format(i) for i in range(10)]
+        names[4] = 'fail'
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            for _ in self.map(names):
+                pass
+
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testSingleEnded(self):
+        fastq1, _fastq2 = self.write_fastqs(['read1', 'read2'])
+
+        lines = list(self.bowtie2.yield_sharded_output(
+            [],
+            fastq1,
+            shard_count=2,
+            work_path=self.work_path,
+            shard_size=1))
+
+        self.assertEqual(['read1', 'read2'],
+                         [line.split('\t')[0] for line in lines])
+
+
+class CommandWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.stdin_patcher = patch('sys.stdin', open(os.devnull))
+        self.stdin_patcher.start()
+        self.work_path = tempfile.mkdtemp()
+        self.logger = logging.getLogger(__name__)
+
+    def tearDown(self):
+        sys.stdin.close()
+        self.stdin_patcher.stop()
+        shutil.rmtree(self.work_path)
+
+    def testRedirectCall(self):
+        command = CommandWrapper(None, sys.executable, logger=self.logger)
+        outpath = os.path.join(self.work_path, 'out.txt')
+
+        command.redirect_call(['-c', 'print("Hello")'], outpath)
+
+        with open(outpath) as f:
+            self.assertEqual('Hello\n', f.read())
+
+    def testRedirectCallFails(self):
+        command = CommandWrapper(None, 'false', logger=self.logger)
+        outpath = os.path.join(self.work_path, 'out.txt')
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            command.redirect_call([], outpath)
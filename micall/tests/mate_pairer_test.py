@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from micall.utils.mate_pairer import MatePairer
+
+
+class MatePairerTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def testAdjacent(self):
+        rows = [['r1', '99'], ['r1', '147'], ['r2', '99'], ['r2', '147']]
+        pairer = MatePairer()
+
+        pairs = list(pairer.pair(rows))
+
+        self.assertEqual([(rows[0], rows[1]), (rows[2], rows[3])], pairs)
+        self.assertEqual(2, pairer.adjacent_count)
+        self.assertEqual(0, pairer.cached_count)
+        self.assertEqual(0, pairer.max_cached_count)
+
+    def testOutOfOrder(self):
+        rows = [['r1', '99'], ['r2', '99'], ['r3', '99'], ['r2', '147'],
+                ['r1', '147']]
+        pairer = MatePairer()
+
+        pairs = list(pairer.pair(rows))
+
+        self.assertEqual([(rows[1], rows[3]),
+                          (rows[0], rows[4]),
+                          (rows[2], None)],
+                         pairs)
+        self.assertEqual(2, pairer.cached_count)
+        self.assertEqual(1, pairer.orphan_count)
+
+    def testSinglesInOrder(self):
+        rows = [['r3', '99'], ['r1', '99'], ['r2', '99'], ['r2', '147']]
+        pairer = MatePairer()
+
+        pairs = list(pairer.pair(rows))
+
+        self.assertEqual([(rows[2], rows[3]),
+                          (rows[0], None),
+                          (rows[1], None)],
+                         pairs)
+
+    def testExcludeSingles(self):
+        rows = [['r1', '99'], ['r2', '99'], ['r2', '147']]
+        pairer = MatePairer()
+
+        pairs = list(pairer.pair(rows, include_singles=False))
+
+        self.assertEqual([(rows[1], rows[2])], pairs)
+        self.assertEqual(1, pairer.orphan_count)
+
+    def testSpill(self):
+        rows = [['r{}'.format(i), '99'] for i in range(10)]
+        rows.append(['r3', '147'])
+        rows.append(['r11', '99'])
+        rows.append(['r11', '147'])
+        pairer = MatePairer(max_cached_rows=4,
+                            bucket_count=3,
+                            work_path=self.work_path)
+
+        pairs = list(pairer.pair(rows))
+
+        # Pairs found in memory come first, then pairs from disk, then singles
+        # in their original order.
+        self.assertEqual((rows[11], rows[12]), pairs[0])
+        self.assertEqual((rows[3], rows[10]), pairs[1])
+        expected_singles = [(row, None)
+                            for i, row in enumerate(rows[:10])
+                            if i != 3]
+        self.assertEqual(expected_singles, pairs[2:])
+        self.assertEqual(1, pairer.spilled_pair_count)
+        self.assertEqual(9, pairer.orphan_count)
+        self.assertLessEqual(pairer.max_cached_count, 4)
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testKeyFunction(self):
+        rows = [dict(qname='r1', flag='99'), dict(qname='r1', flag='147')]
+        pairer = MatePairer(get_qname=lambda row: row['qname'])
+
+        pairs = list(pairer.pair(rows))
+
+        self.assertEqual([(rows[0], rows[1])], pairs)
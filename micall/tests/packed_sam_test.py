@@ -0,0 +1,164 @@
+from io import BytesIO, StringIO
+import unittest
+
+from micall.utils.packed_sam import PackedSamReader, PackedSamWriter, \
+    pack_seq, unpack_seq, create_sam_writer, read_sam_rows, TWO_BIT_SEQ, \
+    FOUR_BIT_SEQ, RAW_SEQ, pack_seq_column, unpack_seq_column, SEQ_HEADER
+
+
+class PackSeqTest(unittest.TestCase):
+    def assertRoundTrip(self, seq, expected_encoding):
+        encoding, packed = pack_seq(seq)
+
+        self.assertEqual(expected_encoding, encoding)
+        self.assertEqual(seq, unpack_seq(encoding, packed, len(seq)))
+
+    def testTwoBit(self):
+        encoding, packed = pack_seq(b'ACGTA')
+
+        self.assertEqual(TWO_BIT_SEQ, encoding)
+        self.assertEqual(b'\x1b\x00', packed)
+        self.assertEqual(b'ACGTA', unpack_seq(encoding, packed, 5))
+
+    def testFourBit(self):
+        self.assertRoundTrip(b'ACGTNRY', FOUR_BIT_SEQ)
+
+    def testUnknownCharacter(self):
+        self.assertRoundTrip(b'ACGTN-', RAW_SEQ)
+
+    def testEmpty(self):
+        self.assertRoundTrip(b'', TWO_BIT_SEQ)
+
+    def testLowerCase(self):
+        self.assertRoundTrip(b'acgt', RAW_SEQ)
+
+
+class SeqColumnTest(unittest.TestCase):
+    def assertRoundTrip(self, seqs, expected_encoding):
+        section = pack_seq_column(seqs)
+
+        self.assertEqual(expected_encoding, section[0])
+        self.assertEqual(seqs, unpack_seq_column(section, len(seqs)))
+        return section
+
+    def testTwoBit(self):
+        section = self.assertRoundTrip(b'ACGTACGTA', TWO_BIT_SEQ)
+
+        self.assertEqual(SEQ_HEADER.size + 3, len(section))
+
+    def testRunsOfOtherLetters(self):
+        seqs = b'ACGT' * 20 + b'NN' + b'ACGT' * 20 + b'R'
+
+        section = self.assertRoundTrip(seqs, TWO_BIT_SEQ)
+
+        self.assertEqual((TWO_BIT_SEQ, 41, 2), SEQ_HEADER.unpack_from(section))
+
+    def testTooManyOtherLetters(self):
+        self.assertRoundTrip(b'ACGTNNNN', FOUR_BIT_SEQ)
+
+    def testUnknownLetters(self):
+        self.assertRoundTrip(b'ACGT----', RAW_SEQ)
+
+    def testEmpty(self):
+        self.assertRoundTrip(b'', TWO_BIT_SEQ)
+
+
+class PackedSamTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = [
+            ['Example_read_1', '99', 'R1', '1', '44', '5M', '=', '1', '5',
+             'ACGTA', 'AAAAA'],
+            ['Example_read_2', '77', '*', '0', '0', '*', '*', '0', '0',
+             'ACNNT', 'AA#AA'],
+            ['Example_read_1', '147', 'R1', '1', '44', '5M', '=', '1', '-5',
+             'ACGTA', 'BBBBB'],
+            ['Example_read_3', '99', 'R2', '10', '44', '3M', 'R1', '8', '0',
+             'TTT', 'AAA']]
+
+    def write(self, block_size=2):
+        packed = BytesIO()
+        writer = PackedSamWriter(packed, block_size=block_size)
+        writer.writeheader()
+        for fields in self.rows:
+            writer.write_fields(fields)
+        writer.close()
+        packed.seek(0)
+        return packed
+
+    def testRoundTrip(self):
+        packed = self.write()
+
+        self.assertEqual(self.rows, list(PackedSamReader(packed)))
+
+    def testRows(self):
+        packed = self.write()
+
+        rows = list(PackedSamReader(packed).iter_rows())
+
+        self.assertEqual('Example_read_3', rows[3]['qname'])
+        self.assertEqual('R1', rows[3]['rnext'])
+        self.assertEqual('0', rows[3]['tlen'])
+
+    def testFetch(self):
+        packed = self.write()
+        reader = PackedSamReader(packed)
+
+        self.assertEqual([self.rows[0], self.rows[2]], list(reader.fetch('R1')))
+        self.assertEqual([self.rows[3]], list(reader.fetch('R2')))
+        self.assertEqual([], list(reader.fetch('R3')))
+
+    def testLongReadName(self):
+        self.rows[0][0] = self.rows[2][0] = 'Example_read_1_' + 'x' * 300
+        packed = self.write()
+
+        self.assertEqual(self.rows, list(PackedSamReader(packed)))
+
+    def testMissingQuality(self):
+        self.rows[0][10] = '*'
+        packed = self.write()
+
+        self.assertEqual(self.rows, list(PackedSamReader(packed)))
+
+    def testFetchFirst(self):
+        """ Fetch finds the names in the index, without reading blocks. """
+        packed = self.write(block_size=1)
+        reader = PackedSamReader(packed)
+
+        fetched = list(reader.fetch('R2'))
+
+        self.assertEqual([self.rows[3]], fetched)
+        self.assertEqual({0: 'R1', 1: 'R2'},
+                         {name_id: name
+                          for name_id, name in reader.names.items()
+                          if name_id < 2})
+
+    def testEmpty(self):
+        self.rows = []
+        packed = self.write()
+
+        self.assertEqual([], list(PackedSamReader(packed)))
+
+    def testNotPacked(self):
+        with self.assertRaisesRegex(ValueError, 'Not a packed SAM file.'):
+            PackedSamReader(BytesIO(b'qname,flag\n'))
+
+    def testTextFormat(self):
+        text = StringIO()
+        writer = create_sam_writer(text)
+        writer.writeheader()
+        writer.writerow(dict(zip(['qname', 'flag', 'rname', 'pos', 'mapq',
+                                  'cigar', 'rnext', 'pnext', 'tlen', 'seq',
+                                  'qual'],
+                                 self.rows[0])))
+        text.seek(0)
+
+        rows = list(read_sam_rows(text))
+
+        self.assertEqual('ACGTA', rows[0]['seq'])
+
+    def testBinaryFormat(self):
+        packed = self.write()
+
+        rows = list(read_sam_rows(packed))
+
+        self.assertEqual('ACNNT', rows[1]['seq'])
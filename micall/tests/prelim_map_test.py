@@ -0,0 +1,53 @@
+from io import StringIO
+import os
+from tempfile import NamedTemporaryFile
+import unittest
+
+from micall.core.prelim_map import write_fastq_sample
+
+
+class WriteFastqSampleTest(unittest.TestCase):
+    def setUp(self):
+        with NamedTemporaryFile('w', suffix='.fastq', delete=False) as fastq:
+            for i in range(1, 6):
+                fastq.write('@read{}\nACGT\n+\nAAAA\n'.format(i))
+        self.fastq_path = fastq.name
+
+    def tearDown(self):
+        os.remove(self.fastq_path)
+
+    def testEveryRead(self):
+        sample = StringIO()
+
+        write_fastq_sample(self.fastq_path, sample, step=1, max_reads=10)
+
+        self.assertEqual(5, sample.getvalue().count('@read'))
+
+    def testStep(self):
+        expected_sample = """\
+@read1
+ACGT
++
+AAAA
+@read3
+ACGT
++
+AAAA
+@read5
+ACGT
++
+AAAA
+"""
+        sample = StringIO()
+
+        write_fastq_sample(self.fastq_path, sample, step=2, max_reads=10)
+
+        self.assertMultiLineEqual(expected_sample, sample.getvalue())
+
+    def testMaxReads(self):
+        sample = StringIO()
+
+        write_fastq_sample(self.fastq_path, sample, step=2, max_reads=2)
+
+        self.assertEqual('@read1\nACGT\n+\nAAAA\n@read3\nACGT\n+\nAAAA\n',
+                         sample.getvalue())
@@ -1,9 +1,16 @@
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
 import StringIO
+import tempfile
+import threading
+import time
 import unittest
 
 from micall.core import remap
 from micall.core.remap import is_first_read, is_short_read, \
     MixedReferenceSplitter
+from micall.utils.cpu_budget import CpuBudget
 
 
 class RemapTest(unittest.TestCase):
@@ -62,6 +69,22 @@ class SamToConseqsTest(unittest.TestCase):
         conseqs = remap.sam_to_conseqs(samIO)
         self.assertDictEqual(expected_conseqs, conseqs)
 
+    def testPairingStats(self):
+        samIO = StringIO.StringIO(
+            "@SQ\tSN:test\n"
+            "test1\t99\ttest\t1\t44\t12M\t=\t1\t12\tACAAGACCCAAC\tJJJJJJJJJJJJ\n"
+            "test2\t99\ttest\t1\t44\t12M\t=\t1\t12\tACAAGACCCAAC\tJJJJJJJJJJJJ\n"
+            "test1\t147\ttest\t1\t44\t12M\t=\t1\t-12\tACAAGACCCAAC\tJJJJJJJJJJJJ\n"
+        )
+
+        with self.assertLogs(remap.logger, 'DEBUG') as logs:
+            remap.sam_to_conseqs(samIO)
+
+        self.assertEqual(
+            ['Found 1 reads without mates, and spilled 0 reads to disk while '
+             'pairing.'],
+            [record.getMessage() for record in logs.records])
+
     def testOffset(self):
         samIO = StringIO.StringIO(
             "@SQ\tSN:test\n"
@@ -581,6 +604,611 @@ class SamToConseqsTest(unittest.TestCase):
         self.assertDictEqual(expected_conseqs, conseqs)
 
 
+class ImapLimitedTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(4)
+        self.lock = threading.Lock()
+        self.running_count = self.max_running_count = 0
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def square(self, x):
+        with self.lock:
+            self.running_count += 1
+            self.max_running_count = max(self.max_running_count,
+                                         self.running_count)
+        time.sleep(0.01)
+        with self.lock:
+            self.running_count -= 1
+        return x*x
+
+    def testUnlimited(self):
+        results = list(remap.imap_limited(self.pool, self.square, range(8)))
+
+        self.assertEqual([0, 1, 4, 9, 16, 25, 36, 49], results)
+
+    def testLimited(self):
+        results = list(remap.imap_limited(self.pool,
+                                          self.square,
+                                          range(8),
+                                          limit=2))
+
+        self.assertEqual([0, 1, 4, 9, 16, 25, 36, 49], results)
+        self.assertEqual(2, self.max_running_count)
+
+
+class MapAndBuildConseqsTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ThreadPool(4)
+        self.lock = threading.Lock()
+        self.busy_count = self.max_busy_count = 0
+        self.mapping_threads = []
+        self.original_pileup_batch = remap.pileup_batch
+        remap.pileup_batch = self.pileup_batch
+
+    def tearDown(self):
+        remap.pileup_batch = self.original_pileup_batch
+        self.pool.close()
+        self.pool.join()
+
+    def use_cores(self, count):
+        with self.lock:
+            self.busy_count += count
+            self.max_busy_count = max(self.max_busy_count, self.busy_count)
+
+    def pileup_batch(self, quality_cutoff, batch):
+        self.use_cores(1)
+        time.sleep(0.5)
+        self.use_cores(-1)
+        return remap.Pileup()
+
+    def start_mapping(self, mapping_threads):
+        """ Stand in for bowtie2, which is busy until its lines are read. """
+        self.mapping_threads.append(mapping_threads)
+        self.use_cores(mapping_threads)
+        try:
+            yield "@SQ\tSN:test\n"
+            for i in range(4*remap.BATCH_SIZE):
+                if i % remap.BATCH_SIZE == 0:
+                    time.sleep(0.02)  # slower than the workers
+                yield "r{}\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n".format(i)
+                yield "r{}\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n".format(i)
+        finally:
+            self.use_cores(-mapping_threads)
+
+    def testSplitReservation(self):
+        budget = CpuBudget(4)
+
+        remap.map_and_build_conseqs(self.start_mapping,
+                                    budget,
+                                    nthreads=4,
+                                    worker_pool=self.pool)
+
+        self.assertEqual([2], self.mapping_threads)
+        self.assertLessEqual(self.max_busy_count, budget.total)
+        self.assertEqual(4, budget.available)
+
+    def testConcurrentPhases(self):
+        budget = CpuBudget(6)
+        threads = [threading.Thread(target=remap.map_and_build_conseqs,
+                                    args=(self.start_mapping, budget, 4),
+                                    kwargs=dict(worker_pool=self.pool))
+                   for _ in range(2)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertLessEqual(self.max_busy_count, budget.total)
+        self.assertEqual(6, budget.available)
+
+    def testOneCore(self):
+        budget = CpuBudget(1)
+
+        conseqs = remap.map_and_build_conseqs(self.start_mapping,
+                                              budget,
+                                              nthreads=4,
+                                              worker_pool=self.pool)
+
+        self.assertEqual([1], self.mapping_threads)
+        self.assertEqual(1, self.max_busy_count)
+        self.assertEqual({'test': 'ACA'}, conseqs)
+
+
+class SeedDistanceTest(unittest.TestCase):
+    def setUp(self):
+        # 60 bases with no repeated 20-mers
+        self.seed = ('ACCTGAGGATCCAGTTAAGCTTGCATGCCTGCAGGTCGACTCTAGAGGATCCCCGGGTAC'
+                     'CGAGCTCGAATTC')
+
+    def testAnchors(self):
+        anchors = remap.find_seed_anchors('ACGTACGTTT', anchor_size=4)
+
+        # ACGT is repeated, so it can't be an anchor.
+        self.assertEqual({'CGTA': 1, 'GTAC': 2, 'TACG': 3, 'CGTT': 5,
+                          'GTTT': 6},
+                         anchors)
+
+    def testAnchoredConsensus(self):
+        conseq = self.seed[5:30] + 'T' + self.seed[31:55]
+
+        distance = remap.calculate_seed_distance(self.seed, conseq)
+
+        self.assertEqual(1, distance)
+
+    def testShortConsensusIsAligned(self):
+        conseq = self.seed[10:20] + 'A' + self.seed[20:30]
+
+        distance = remap.calculate_seed_distance(self.seed, conseq)
+
+        self.assertEqual(1, distance)
+
+    def testMismatchedEndsAreAligned(self):
+        conseq = 'T' + self.seed[1:45] + 'T'
+
+        distance = remap.calculate_seed_distance(self.seed, conseq)
+
+        self.assertEqual(2, distance)
+
+    def testMaxDistance(self):
+        conseq = 'TTTTTTTTTTTTTTTTTTTTTTTTT'
+
+        distance = remap.calculate_seed_distance(self.seed,
+                                                 conseq,
+                                                 max_distance=3)
+
+        self.assertGreater(distance, 3)
+
+
+class PileupTest(unittest.TestCase):
+    def testConsensus(self):
+        pileup = remap.Pileup()
+        pileup.add('test', 'ACGT', {})
+        pileup.add('test', '--GA', {})
+        pileup.add('test', '--GA', {})
+
+        self.assertEqual({'test': 'ACGA'}, pileup.build_conseqs())
+
+    def testTieGoesToFirstToken(self):
+        pileup = remap.Pileup()
+        pileup.add('test', 'ACGT', {})
+        pileup.add('test', 'ACTT', {})
+
+        self.assertEqual({'test': 'ACGT'}, pileup.build_conseqs())
+
+    def testSeedFillsGaps(self):
+        pileup = remap.Pileup(seeds={'test': 'AAAAAA'})
+        pileup.add('test', '--CC', {})
+
+        self.assertEqual({'test': 'AACCAA'}, pileup.build_conseqs())
+
+    def testCodonInsertion(self):
+        pileup = remap.Pileup()
+        pileup.add('test', 'ACGT', {3: 'TTT'})
+        pileup.add('test', 'ACGT', {3: 'TTT'})
+        pileup.add('test', 'ACGT', {3: 'TT'})  # not a codon, so ignored
+
+        self.assertEqual({'G': 1, 'GTTT': 2},
+                         pileup.get_token_counts('test', 3))
+        self.assertEqual({'test': 'ACGTTTT'}, pileup.build_conseqs())
+
+    def testCoverage(self):
+        pileup = remap.Pileup(seeds={'test': 'AAAA'})
+        pileup.add('test', 'ACGT', {})
+        pileup.add('test', 'NCGT', {})
+        pileup.add('test', 'A-GT', {})
+
+        self.assertEqual(1, pileup.get_coverage('test', 1))  # 2 A's and N
+        self.assertEqual(0, pileup.get_coverage('test', 2))  # 2 C's and -
+        self.assertEqual(0, pileup.get_coverage('test', 5))
+
+    def testNoCoverage(self):
+        pileup = remap.Pileup(seeds={'test': 'AAAA'})
+        pileup.add('test', 'NN', {})
+
+        self.assertEqual({}, pileup.build_conseqs())
+
+    def testMerge(self):
+        pileup1 = remap.Pileup()
+        pileup1.add('test', 'ACGT', {})
+        pileup2 = remap.Pileup()
+        pileup2.add('other', 'TTTT', {})
+        pileup2.add('test', 'ACCT', {})
+        pileup2.add('test', 'ACCT', {})
+
+        pileup1.merge(pileup2)
+
+        self.assertEqual({'test': 'ACCT', 'other': 'TTTT'},
+                         pileup1.build_conseqs())
+        self.assertEqual(['test', 'other'], pileup1.rnames)
+        self.assertEqual(3, pileup1.read_counts['test'])
+
+
+class BatchReadPairsTest(unittest.TestCase):
+    def testBatches(self):
+        samIO = StringIO.StringIO(
+            "@SQ\tSN:test\n"
+            "test1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+            "test2\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+            "test1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"
+            "test3\t99\tother\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+            "test4\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+            "test4\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"
+        )
+        expected_batches = [
+            (True,
+             "test1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+             "test1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"),
+            (True,
+             "test4\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+             "test4\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"),
+            (False,
+             "test2\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n")]
+
+        batches = list(remap.batch_read_pairs(samIO, batch_size=1))
+
+        self.assertEqual(expected_batches, batches)
+
+    def testPileupBatch(self):
+        samIO = StringIO.StringIO(
+            "@SQ\tSN:test\n"
+            "test1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"
+            "test1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"
+            "test2\t99\ttest\t1\t44\t3M\t=\t1\t3\tAGA\tJJJ\n"
+            "test3\t99\ttest\t1\t44\t3M\t=\t1\t3\tAGA\tJJJ\n"
+        )
+        pileup = remap.Pileup()
+
+        for batch in remap.batch_read_pairs(samIO):
+            pileup.merge(remap.pileup_batch(20, batch))
+
+        self.assertEqual({'test': 'AGA'}, pileup.build_conseqs())
+        self.assertEqual(3, pileup.read_counts['test'])
+
+
+class IncrementalRemapTest(unittest.TestCase):
+    def testConseqChanges(self):
+        old_conseqs = {'same': 'ACGTACGT',
+                       'small': 'ACGTACGTACGT',
+                       'insert': 'ACGTACGTACGT',
+                       'large': 'ACGTACGTACGT',
+                       'dropped': 'ACGT'}
+        new_conseqs = {'same': 'ACGTACGT',
+                       'small': 'ACGTAGGTACGT',
+                       'insert': 'ACGTACGTTTACGT',
+                       'large': 'TTTTTTTTTTTT',
+                       'new': 'ACGT'}
+        expected_changes = {'same': None,
+                            'small': (6, 6, 0),
+                            'insert': (9, 8, 2)}
+
+        changes = remap.find_conseq_changes(old_conseqs,
+                                            new_conseqs,
+                                            max_window=5)
+
+        self.assertEqual(expected_changes, changes)
+
+    def testReadSpan(self):
+        fields = 'r1\t99\ttest\t10\t44\t2S5M1D3M1I2M4S'.split('\t')
+
+        span = remap.get_read_span(fields)
+
+        self.assertEqual((8, 24), span)
+
+    def testReuseUnchanged(self):
+        lines = ["r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n",
+                 "r1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines, {'test': None})
+
+        self.assertEqual(lines, kept_lines)
+
+    def testReuseBeforeWindow(self):
+        lines = ["r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines,
+                                           {'test': (10, 12, 3)},
+                                           margin=5)
+
+        self.assertEqual(lines, kept_lines)
+
+    def testReuseAfterWindow(self):
+        lines = ["r1\t99\ttest\t20\t44\t3M\t=\t22\t5\tACA\tJJJ\n",
+                 "r1\t147\ttest\t22\t44\t3M\t=\t20\t-5\tACA\tJJJ\n"]
+        expected_lines = [
+            "r1\t99\ttest\t23\t44\t3M\t=\t25\t5\tACA\tJJJ\n",
+            "r1\t147\ttest\t25\t44\t3M\t=\t23\t-5\tACA\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines,
+                                           {'test': (10, 12, 3)},
+                                           margin=5)
+
+        self.assertEqual(expected_lines, kept_lines)
+
+    def testRemapOverlappingWindow(self):
+        lines = ["r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines,
+                                           {'test': (6, 6, 0)},
+                                           margin=5)
+
+        self.assertIsNone(kept_lines)
+
+    def testRemapChangedReference(self):
+        lines = ["r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines, {'other': None})
+
+        self.assertIsNone(kept_lines)
+
+    def testRemapUnmappedMate(self):
+        lines = ["r1\t73\ttest\t1\t44\t3M\t=\t1\t0\tACA\tJJJ\n",
+                 "r1\t133\ttest\t1\t0\t*\t=\t1\t0\tGGG\tJJJ\n"]
+
+        kept_lines = remap.reuse_alignment(lines, {'test': None})
+
+        self.assertIsNone(kept_lines)
+
+    def testWriteOriginalReads(self):
+        lines = ["r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACC\tJJK\tAS:i:6\n",
+                 "r1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACC\tJJK\n"]
+        fastq1 = StringIO.StringIO()
+        fastq2 = StringIO.StringIO()
+
+        remap.write_original_reads(lines, [fastq1, fastq2])
+
+        self.assertEqual("@r1\nACC\n+\nJJK\n", fastq1.getvalue())
+        self.assertEqual("@r1\nGGT\n+\nKJJ\n", fastq2.getvalue())
+
+
+class ConvergenceTest(unittest.TestCase):
+    def testConseqChanges(self):
+        old_conseqs = {'same': 'ACGTACGT',
+                       'changed': 'ACGTACGTACGT',
+                       'covered': 'NNNTACGTACGT',
+                       'dropped': 'ACGT'}
+        new_conseqs = {'same': 'ACGTACGT',
+                       'changed': 'ACGTAGGTTCGT',
+                       'covered': 'ACGTACGTACGTAC',
+                       'new': 'ACGT'}
+        expected_report = {
+            'same': dict(conseq_diff=0, coverage_gain=0),
+            'changed': dict(conseq_diff=4, coverage_gain=0),
+            'covered': dict(conseq_diff=14, coverage_gain=5)}
+
+        report = remap.measure_conseq_changes(old_conseqs, new_conseqs)
+
+        self.assertEqual(expected_report, report)
+
+    def testCountsRow(self):
+        remap_counts = StringIO.StringIO()
+        writer = remap.csv.DictWriter(
+            remap_counts,
+            'type count seed_dist conseq_diff coverage_gain'.split(),
+            lineterminator='\n')
+        change_report = {'test': dict(conseq_diff=3, coverage_gain=10)}
+
+        remap.write_remap_counts(writer,
+                                 {'test': 100},
+                                 title='remap-1',
+                                 change_report=change_report)
+
+        self.assertEqual('remap-1 test,100,,3,10\n', remap_counts.getvalue())
+
+
+class WriteUnmappedReadTest(unittest.TestCase):
+    def testWrite(self):
+        unmapped1 = StringIO.StringIO()
+        unmapped2 = StringIO.StringIO()
+        rows = ['r1\t77\t*\t0\t0\t*\t*\t0\t0\tACG\tJJK'.split('\t'),
+                'r1\t141\t*\t0\t0\t*\t*\t0\t0\tTTA\tKJJ'.split('\t')]
+
+        for fields in rows:
+            remap.write_unmapped_read(fields, unmapped1, unmapped2)
+
+        self.assertEqual('@r1\nACG\n+\nJJK\n', unmapped1.getvalue())
+        self.assertEqual('@r1\nTTA\n+\nKJJ\n', unmapped2.getvalue())
+
+    def testSkip(self):
+        unmapped2 = StringIO.StringIO()
+        fields = 'r1\t77\t*\t0\t0\t*\t*\t0\t0\tACG\tJJK'.split('\t')
+
+        remap.write_unmapped_read(fields, None, unmapped2)
+
+        self.assertEqual('', unmapped2.getvalue())
+
+
+class WarmStartTest(unittest.TestCase):
+    def testChooseWarmConseqs(self):
+        seeds = {'close': 'ACGTACGTACGTACGTACGT',
+                 'far': 'ACGTACGTACGTACGTACGT',
+                 'unused': 'ACGTACGTACGTACGTACGT',
+                 'missing': 'ACGTACGTACGTACGTACGT'}
+        stored_conseqs = {'close': 'ACGTACGTTCGTACGTACGT',
+                          'far': 'TTTTTTTTTTTTTTTTTTTT',
+                          'unused': 'ACGTACGTACGTACGTACGT'}
+        rnames = ['close', 'far', 'missing']
+
+        warm_conseqs = remap.choose_warm_conseqs(stored_conseqs, seeds, rnames)
+
+        self.assertEqual({'close': 'ACGTACGTTCGTACGTACGT'}, warm_conseqs)
+
+
+class StreamPrelimTest(unittest.TestCase):
+    def testCounts(self):
+        prelim_csv = StringIO.StringIO("""\
+qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual
+test1,99,test,1,44,12M,=,1,12,ACAAGACCCAAC,JJJJJJJJJJJJ
+test1,147,test,1,44,12M,=,1,-12,ACAAGACCCAAC,JJJJJJJJJJJJ
+test2,77,*,0,0,*,*,0,0,GTGT,JJJJ
+""")
+        seeds = {'test': 'ACAAGACCCAAC'}
+        expected_lines = [
+            "@HD\tVN:1.0\tSO:unsorted\n",
+            "@SQ\tSN:test\tLN:12\n",
+            "test1\t99\ttest\t1\t44\t12M\t=\t1\t12\tACAAGACCCAAC\tJJJJJJJJJJJJ\n",
+            "test1\t147\ttest\t1\t44\t12M\t=\t1\t-12\tACAAGACCCAAC\tJJJJJJJJJJJJ\n",
+            "test2\t77\t*\t0\t0\t*\t*\t0\t0\tGTGT\tJJJJ\n"]
+        prelim_counts = {}
+        prelim_stats = {}
+
+        lines = list(remap.stream_prelim(prelim_csv,
+                                         seeds,
+                                         prelim_counts,
+                                         prelim_stats))
+
+        self.assertEqual(expected_lines, lines)
+        self.assertEqual({'test': 0}, prelim_counts)  # short reads excluded
+        self.assertEqual({'row_count': 3}, prelim_stats)
+
+    def testConsensus(self):
+        prelim_csv = StringIO.StringIO("""\
+qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual
+test1,99,test,1,44,12M,=,1,12,ACAAGACCCAAC,JJJJJJJJJJJJ
+""")
+        seeds = {'test': 'ACAAGACCCAAT'}
+
+        conseqs = remap.sam_to_conseqs(remap.stream_prelim(prelim_csv,
+                                                           seeds,
+                                                           {},
+                                                           {}))
+
+        self.assertEqual({'test': 'ACAAGACCCAAC'}, conseqs)
+
+
+class FakeBowtie2Build(object):
+    def build(self, reffile, reffile_template):
+        self.reffile = reffile
+
+
+class FakeBowtie2(object):
+    def __init__(self, mapped_lines):
+        self.mapped_lines = mapped_lines
+
+    def yield_mapping(self, args, fastq1, fastq2=None, nthreads=1,
+                      shard_count=1, work_path='', stderr=None):
+        self.work_path = work_path
+        return iter(self.mapped_lines)
+
+
+class RemapSplitTest(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def testWorkspace(self):
+        bowtie2 = FakeBowtie2([
+            "r1\t99\ttest\t1\t44\t3M\t=\t1\t3\tACA\tJJJ\n",
+            "r1\t147\ttest\t1\t44\t3M\t=\t1\t-3\tACA\tJJJ\n",
+            "r2\t77\t*\t0\t0\t*\t*\t0\t0\tGGG\tJJJ\tYT:Z:UP\n",
+            "r2\t141\t*\t0\t0\t*\t*\t0\t0\tTTT\tJJK\tYT:Z:UP\n"])
+        bowtie2_build = FakeBowtie2Build()
+
+        split_counts, unmapped_count = remap.remap_split(
+            'test_R1.fastq', 'test_R2.fastq', {'test': 'ACAGT'},
+            self.workspace, bowtie2, bowtie2_build, raw_count=4, rdgopen=10,
+            rfgopen=10, nthreads=1, stderr=None)
+
+        with open(os.path.join(self.workspace, 'temp_unmapped_R2.fastq')) as f:
+            unmapped2 = f.read()
+        with open(os.path.join(self.workspace, 'temp.sam')) as f:
+            sam_lines = f.readlines()
+        self.assertEqual({'test': 2}, split_counts)
+        self.assertEqual(2, unmapped_count)
+        self.assertEqual("@r2\nTTT\n+\nJJK\n", unmapped2)
+        self.assertEqual(self.workspace, bowtie2.work_path)
+        self.assertEqual(os.path.join(self.workspace, 'temp.fasta'),
+                         bowtie2_build.reffile)
+        self.assertEqual(7, len(sam_lines))  # 3 header lines
+
+
+class FakeSplitFile(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSplitter(object):
+    def __init__(self, rnames):
+        self.splits = dict((rname, (FakeSplitFile(rname + '_R1.fastq'),
+                                    FakeSplitFile(rname + '_R2.fastq')))
+                           for rname in rnames)
+
+    def walk(self, samfile):
+        for line in samfile:
+            if not line.startswith('@'):
+                yield line.rstrip('\n').split('\t')
+
+
+class ReferenceLengthsTest(unittest.TestCase):
+    def testNoIterations(self):
+        lengths = remap.get_reference_lengths({'R1': 'ACGT', 'R2': 'AC'})
+
+        self.assertEqual({'R1': 4, 'R2': 2}, lengths)
+
+    def testChangedLengths(self):
+        conseqs = {'R1': 'ACGTAC', 'R2': 'AC'}
+        mapped_conseqs = {'R1': 'ACGT', 'R2': 'ACG', 'R3': 'A'}
+
+        lengths = remap.get_reference_lengths(conseqs, mapped_conseqs)
+
+        self.assertEqual({'R1': 6, 'R2': 3, 'R3': 1}, lengths)
+
+
+class RemapSplitsTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.original_remap_split = remap.remap_split
+        remap.remap_split = self.fail_remap_split
+        self.splitter = FakeSplitter(['R1', 'R2'])
+
+    def tearDown(self):
+        remap.remap_split = self.original_remap_split
+        shutil.rmtree(self.work_path)
+
+    def fail_remap_split(self, fastq1, fastq2, refseqs, workspace, *args,
+                         **kwargs):
+        with open(os.path.join(workspace, 'temp.sam'), 'w'):
+            pass
+        raise RuntimeError('Bowtie2 failed.')
+
+    def remap_splits(self, keep=False):
+        remap.remap_splits(self.splitter,
+                           {'R1': 'ACGT', 'R2': 'TTGG'},
+                           remap_writer=None,
+                           fieldnames=[],
+                           unmapped1=None,
+                           unmapped2=None,
+                           work_path=self.work_path,
+                           bowtie2=None,
+                           bowtie2_build=None,
+                           raw_count=4,
+                           rdgopen=10,
+                           rfgopen=10,
+                           stderr=None,
+                           shard_count=1,
+                           cpu_budget=CpuBudget(2),
+                           keep=keep)
+
+    def testFailureRemovesWorkspaces(self):
+        with self.assertRaisesRegex(RuntimeError, 'Bowtie2 failed'):
+            self.remap_splits()
+
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testFailureKeepsWorkspaces(self):
+        with self.assertRaisesRegex(RuntimeError, 'Bowtie2 failed'):
+            self.remap_splits(keep=True)
+
+        workspaces = sorted(os.listdir(self.work_path))
+        self.assertEqual(2, len(workspaces))
+        self.assertTrue(workspaces[0].startswith('temp.split_'))
+
+
 class MixedReferenceMemorySplitter(MixedReferenceSplitter):
     """ Dummy class to hold split reads in memory. Useful for testing. """
     def create_split_file(self, refname, direction):
@@ -1,7 +1,18 @@
+import os
+import random
+import tempfile
 import unittest
+from csv import DictReader
 from StringIO import StringIO
+from unittest.mock import patch
 
-from micall.core.sam2aln import sam2aln, apply_cigar, merge_pairs, merge_inserts
+from micall.core.sam2aln import sam2aln, apply_cigar, merge_pairs, merge_inserts, \
+    merge_pairs_batch, merge_pairs_by_char, merge_pairs_cutoffs, \
+    apply_cigar_batch, compile_cigar, MergeMemo, QUALITY_BIN_EDGES, \
+    find_pair_ranges, merge_ranges, AlignedCounts, get_range_path
+from micall.utils.aligned_deltas import read_aligned_rows
+from micall.utils.bam import INDEX_SUFFIX, load_index
+from micall.utils.packed_sam import create_sam_writer
 
 
 class RemapReaderTest(unittest.TestCase):
@@ -547,6 +558,30 @@ class CigarTest(unittest.TestCase):
         self.assertEqual(expected_quality, clipped_quality)
         self.assertEqual({3: ('TAG', 'BBB')}, inserts)
 
+    def testUnsupportedTokenAfterLongCigar(self):
+        cigar = '12M2H'
+        seq     = 'AAACAACCA'  # @IgnorePep8
+        quality = 'BBBBBBBBB'
+
+        with self.assertRaisesRegexp(RuntimeError,
+                                     r"CIGAR string '12M2H' is too long"):
+            apply_cigar(cigar, seq, quality)
+
+    def testCompiledOnce(self):
+        self.assertIs(compile_cigar('3M1I5M'), compile_cigar('3M1I5M'))
+
+    def testBatch(self):
+        reads = [('9M', 'AAACAACCA', 'BBBBBBBBB'),
+                 ('3M3I3M', 'ACTTAGAAA', 'AAABBBDDD', 0, 0, 3),
+                 ('2M1D3M', 'ACTTA', 'AAABB', 2)]
+        expected_results = [('AAACAACCA', 'BBBBBBBBB', {}),
+                            ('ACTA', 'AAAD', {3: ('TAG', 'BBB')}),
+                            ('--AC-TTA', '!!AA ABB', {})]
+
+        results = apply_cigar_batch(reads)
+
+        self.assertEqual(expected_results, results)
+
 
 class MergePairsTest(unittest.TestCase):
     def setUp(self):
@@ -701,6 +736,137 @@ class MergePairsTest(unittest.TestCase):
 
         self.assertEqual(expected_mseq, mseq)
 
+    def testIntervalBetweenReads(self):
+        seq1          = 'ACT'  # @IgnorePep8
+        seq2          = '-----GCA'  # @IgnorePep8
+        qual1         = 'JJJ'  # @IgnorePep8
+        qual2         = '!!!!!JJJ'  # @IgnorePep8
+        expected_mseq = 'ACTnnGCA'
+
+        mseq = merge_pairs(seq1, seq2, qual1, qual2)
+
+        self.assertEqual(expected_mseq, mseq)
+
+    def testOnlyGapsInOverlap(self):
+        seq1          = '--'  # @IgnorePep8
+        seq2          = '---GCA'  # @IgnorePep8
+        qual1         = '!!'  # @IgnorePep8
+        qual2         = '!!!JJJ'  # @IgnorePep8
+        expected_mseq = 'nGCA'
+
+        mseq = merge_pairs(seq1, seq2, qual1, qual2)
+
+        self.assertEqual(expected_mseq, mseq)
+
+    def testInsertionPastEnd(self):
+        seq1          = 'AGTGCA'  # @IgnorePep8
+        seq2          = 'AGTGCA'  # @IgnorePep8
+        qual1         = 'JJJJJJ'  # @IgnorePep8
+        qual2         = 'JJJJJJ'  # @IgnorePep8
+        ins1 = {8: ('CC', 'JJ'), 7: ('TT', 'JJ')}
+        expected_mseq = 'AGTGCACTTC'
+
+        mseq = merge_pairs(seq1, seq2, qual1, qual2, ins1)
+
+        self.assertEqual(expected_mseq, mseq)
+
+    def testNotAscii(self):
+        seq1          = 'ACT\u00e9CA'  # @IgnorePep8
+        seq2          = 'ACTGCA'  # @IgnorePep8
+        qual1         = 'JJJJJJ'  # @IgnorePep8
+        qual2         = 'JJJJJJ'  # @IgnorePep8
+        expected_mseq = 'ACTNCA'
+
+        mseq = merge_pairs(seq1, seq2, qual1, qual2)
+
+        self.assertEqual(expected_mseq, mseq)
+
+
+class MergePairsBatchTest(unittest.TestCase):
+    def testBatch(self):
+        pairs = [('ACTGCA', 'ACTGCA', 'JJJJJJ', 'JJJJJJ'),
+                 ('ACTGCA', 'ACTTCA', 'JJJJJJ', 'JJJ#JJ'),
+                 ('AGTGCA', 'AGTGCA', 'JJJJJJ', 'JJJJJJ',
+                  {2: ('CCC', 'JJJ')}, None)]
+        expected_mseqs = ['ACTGCA', 'ACTGCA', 'AGCCCTGCA']
+
+        mseqs = merge_pairs_batch(pairs)
+
+        self.assertEqual(expected_mseqs, mseqs)
+
+    def testEmpty(self):
+        self.assertEqual([], merge_pairs_batch([]))
+
+    def testMatchesMergeByChar(self):
+        """ Compare with the original version on random read pairs. """
+        rand = random.Random(41)
+
+        def random_read():
+            size = rand.randint(0, 12)
+            seq = ''.join(rand.choice('ACGT-N') for _ in range(size))
+            if rand.random() < 0.3:
+                seq = '-' * rand.randint(0, 5) + seq
+            qual = ''.join(chr(33 + rand.choice([0, 5, 9, 10, 11, 14, 15, 16, 40]))
+                           for _ in seq)
+            return seq, qual
+
+        for q_cutoff, minimum_q_delta in [(10, 5), (15, 5), (0, 0), (10, 1)]:
+            pairs = []
+            for _ in range(500):
+                seq1, qual1 = random_read()
+                seq2, qual2 = random_read()
+                ins1 = rand.choice([None, {}, {rand.randint(0, 14): ('AC', 'JJ')}])
+                pairs.append((seq1, seq2, qual1, qual2, ins1, None))
+            expected_mseqs = [merge_pairs_by_char(*pair,
+                                                  q_cutoff=q_cutoff,
+                                                  minimum_q_delta=minimum_q_delta)
+                              for pair in pairs]
+
+            mseqs = merge_pairs_batch(pairs, q_cutoff, minimum_q_delta)
+
+            self.assertEqual(expected_mseqs, mseqs)
+
+    def testCutoffs(self):
+        pairs = [('ACTGCA', 'ACTGCA', 'JJJJJJ', 'JJJJJJ'),
+                 ('ACTGCA', 'ACTTCA', 'JJJ5JJ', 'JJJ#JJ'),
+                 ('AGTGCA-', 'AGTGCAT', 'JJJJJJ!', 'JJJJJ55',
+                  {2: ('CCC', '555')}, None)]
+        expected_mseqs = [{15: 'ACTGCA', 20: 'ACTGCA'},
+                          {15: 'ACTGCA', 20: 'ACTNCA'},
+                          {15: 'AGCCCTGCAT', 20: 'AGTGCAN'}]
+
+        mseqs = merge_pairs_cutoffs(pairs, [15, 20])
+
+        self.assertEqual(expected_mseqs, mseqs)
+
+    def testCutoffsMatchMergeByChar(self):
+        """ Compare each cutoff with the original version. """
+        rand = random.Random(45)
+        q_cutoffs = [0, 10, 15, 30]
+
+        def random_read():
+            size = rand.randint(0, 12)
+            seq = ''.join(rand.choice('ACGT-N') for _ in range(size))
+            if rand.random() < 0.3:
+                seq = '-' * rand.randint(0, 5) + seq
+            qual = ''.join(chr(33 + rand.choice([0, 9, 10, 11, 15, 16, 30, 31, 40]))
+                           for _ in seq)
+            return seq, qual
+
+        pairs = []
+        for _ in range(500):
+            seq1, qual1 = random_read()
+            seq2, qual2 = random_read()
+            ins1 = rand.choice([None, {}, {rand.randint(0, 14): ('AC', '5J')}])
+            pairs.append((seq1, seq2, qual1, qual2, ins1, None))
+        expected_mseqs = [{q_cutoff: merge_pairs_by_char(*pair, q_cutoff=q_cutoff)
+                           for q_cutoff in q_cutoffs}
+                          for pair in pairs]
+
+        mseqs = merge_pairs_cutoffs(pairs, q_cutoffs)
+
+        self.assertEqual(expected_mseqs, mseqs)
+
 
 class MergeInsertionsTest(unittest.TestCase):
     def setUp(self):
@@ -777,3 +943,298 @@ class MergeInsertionsTest(unittest.TestCase):
         merged = merge_inserts(ins1, ins2)
 
         self.assertEqual(expected_merged, merged)
+
+
+class MergeMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.remap_text = """\
+qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual
+Example_read_1,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_1,147,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_2,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_2,147,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_3,99,V3LOOP,1,44,2M1I29M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_3,147,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_4,163,V3LOOP,1,44,2M1I29M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_4,83,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+"""
+
+    def run_sam2aln(self, **kwargs):
+        aligned_csv = StringIO()
+        insert_csv = StringIO()
+        merge_stats = {}
+        sam2aln(StringIO(self.remap_text),
+                aligned_csv,
+                insert_csv,
+                StringIO(),
+                merge_stats=merge_stats,
+                **kwargs)
+        return aligned_csv.getvalue(), insert_csv.getvalue(), merge_stats
+
+    def testHits(self):
+        expected_stats = {'hit_count': 1,
+                          'miss_count': 3,
+                          'orphan_count': 0,
+                          'spilled_count': 0}
+
+        _aligned, _inserts, merge_stats = self.run_sam2aln()
+
+        self.assertEqual(expected_stats, merge_stats)
+
+    def testSameOutputWithoutMemo(self):
+        expected_aligned, expected_inserts, _stats = self.run_sam2aln(
+            memo_size=0)
+
+        aligned, inserts, merge_stats = self.run_sam2aln()
+
+        self.assertMultiLineEqual(expected_aligned, aligned)
+        self.assertMultiLineEqual(expected_inserts, inserts)
+        self.assertIn('Example_read_3,F,V3LOOP,2,T,A', inserts)
+        self.assertIn('Example_read_4,R,V3LOOP,2,T,A', inserts)
+        self.assertEqual({'hit_count': 0,
+                          'miss_count': 0,
+                          'orphan_count': 0,
+                          'spilled_count': 0},
+                         self.run_sam2aln(memo_size=0)[2])
+
+    def testEviction(self):
+        memo = MergeMemo(max_size=1)
+        read1 = ('1', '3M', 'ACT', 'AAA', 'F')
+        read2 = ('1', '3M', 'ACT', 'AAA', 'R')
+        read3 = ('1', '3M', 'ACG', 'AAA', 'R')
+
+        memo.merge(read1, read2)
+        memo.merge(read1, read3)
+        memo.merge(read1, read2)
+
+        self.assertEqual((0, 3), (memo.hit_count, memo.miss_count))
+
+    def testQualityBinning(self):
+        memo = MergeMemo(quality_bins=QUALITY_BIN_EDGES)
+        read1 = ('1', '3M', 'ACT', 'AAA', 'F')
+        read2 = ('1', '3M', 'ACT', 'AAB', 'R')  # Q32 and Q33 share a bin
+        read3 = ('1', '3M', 'ACT', '111', 'R')  # Q16 is just above the cutoff
+
+        merged2 = memo.merge(read1, read2)
+        merged3 = memo.merge(read1, read3)
+        merged4 = memo.merge(read1, read3)
+
+        self.assertEqual((1, 2), (memo.hit_count, memo.miss_count))
+        self.assertEqual({15: 'ACT'}, merged2[0])
+        self.assertEqual({15: 'ACT'}, merged3[0])
+        self.assertIs(merged3, merged4)
+
+    def testQualityBinningKeepsInsertQualities(self):
+        memo = MergeMemo(quality_bins=QUALITY_BIN_EDGES)
+        read1 = ('1', '1M1I2M', 'ACTG', 'AAAA', 'F')
+        read2 = ('1', '3M', 'ATG', 'AAA', 'R')
+        read3 = ('1', '1M1I2M', 'ACTG', 'ABAA', 'F')  # insertion is Q33
+
+        merged2 = memo.merge(read1, read2)
+        merged3 = memo.merge(read3, read2)
+
+        self.assertEqual((1, 1), (memo.hit_count, memo.miss_count))
+        self.assertEqual(merged2[0], merged3[0])
+        self.assertEqual([('F', 1, 'C', 'A')], merged2[1])
+        self.assertEqual([('F', 1, 'C', 'B')], merged3[1])
+
+
+class MergeRangesTest(unittest.TestCase):
+    def setUp(self):
+        remap_text = """\
+qname,flag,rname,pos,mapq,cigar,rnext,pnext,tlen,seq,qual
+Example_read_1,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_2,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_1,147,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_3,99,INT,1,44,2M1I29M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_3,147,INT,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_4,0,V3LOOP,1,44,32M,*,0,0,TGTACAAGACCCAACAACAATACAAGAAAAAC,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_5,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_5,147,INT,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_6,99,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+Example_read_2,147,V3LOOP,1,44,32M,=,1,-32,TGTACAAGACCCAACAACAATACAAGAAAAAG,AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+"""
+        handle, self.remap_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as remap_csv:
+            remap_csv.write(remap_text)
+
+        self.bam_path = None
+
+    def tearDown(self):
+        os.remove(self.remap_path)
+        if self.bam_path is not None:
+            os.remove(self.bam_path)
+            os.remove(self.bam_path + INDEX_SUFFIX)
+
+    def write_bam(self):
+        """ Copy the remap CSV to a BAM file with a chunk for each record. """
+        handle, self.bam_path = tempfile.mkstemp(suffix='.bam')
+        os.close(handle)
+        with open(self.remap_path) as remap_csv, \
+                open(self.bam_path, 'wb') as remap_bam, \
+                patch('micall.utils.bam.MAX_BLOCK_DATA', 100):
+            writer = create_sam_writer(remap_bam,
+                                       references={'V3LOOP': 105, 'INT': 867})
+            writer.writeheader()
+            writer.writerows(DictReader(remap_csv))
+            writer.close()
+
+    def run_sam2aln(self, remap_path=None, **kwargs):
+        aligned_csv = StringIO()
+        insert_csv = StringIO()
+        failed_csv = StringIO()
+        remap_path = remap_path or self.remap_path
+        mode = 'rb' if remap_path.endswith('.bam') else 'r'
+        with open(remap_path, mode) as remap_csv:
+            sam2aln(remap_csv, aligned_csv, insert_csv, failed_csv, **kwargs)
+        return (aligned_csv.getvalue(),
+                insert_csv.getvalue(),
+                failed_csv.getvalue())
+
+    def testFindPairRanges(self):
+        with open(self.remap_path, 'rb') as remap_csv:
+            remap_bytes = remap_csv.read()
+        header_size = remap_bytes.index(b'\n') + 1
+
+        fieldnames, byte_ranges = find_pair_ranges(self.remap_path,
+                                                   range_count=3,
+                                                   min_range_size=1)
+
+        self.assertEqual(['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar',
+                          'rnext', 'pnext', 'tlen', 'seq', 'qual'],
+                         fieldnames)
+        self.assertEqual(header_size, byte_ranges[0][0])
+        self.assertEqual(len(remap_bytes), byte_ranges[-1][1])
+        self.assertLess(1, len(byte_ranges))
+        for (_start1, end1), (start2, _end2) in zip(byte_ranges,
+                                                    byte_ranges[1:]):
+            self.assertEqual(end1, start2)
+
+            # ranges never start between adjacent mates
+            previous_line = remap_bytes[:start2].splitlines()[-1]
+            next_line = remap_bytes[start2:].splitlines()[0]
+            self.assertNotEqual(previous_line.split(b',')[0],
+                                next_line.split(b',')[0])
+
+    def testSmallFileIsOneRange(self):
+        _fieldnames, byte_ranges = find_pair_ranges(self.remap_path,
+                                                    range_count=4)
+
+        self.assertEqual(1, len(byte_ranges))
+
+    def testMatesInDifferentRanges(self):
+        aligned = AlignedCounts()
+        expected_counts = [
+            ('V3LOOP', 15, [(2, 0, 'TGTACAAGACCCAACAACAATACAAGAAAAAG'),
+                            (1, 0, 'TGTACAAGACCCAACAACAATACAAGAAAAAC')])]
+        expected_events = [
+            ([dict(qname='Example_read_3',
+                   fwd_rev='F',
+                   refname='INT',
+                   pos=2,
+                   insert='T',
+                   qual='A')],
+             [dict(qname='Example_read_3', cause='manyNs')]),
+            ([], [dict(qname='Example_read_5', cause='2refs')]),
+            ([], [dict(qname='Example_read_6', cause='unmatched')])]
+
+        events = list(merge_ranges(self.remap_path,
+                                   aligned,
+                                   nthreads=2,
+                                   min_range_size=1))
+
+        self.assertEqual(expected_events, events)
+        self.assertEqual(expected_counts,
+                         [(rname, qcut, list(ranked_seqs))
+                          for rname, qcut, ranked_seqs
+                          in aligned.iter_ranked()])
+        self.assertEqual(['V3LOOP', 'INT'], list(aligned.regions))
+
+    def testMatesInDifferentBamRanges(self):
+        self.write_bam()
+        expected_aligned = AlignedCounts()
+        expected_events = list(merge_ranges(self.remap_path,
+                                            expected_aligned,
+                                            nthreads=2,
+                                            min_range_size=1))
+        aligned = AlignedCounts()
+
+        events = list(merge_ranges(self.bam_path,
+                                   aligned,
+                                   nthreads=2,
+                                   min_range_records=1))
+
+        self.assertEqual(10, len(load_index(self.bam_path)['chunks']))
+        self.assertEqual(expected_events, events)
+        self.assertEqual([(rname, qcut, list(ranked_seqs))
+                          for rname, qcut, ranked_seqs
+                          in expected_aligned.iter_ranked()],
+                         [(rname, qcut, list(ranked_seqs))
+                          for rname, qcut, ranked_seqs
+                          in aligned.iter_ranked()])
+
+    def testBamRangePath(self):
+        self.write_bam()
+
+        with open(self.bam_path, 'rb') as remap_bam:
+            range_path = get_range_path(remap_bam)
+        os.remove(self.bam_path + INDEX_SUFFIX)
+        with open(self.bam_path, 'rb') as remap_bam:
+            unindexed_path = get_range_path(remap_bam)
+        with open(self.bam_path + INDEX_SUFFIX, 'w'):
+            pass  # so tearDown can remove it
+
+        self.assertEqual(self.bam_path, range_path)
+        self.assertIsNone(unindexed_path)
+
+    def testSameOutputFromBam(self):
+        expected = self.run_sam2aln()
+        self.write_bam()
+
+        serial_outputs = self.run_sam2aln(self.bam_path)
+        outputs = self.run_sam2aln(self.bam_path, nthreads=2)
+
+        self.assertEqual(expected, serial_outputs)
+        self.assertEqual(expected, outputs)
+
+    def testPairingStats(self):
+        serial_stats = {}
+        range_stats = {}
+
+        self.run_sam2aln(merge_stats=serial_stats)
+        self.run_sam2aln(merge_stats=range_stats, nthreads=2)
+
+        # Example_read_4 is single, and Example_read_6 lost its mate
+        self.assertEqual(2, serial_stats['orphan_count'])
+        self.assertEqual(2, range_stats['orphan_count'])
+        self.assertEqual(0, serial_stats['spilled_count'])
+        self.assertEqual(0, range_stats['spilled_count'])
+
+    def testSameOutputInParallel(self):
+        expected = self.run_sam2aln()
+
+        outputs = self.run_sam2aln(nthreads=2)
+
+        self.assertEqual(expected, outputs)
+
+    def testDeltaEncoded(self):
+        expected_aligned = """\
+refname,qcut,rank,count,offset,length,delta
+V3LOOP,15,0,2,0,32,0TGTACAAGACCCAACAACAATACAAGAAAAAG
+V3LOOP,15,1,1,0,32,31C
+"""
+        plain_aligned = self.run_sam2aln()[0]
+
+        aligned = self.run_sam2aln(delta_encoded=True)[0]
+
+        self.assertMultiLineEqual(expected_aligned,
+                                  aligned.replace(os.linesep, '\n'))
+        self.assertEqual(list(DictReader(StringIO(plain_aligned))),
+                         list(read_aligned_rows(StringIO(aligned))))
+
+    def testSameOutputAfterSpilling(self):
+        expected = self.run_sam2aln()
+
+        outputs = self.run_sam2aln(max_counted_seqs=1)
+
+        self.assertEqual(expected, outputs)
@@ -0,0 +1,88 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from micall.utils.spilling_counter import SpillingCounter
+
+
+class SpillingCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def read_groups(self, counter, **kwargs):
+        return [(group, list(ranked_items))
+                for group, ranked_items in counter.iter_groups(**kwargs)]
+
+    def testInMemory(self):
+        counter = SpillingCounter(work_path=self.work_path)
+        counter.add('b', 'x')
+        counter.add('a', 'y')
+        counter.add('a', 'z', 2)
+        counter.update('a', {'y': 2, 'w': 1})
+        expected_groups = [('a', [('y', 3), ('z', 2), ('w', 1)]),
+                           ('b', [('x', 1)])]
+
+        groups = self.read_groups(counter)
+
+        self.assertEqual(expected_groups, groups)
+        self.assertEqual(0, counter.spill_count)
+        self.assertEqual(4, counter.max_item_count)
+
+    def testSpill(self):
+        counter = SpillingCounter(max_items=2, work_path=self.work_path)
+        counter.add('a', 'x')
+        counter.add('a', 'y')
+        counter.add('a', 'x')
+        counter.add('b', 'z')
+        counter.add('a', 'y', 3)
+        expected_groups = [('a', [('y', 4), ('x', 2)]),
+                           ('b', [('z', 1)])]
+
+        groups = self.read_groups(counter)
+
+        self.assertEqual(expected_groups, groups)
+        self.assertEqual(2, counter.spill_count)
+        self.assertEqual(2, counter.max_item_count)
+        self.assertEqual([], os.listdir(self.work_path))
+
+    def testRankKey(self):
+        counter = SpillingCounter(max_items=2, work_path=self.work_path)
+        counter.update(1, {'aaa': 1, 'b': 1, 'cc': 2})
+
+        groups = self.read_groups(counter,
+                                  key=lambda item, count: len(item))
+
+        self.assertEqual([(1, [('aaa', 1), ('cc', 2), ('b', 1)])], groups)
+
+    def testSameAsInMemory(self):
+        rand = random.Random(46)
+        items = [(rand.randint(0, 3), rand.choice('ABCDEFGHIJKLMNOP'))
+                 for _ in range(1000)]
+        expected_groups = None
+        for max_items in (1000, 5, 1):
+            counter = SpillingCounter(max_items, work_path=self.work_path)
+            for group, item in items:
+                counter.add(group, item)
+
+            groups = self.read_groups(counter)
+
+            if expected_groups is None:
+                expected_groups = groups
+            self.assertEqual(expected_groups, groups)
+            self.assertGreaterEqual(max_items, counter.max_item_count)
+
+    def testStopEarly(self):
+        counter = SpillingCounter(max_items=1, work_path=self.work_path)
+        counter.add('a', 'x')
+        counter.add('b', 'y')
+
+        for _group, ranked_items in counter.iter_groups():
+            break
+        counter.close()
+
+        self.assertEqual([], os.listdir(self.work_path))
@@ -1,5 +1,6 @@
 import unittest
-from micall.utils.translation import translate, reverse_and_complement
+from micall.utils.translation import translate, reverse_and_complement, \
+    amino_table
 
 
 class TranslateTest(unittest.TestCase):
@@ -175,6 +176,48 @@ class TranslateTest(unittest.TestCase):
         self.assertEqual(expected_aminos, aminos)
         self.assertEqual(expected_stats, stats)
 
+    def testUnusualCharacterWithMixture(self):
+        nucs = 'TTTAXN'
+        expected_aminos = 'F?'
+
+        aminos = translate(nucs, translate_mixtures=False)
+
+        self.assertEqual(expected_aminos, aminos)
+
+    def testUnusualCharacter(self):
+        nucs = 'TTTAXG'
+
+        with self.assertRaises(KeyError):
+            translate(nucs)
+
+    def testResolveIsSorted(self):
+        nucs = 'TTMTTC'
+        expected_aminos = 'FF'
+
+        aminos = translate(nucs, resolve=True)
+
+        self.assertEqual(expected_aminos, aminos)
+
+
+class AminoTableTest(unittest.TestCase):
+    def testPlainCodon(self):
+        self.assertEqual('F', amino_table['TTT'])
+
+    def testUnambiguousMixture(self):
+        self.assertEqual('L', amino_table['CTN'])
+
+    def testAmbiguousMixture(self):
+        self.assertEqual('?', amino_table['TTM'])
+
+    def testGaps(self):
+        self.assertEqual('-', amino_table['---'])
+        self.assertEqual('?', amino_table['T--'])
+
+    def testMatchesTranslate(self):
+        for codon, amino in amino_table.items():
+            # stats skips the table lookup
+            self.assertEqual(translate(codon, stats={}), amino, codon)
+
 
 class ReverseAndComplementTest(unittest.TestCase):
     def testSimple(self):
@@ -0,0 +1,205 @@
+"""
+Compact format for the merged reads in aligned.csv.
+
+Each row of aligned.csv holds a whole merged sequence, but most variants of a
+region only differ from each other at a few positions. In this format, each
+row only stores the runs of positions where it differs from a reference for
+its region and cutoff: substitutions, gaps, and Ns.
+
+The reference starts empty for each region and cutoff, and every row extends
+it to cover any positions the row covers that it didn't. Rows are written
+from most common to least, so the reference is mostly made of the common
+variants, and the reader rebuilds the same reference as it goes.
+
+The columns are refname, qcut, rank, count, offset, length, and delta.
+Offset and length give the span of the merged sequence, and delta is a list of
+runs, each one the number of positions to skip followed by the text that
+replaces the reference's text. Positions start at the offset, and the skip
+counts from the end of the previous run. For example, with the reference
+ACGTACGT at offset 0, the row with offset 2, length 5, and delta 0C2TT is the
+sequence CTATT. Positions outside the reference are gaps, so the first row
+of each group has a delta that holds all of its bases.
+"""
+
+from csv import DictReader, DictWriter
+import re
+
+DELTA_FIELDS = ['refname', 'qcut', 'rank', 'count', 'offset', 'length',
+                'delta']
+
+delta_pattern = re.compile(r'(\d+)(\D+)')  # skip count, then replacement text
+COMPARE_BLOCK_SIZE = 32  # positions to compare at once, looking for runs
+
+
+def encode_delta(seq, offset, reference, reference_offset):
+    """ Find the runs of positions where a sequence differs from a reference.
+
+    @param seq: the sequence, starting at offset
+    @param offset: the position where seq starts
+    @param reference: the reference sequence, starting at reference_offset
+    @param reference_offset: the position where reference starts
+    @return: the delta text
+    """
+    expected = get_reference_span(reference,
+                                  reference_offset,
+                                  offset,
+                                  len(seq))
+    runs = []
+    run_end = 0  # end of the previous run, relative to offset
+    run_start = None
+    for block_start in range(0, len(seq), COMPARE_BLOCK_SIZE):
+        block_end = block_start + COMPARE_BLOCK_SIZE
+        if (run_start is None and
+                seq[block_start:block_end] == expected[block_start:block_end]):
+            continue  # most blocks match, so skip the slow comparison
+        for i in range(block_start, min(block_end, len(seq))):
+            if seq[i] != expected[i]:
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                runs.append('{}{}'.format(run_start - run_end,
+                                          seq[run_start:i]))
+                run_end = i
+                run_start = None
+    if run_start is not None:
+        runs.append('{}{}'.format(run_start - run_end, seq[run_start:]))
+    return ''.join(runs)
+
+
+def decode_delta(delta, offset, length, reference, reference_offset):
+    """ Rebuild a sequence from its differences with a reference.
+
+    See encode_delta() for the parameters, and length is the length of the
+    sequence.
+    @return: the sequence, starting at offset
+    """
+    expected = get_reference_span(reference, reference_offset, offset, length)
+    parts = []
+    pos = 0
+    for skip, text in delta_pattern.findall(delta):
+        run_start = pos + int(skip)
+        parts.append(expected[pos:run_start])
+        parts.append(text)
+        pos = run_start + len(text)
+    parts.append(expected[pos:])
+    return ''.join(parts)
+
+
+def get_reference_span(reference, reference_offset, offset, length):
+    """ Get the piece of a reference that lines up with a sequence.
+
+    Positions outside the reference are filled with gaps.
+    """
+    start = offset - reference_offset
+    if start >= 0:
+        span = reference[start:start+length]
+    else:
+        span = '-' * -start + reference[:max(0, length+start)]
+    return span[:length] + '-' * (length - len(span))
+
+
+class DeltaReference(object):
+    def __init__(self):
+        """ Track the reference for a region and cutoff's rows. """
+        self.seq = ''
+        self.offset = 0
+
+    def encode(self, seq, offset):
+        """ Encode a row's sequence, and then add it to the reference.
+
+        @return: the delta text
+        """
+        delta = encode_delta(seq, offset, self.seq, self.offset)
+        self.add(seq, offset)
+        return delta
+
+    def decode(self, delta, offset, length):
+        """ Decode a row's sequence, and then add it to the reference.
+
+        @return: the sequence
+        """
+        seq = decode_delta(delta, offset, length, self.seq, self.offset)
+        self.add(seq, offset)
+        return seq
+
+    def add(self, seq, offset):
+        """ Extend the reference to cover a sequence's positions. """
+        if not self.seq:
+            self.seq = seq
+            self.offset = offset
+            return
+        end = offset + len(seq)
+        reference_end = self.offset + len(self.seq)
+        if offset < self.offset:
+            head = seq[:self.offset - offset]
+            head += '-' * (self.offset - offset - len(head))
+            self.seq = head + self.seq
+            self.offset = offset
+        if end > reference_end:
+            tail = seq[max(0, reference_end - offset):]
+            self.seq += '-' * (end - reference_end - len(tail)) + tail
+
+
+class DeltaWriter(object):
+    def __init__(self, handle, lineterminator='\r\n'):
+        """ Write aligned.csv rows in the delta format.
+
+        Takes the same rows as a csv.DictWriter for aligned.csv, so it can
+        replace one.
+        @param handle: an open text file
+        """
+        self.writer = DictWriter(handle,
+                                 DELTA_FIELDS,
+                                 lineterminator=lineterminator)
+        self.group = self.reference = None
+
+    def writeheader(self):
+        self.writer.writeheader()
+
+    def writerow(self, row):
+        seq = row['seq']
+        offset = int(row['offset'])
+        group = (row['refname'], row['qcut'])
+        if group != self.group:
+            self.group = group
+            self.reference = DeltaReference()
+        self.writer.writerow(dict(refname=row['refname'],
+                                  qcut=row['qcut'],
+                                  rank=row['rank'],
+                                  count=row['count'],
+                                  offset=offset,
+                                  length=len(seq),
+                                  delta=self.reference.encode(seq, offset)))
+
+
+def is_delta_format(fieldnames):
+    return fieldnames is not None and 'delta' in fieldnames
+
+
+def read_aligned_rows(handle):
+    """ Read aligned.csv rows in the plain or delta format.
+
+    @param handle: an open text file
+    @return: yields a dictionary for each row with the aligned.csv columns,
+        holding text like a csv.DictReader
+    """
+    reader = DictReader(handle)
+    if not is_delta_format(reader.fieldnames):
+        for row in reader:
+            yield row
+        return
+    group = reference = None
+    for row in reader:
+        row_group = (row['refname'], row['qcut'])
+        if row_group != group:
+            group = row_group
+            reference = DeltaReference()
+        seq = reference.decode(row['delta'],
+                               int(row['offset']),
+                               int(row['length']))
+        yield dict(refname=row['refname'],
+                   qcut=row['qcut'],
+                   rank=row['rank'],
+                   count=row['count'],
+                   offset=row['offset'],
+                   seq=seq)
@@ -0,0 +1,509 @@
+"""
+Map reads to small references without starting bowtie2.
+
+For short amplicon targets, most of the time spent in bowtie2 goes to
+starting processes, building an index, and writing SAM text. This mapper
+runs in the same process: the references' k-mers are indexed in a
+dictionary, each read's k-mers vote for a reference, strand, and diagonal,
+and the read is extended along the winning diagonal. If the votes are spread
+over more than one diagonal, there's probably an insertion or deletion, so
+the read is aligned with gotoh2 to a band of the reference around those
+diagonals.
+
+AmpliconMapper has the build() method of Bowtie2Build and the
+yield_mapping() method of Bowtie2, so the same object can replace both. It
+reads the bowtie2 options that the pipeline uses, and writes the same SAM
+fields and tags: flags, CIGAR with soft clipping, mapping quality, template
+length, and the AS and YT tags. Scores follow bowtie2's defaults, so the
+same reads pass the minimum score, but the alignments themselves can differ.
+Use bowtie2 for large references.
+"""
+
+from collections import Counter
+from math import log
+
+from micall.alignment.gotoh2 import Aligner
+from micall.utils.externals import open_fastq
+from micall.utils.translation import reverse_and_complement
+
+KMER_SIZE = 15        # length of the seeds looked up in the index
+KMER_STEP = 5         # distance between seeds taken from each read
+BAND_WIDTH = 15       # reference bases added on each side of the diagonals
+MAX_REPEATS = 20      # skip seeds that appear more often in the references
+
+MATCH_BONUS = 2       # bowtie2's --ma in local mode, 0 in end-to-end mode
+MISMATCH_PENALTY = 6  # bowtie2's --mp
+N_PENALTY = 1         # bowtie2's --np
+GAP_OPEN = 5          # bowtie2's --rdg and --rfg
+GAP_EXTEND = 3
+MAX_FRAGMENT = 500    # bowtie2's -X
+MAX_MAPQ = 42
+
+UNMAPPED_FLAG = 0x4
+
+
+class AmpliconMapper(object):
+    def __init__(self, logger=None, kmer_size=KMER_SIZE):
+        """ Initialize.
+
+        @param logger: not used, but accepted like bowtie2's wrappers
+        @param kmer_size: the length of the seeds to index
+        """
+        self.logger = logger
+        self.kmer_size = kmer_size
+        self.version = 'amplicon'
+        self.indexes = {}  # {reffile_template: ReferenceIndex}
+
+    def build(self, ref_path, reffile_template):
+        """ Build an index from a reference file.
+
+        @param ref_path: path to a FASTA file with reference sequences.
+        @param reffile_template: the name to find the index by, passed to
+            yield_mapping() with the -x option.
+        """
+        with open(ref_path) as ref_file:
+            refseqs = read_fasta(ref_file)
+        self.indexes[reffile_template] = ReferenceIndex(refseqs,
+                                                        self.kmer_size)
+
+    def yield_mapping(self,
+                      args,
+                      fastq1,
+                      fastq2=None,
+                      nthreads=1,
+                      shard_count=1,
+                      work_path='',
+                      stderr=None):
+        """ Map reads, and yield the SAM lines.
+
+        The parameters are the same as Bowtie2.yield_mapping(), but reads are
+        always mapped in this process, one at a time, and in order.
+        @param args: bowtie2 arguments, without the input files or -p
+        @param fastq1: FASTQ file with the forward or unpaired reads, may be
+            compressed if the name ends with .gz
+        @param fastq2: FASTQ file with the reverse reads, or None
+        """
+        settings = MapperSettings(args)
+        try:
+            index = self.indexes[settings.reffile_template]
+        except KeyError:
+            raise ValueError('No index was built for {!r}.'.format(
+                settings.reffile_template))
+        if settings.is_header_written:
+            yield '@HD\tVN:1.0\tSO:unsorted\n'
+            for rname, refseq in index.refseqs.items():
+                yield '@SQ\tSN:{}\tLN:{}\n'.format(rname, len(refseq))
+        aligner = Aligner(gop=settings.read_gap_open,
+                          gep=settings.read_gap_extend,
+                          is_global=False)
+        if fastq2 is None:
+            with open_fastq(fastq1) as reads:
+                for qname, seq, qual in read_fastq(reads):
+                    alignment = index.map_read(seq, settings, aligner)
+                    yield format_unpaired(qname, seq, qual, alignment)
+            return
+        with open_fastq(fastq1) as reads1, open_fastq(fastq2) as reads2:
+            for read1, read2 in zip(read_fastq(reads1), read_fastq(reads2)):
+                qname, seq1, qual1 = read1
+                _, seq2, qual2 = read2
+                alignment1 = index.map_read(seq1, settings, aligner)
+                alignment2 = index.map_read(seq2, settings, aligner)
+                for line in format_pair(qname,
+                                        (seq1, qual1, alignment1),
+                                        (seq2, qual2, alignment2),
+                                        settings):
+                    yield line
+
+
+class MapperSettings(object):
+    def __init__(self, args):
+        """ Read the settings from bowtie2 arguments. """
+        self.reffile_template = None
+        self.is_local = False
+        self.is_header_written = True
+        self.read_gap_open = self.ref_gap_open = GAP_OPEN
+        self.read_gap_extend = self.ref_gap_extend = GAP_EXTEND
+        self.max_fragment = MAX_FRAGMENT
+        args = list(args)
+        for i, arg in enumerate(args):
+            if arg == '-x':
+                self.reffile_template = args[i+1]
+            elif arg == '--local':
+                self.is_local = True
+            elif arg == '--no-hd':
+                self.is_header_written = False
+            elif arg == '--rdg':
+                self.read_gap_open, self.read_gap_extend = map(
+                    int,
+                    args[i+1].split(','))
+            elif arg == '--rfg':
+                self.ref_gap_open, self.ref_gap_extend = map(
+                    int,
+                    args[i+1].split(','))
+            elif arg == '-X':
+                self.max_fragment = int(args[i+1])
+        self.match_bonus = MATCH_BONUS if self.is_local else 0
+
+    def get_min_score(self, read_length):
+        """ Same as bowtie2's default --score-min. """
+        if self.is_local:
+            return 20 + 8 * log(read_length)
+        return -0.6 - 0.6 * read_length
+
+
+class ReadAlignment(object):
+    def __init__(self, rname, pos, cigar, score, is_reversed, end):
+        """ Initialize.
+
+        @param rname: the reference name
+        @param pos: the 1-based position of the first aligned base
+        @param cigar: the CIGAR string, including soft clipping
+        @param score: the alignment score
+        @param is_reversed: True if the reverse complement was aligned
+        @param end: the 1-based position of the last aligned base
+        """
+        self.rname = rname
+        self.pos = pos
+        self.cigar = cigar
+        self.score = score
+        self.is_reversed = is_reversed
+        self.end = end
+        self.mapq = MAX_MAPQ
+
+
+class ReferenceIndex(object):
+    def __init__(self, refseqs, kmer_size=KMER_SIZE):
+        """ Index all the k-mers in a set of references.
+
+        @param refseqs: {rname: sequence}
+        @param kmer_size: the length of the k-mers
+        """
+        self.refseqs = refseqs
+        self.kmer_size = kmer_size
+        self.kmers = {}  # {kmer: [(rname, start)]}
+        for rname, refseq in refseqs.items():
+            for start in range(len(refseq) - kmer_size + 1):
+                kmer = refseq[start:start+kmer_size]
+                self.kmers.setdefault(kmer, []).append((rname, start))
+
+    def find_diagonals(self, seq):
+        """ Count the seeds that support each diagonal on each strand.
+
+        @return: Counter {(rname, is_reversed, diagonal): seed_count}, where
+            diagonal is the 0-based reference position of the read's start
+        """
+        kmer_size = self.kmer_size
+        last_start = len(seq) - kmer_size
+        starts = list(range(0, last_start + 1, KMER_STEP))
+        if starts and starts[-1] != last_start:
+            starts.append(last_start)
+        votes = Counter()
+        for is_reversed in (False, True):
+            if is_reversed:
+                seq = reverse_and_complement(seq)
+            for offset in starts:
+                hits = self.kmers.get(seq[offset:offset+kmer_size])
+                if hits is None or len(hits) > MAX_REPEATS:
+                    continue
+                for rname, start in hits:
+                    votes[(rname, is_reversed, start - offset)] += 1
+        return votes
+
+    def map_read(self, seq, settings, aligner):
+        """ Find the best alignment for a read.
+
+        @return: a ReadAlignment, or None if the read didn't map
+        """
+        votes = self.find_diagonals(seq)
+        if not votes:
+            return None
+        # Group the diagonals by reference and strand, and try the two best.
+        clusters = {}
+        for (rname, is_reversed, diagonal), count in votes.most_common():
+            cluster = clusters.get((rname, is_reversed))
+            if cluster is None:
+                clusters[(rname, is_reversed)] = [count, [diagonal]]
+            elif abs(diagonal - cluster[1][0]) <= BAND_WIDTH:
+                cluster[0] += count
+                cluster[1].append(diagonal)
+        ranked = sorted(clusters.items(),
+                        key=lambda item: -item[1][0])[:2]
+        alignments = []
+        for (rname, is_reversed), (_count, diagonals) in ranked:
+            read_seq = reverse_and_complement(seq) if is_reversed else seq
+            alignment = self.extend(rname,
+                                    read_seq,
+                                    is_reversed,
+                                    diagonals,
+                                    settings,
+                                    aligner)
+            if alignment.score >= settings.get_min_score(len(seq)):
+                alignments.append(alignment)
+        if not alignments:
+            return None
+        alignments.sort(key=lambda a: -a.score)
+        best = alignments[0]
+        if len(alignments) > 1:
+            best.mapq = max(0, min(MAX_MAPQ,
+                                   best.score - alignments[1].score))
+        return best
+
+    def extend(self, rname, read_seq, is_reversed, diagonals, settings,
+               aligner):
+        """ Align a read to a reference around the diagonals its seeds hit.
+
+        @return: a ReadAlignment
+        """
+        refseq = self.refseqs[rname]
+        read_length = len(read_seq)
+        low, high = min(diagonals), max(diagonals)
+        if low == high:
+            # No sign of indels, so the read lines up with the reference.
+            ref_start = max(0, low)
+            aligned_ref = ('-' * max(0, -low) +
+                           refseq[max(0, low):low+read_length] +
+                           '-' * max(0, low + read_length - len(refseq)))
+            aligned_read = read_seq
+        else:
+            ref_start = max(0, low - BAND_WIDTH)
+            window = refseq[ref_start:high + read_length + BAND_WIDTH]
+            aligned_window, aligned_read, _score = aligner.align(window,
+                                                                 read_seq)
+            # The aligner replaces unknown letters, so restore them.
+            aligned_ref = restore_gaps(aligned_window, window)
+            aligned_read = restore_gaps(aligned_read, read_seq)
+        return score_alignment(rname,
+                               aligned_ref,
+                               aligned_read,
+                               ref_start,
+                               is_reversed,
+                               settings)
+
+
+def restore_gaps(aligned, original):
+    """ Replace the letters in an aligned sequence with the originals. """
+    letters = iter(original)
+    return ''.join(c if c == '-' else next(letters) for c in aligned)
+
+
+def score_alignment(rname, aligned_ref, aligned_read, ref_start, is_reversed,
+                    settings):
+    """ Score an alignment, trim it in local mode, and build its CIGAR.
+
+    @param aligned_ref: the reference, aligned to the read, with dashes for
+        insertions and for read bases that hang past the reference's ends
+    @param aligned_read: the read, aligned to the reference
+    @param ref_start: the 0-based reference position of the first
+        reference base in aligned_ref
+    @return: a ReadAlignment
+    """
+    # (operation, score, ref_position) for each column with a read base or
+    # a deletion. Read bases before the first aligned base or after the last
+    # one get soft clipped.
+    columns = []
+    ref_pos = ref_start
+    gap_type = None
+    for ref_char, read_char in zip(aligned_ref, aligned_read):
+        if ref_char == '-':
+            if read_char == '-':
+                continue
+            score = -settings.ref_gap_extend
+            if gap_type != 'I':
+                score -= settings.ref_gap_open
+            columns.append(('I', score, ref_pos))
+            gap_type = 'I'
+            continue
+        ref_pos += 1
+        if read_char == '-':
+            score = -settings.read_gap_extend
+            if gap_type != 'D':
+                score -= settings.read_gap_open
+            columns.append(('D', score, ref_pos))
+            gap_type = 'D'
+            continue
+        gap_type = None
+        if read_char == 'N' or ref_char == 'N':
+            score = -N_PENALTY
+        elif read_char == ref_char:
+            score = settings.match_bonus
+        else:
+            score = -MISMATCH_PENALTY
+        columns.append(('M', score, ref_pos))
+
+    # Leading and trailing deletions are just unaligned reference.
+    first = next((i for i, column in enumerate(columns)
+                  if column[0] == 'M'), None)
+    if first is None:
+        return ReadAlignment(rname, 0, '*', float('-inf'), is_reversed, 0)
+    last = max(i for i, column in enumerate(columns) if column[0] == 'M')
+    if settings.is_local:
+        first, last = find_best_segment(columns, first, last)
+    score = sum(column[1] for column in columns[first:last+1])
+    lead_clip = sum(1 for column in columns[:first] if column[0] != 'D')
+    tail_clip = sum(1 for column in columns[last+1:] if column[0] != 'D')
+    operations = []
+    if lead_clip:
+        operations.append(['S', lead_clip])
+    for operation, _score, _pos in columns[first:last+1]:
+        if operations and operations[-1][0] == operation:
+            operations[-1][1] += 1
+        else:
+            operations.append([operation, 1])
+    if tail_clip:
+        operations.append(['S', tail_clip])
+    cigar = ''.join('{}{}'.format(size, operation)
+                    for operation, size in operations)
+    return ReadAlignment(rname,
+                         columns[first][2],
+                         cigar,
+                         score,
+                         is_reversed,
+                         columns[last][2])
+
+
+def find_best_segment(columns, first, last):
+    """ Find the run of columns with the highest total score.
+
+    @return: (first, last) indexes of the best run, both aligned bases
+    """
+    best_score = best_first = best_last = None
+    run_score = 0
+    run_first = first
+    for i in range(first, last + 1):
+        operation, score, _pos = columns[i]
+        if run_score <= 0:
+            if operation != 'M':
+                continue
+            run_score = 0
+            run_first = i
+        run_score += score
+        if operation == 'M' and (best_score is None or run_score > best_score):
+            best_score = run_score
+            best_first = run_first
+            best_last = i
+    return best_first, best_last
+
+
+def read_fasta(ref_file):
+    """ Read reference sequences from a FASTA file.
+
+    @return: {name: sequence}, with names cut at the first space
+    """
+    refseqs = {}
+    name = None
+    parts = []
+    for line in ref_file:
+        line = line.strip()
+        if line.startswith('>'):
+            if name is not None:
+                refseqs[name] = ''.join(parts)
+            name = line[1:].split()[0]
+            parts = []
+        elif line:
+            parts.append(line.upper())
+    if name is not None:
+        refseqs[name] = ''.join(parts)
+    return refseqs
+
+
+def read_fastq(reads):
+    """ Yield (qname, seq, qual) for each read in a FASTQ file.
+
+    Query names are cut at the first space, and /1 or /2 suffixes are
+    removed, the same as bowtie2 does.
+    """
+    for header, seq, _, qual in zip(reads, reads, reads, reads):
+        qname = header[1:].split()[0]
+        if qname.endswith('/1') or qname.endswith('/2'):
+            qname = qname[:-2]
+        yield qname, seq.strip(), qual.strip()
+
+
+def format_unpaired(qname, seq, qual, alignment):
+    if alignment is None:
+        fields = [qname, UNMAPPED_FLAG, '*', 0, 0, '*', '*', 0, 0, seq, qual,
+                  'YT:Z:UU']
+    else:
+        if alignment.is_reversed:
+            seq = reverse_and_complement(seq)
+            qual = qual[::-1]
+        fields = [qname,
+                  0x10 if alignment.is_reversed else 0,
+                  alignment.rname,
+                  alignment.pos,
+                  alignment.mapq,
+                  alignment.cigar,
+                  '*',
+                  0,
+                  0,
+                  seq,
+                  qual,
+                  'AS:i:{}'.format(alignment.score),
+                  'YT:Z:UU']
+    return '\t'.join(map(str, fields)) + '\n'
+
+
+def format_pair(qname, read1, read2, settings):
+    """ Format SAM lines for both reads of a pair.
+
+    @param read1: (seq, qual, alignment) for the forward read, where
+        alignment is None if the read didn't map
+    @param read2: (seq, qual, alignment) for the reverse read
+    @return: [line1, line2]
+    """
+    alignment1 = read1[2]
+    alignment2 = read2[2]
+    pair_type = 'UP'
+    lengths = {}
+    if alignment1 is not None and alignment2 is not None:
+        pair_type = 'DP'
+        if alignment1.rname == alignment2.rname:
+            left = min(alignment1.pos, alignment2.pos)
+            right = max(alignment1.end, alignment2.end)
+            fragment_length = right - left + 1
+            if (alignment1.is_reversed != alignment2.is_reversed and
+                    fragment_length <= settings.max_fragment):
+                pair_type = 'CP'
+            if alignment1.pos <= alignment2.pos:
+                lengths = {1: fragment_length, 2: -fragment_length}
+            else:
+                lengths = {1: -fragment_length, 2: fragment_length}
+    lines = []
+    for read_number, (seq, qual, alignment), mate in ((1, read1, alignment2),
+                                                      (2, read2, alignment1)):
+        flag = 0x1 | (0x40 if read_number == 1 else 0x80)
+        if pair_type == 'CP':
+            flag |= 0x2
+        if mate is None:
+            flag |= 0x8
+        elif mate.is_reversed:
+            flag |= 0x20
+        if alignment is None:
+            flag |= UNMAPPED_FLAG
+            if mate is None:
+                location = ['*', 0, 0, '*', '*', 0, 0]
+            else:
+                location = [mate.rname, mate.pos, 0, '*', '=', mate.pos, 0]
+            tags = ['YT:Z:' + pair_type]
+        else:
+            if alignment.is_reversed:
+                flag |= 0x10
+                seq = reverse_and_complement(seq)
+                qual = qual[::-1]
+            if mate is None:
+                rnext, pnext = '=', alignment.pos
+            elif mate.rname == alignment.rname:
+                rnext, pnext = '=', mate.pos
+            else:
+                rnext, pnext = mate.rname, mate.pos
+            location = [alignment.rname,
+                        alignment.pos,
+                        alignment.mapq,
+                        alignment.cigar,
+                        rnext,
+                        pnext,
+                        lengths.get(read_number, 0)]
+            tags = ['AS:i:{}'.format(alignment.score), 'YT:Z:' + pair_type]
+        fields = [qname, flag] + location + [seq, qual] + tags
+        lines.append('\t'.join(map(str, fields)) + '\n')
+    return lines
@@ -0,0 +1,597 @@
+"""
+Read and write BAM files without samtools.
+
+BAM files are SAM records in a binary layout, compressed in BGZF blocks: a
+series of gzip members of up to 64 KiB each, so each block can be compressed
+and decompressed on its own. The writer and reader compress and decompress
+batches of blocks in parallel threads, because zlib releases the GIL.
+
+The writer always starts a new block between records, and writes an index
+next to the BAM file that lists which references each run of blocks holds.
+The records aren't sorted, so a standard BAI index can't describe them, but
+this index lets a reader fetch one reference's records without decompressing
+the whole file. Index layout, in JSON:
+    {"references": [name, ...],
+     "chunks": [[file_offset, record_count, [reference_id, ...]], ...]}
+The reference id -1 means unmapped reads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+import struct
+import zlib
+
+from micall.utils.packed_sam import FIELD_NAMES, FOUR_BIT_ALPHABET
+
+BAM_MAGIC = b'BAM\x01'
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+MAX_BLOCK_DATA = 0xff00  # uncompressed bytes in each BGZF block, like htslib
+BATCH_BLOCKS = 4  # blocks to compress or decompress per thread at once
+INDEX_SUFFIX = '.json'
+# An empty block marks the end of a BGZF file.
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000'
+                          '000000000000')
+
+# magic, mtime, extra flags, OS, extra length, 'BC', subfield length, bsize
+BGZF_HEADER = struct.Struct('<4sIBBH2sHH')
+BGZF_TRAILER = struct.Struct('<II')  # CRC32, uncompressed size
+# reference id, pos, read name length, mapq, bin, CIGAR op count, flag,
+# sequence length, next reference id, next pos, template length
+RECORD_HEADER = struct.Struct('<iiBBHHHIiii')
+INT32 = struct.Struct('<i')
+
+CIGAR_OPS = 'MIDNSHP=X'
+REFERENCE_OPS = set('MDN=X')  # ops that consume the reference
+cigar_pattern = re.compile(r'(\d+)([MIDNSHP=X])')
+
+
+def _build_tables():
+    encode_seq = bytearray([FOUR_BIT_ALPHABET.index(b'N')] * 256)
+    for code, letter in enumerate(FOUR_BIT_ALPHABET):
+        encode_seq[letter] = code
+        encode_seq[ord(chr(letter).lower())] = code
+    high_letters = bytes(FOUR_BIT_ALPHABET[byte >> 4] for byte in range(256))
+    low_letters = bytes(FOUR_BIT_ALPHABET[byte & 15] for byte in range(256))
+    encode_qual = bytes((byte - 33) % 256 for byte in range(256))
+    decode_qual = bytes((byte + 33) % 256 for byte in range(256))
+    return (bytes(encode_seq),
+            high_letters,
+            low_letters,
+            encode_qual,
+            decode_qual)
+
+
+(ENCODE_SEQ, HIGH_LETTERS, LOW_LETTERS, ENCODE_QUAL,
+ DECODE_QUAL) = _build_tables()
+
+
+def compress_block(data, level=6):
+    """ Compress up to MAX_BLOCK_DATA bytes into a BGZF block. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER.size + len(payload) + BGZF_TRAILER.size
+    return b''.join((BGZF_HEADER.pack(BGZF_MAGIC, 0, 0, 0xff, 6, b'BC', 2,
+                                      block_size - 1),
+                     payload,
+                     BGZF_TRAILER.pack(zlib.crc32(data), len(data))))
+
+
+def decompress_block(block):
+    """ Decompress a BGZF block, checking its CRC. """
+    extra_length, = struct.unpack_from('<H', block, 10)
+    payload_start = 12 + extra_length
+    data = zlib.decompress(block[payload_start:-BGZF_TRAILER.size], -15)
+    crc, size = BGZF_TRAILER.unpack_from(block, len(block) - BGZF_TRAILER.size)
+    if size != len(data) or crc != zlib.crc32(data):
+        raise ValueError('Corrupt BGZF block.')
+    return data
+
+
+def read_raw_block(handle):
+    """ Read the next compressed BGZF block.
+
+    @return: the block's bytes, or None at the end of the file
+    """
+    start = handle.read(12)
+    if len(start) < 12:
+        return None
+    if start[:4] != BGZF_MAGIC:
+        raise ValueError('Not a BGZF file.')
+    extra_length, = struct.unpack_from('<H', start, 10)
+    extra = handle.read(extra_length)
+    block_size = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        subfield_id = extra[pos:pos+2]
+        subfield_length, = struct.unpack_from('<H', extra, pos+2)
+        if subfield_id == b'BC':
+            block_size, = struct.unpack_from('<H', extra, pos+4)
+        pos += 4 + subfield_length
+    if block_size is None:
+        raise ValueError('BGZF block has no size.')
+    rest = handle.read(block_size + 1 - len(start) - len(extra))
+    return start + extra + rest
+
+
+class BgzfWriter(object):
+    def __init__(self, handle, threads=1, batch_blocks=BATCH_BLOCKS):
+        """ Write data in BGZF blocks, compressing batches in parallel.
+
+        @param handle: a file open for writing bytes
+        @param threads: the number of threads to compress blocks in
+        @param batch_blocks: the number of blocks each thread compresses
+            before the batch is written
+        """
+        self.handle = handle
+        self.threads = threads
+        self.batch_size = threads * batch_blocks
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending = []  # [(data, label)]
+        self.chunk_offsets = []  # [(file_offset, label)]
+        try:
+            self.offset = handle.tell()
+        except (AttributeError, IOError, OSError):
+            self.offset = 0
+
+    def write_chunk(self, data, label=None):
+        """ Write data, starting a new block.
+
+        @param data: the bytes to write
+        @param label: if not None, record the file offset where the chunk
+            starts in chunk_offsets, with this label
+        """
+        for start in range(0, len(data), MAX_BLOCK_DATA):
+            self.pending.append((data[start:start+MAX_BLOCK_DATA], label))
+            label = None
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Compress and write all the pending blocks. """
+        pieces = [data for data, _label in self.pending]
+        if self.executor is None:
+            blocks = map(compress_block, pieces)
+        else:
+            blocks = self.executor.map(compress_block, pieces)
+        for (_data, label), block in zip(self.pending, blocks):
+            if label is not None:
+                self.chunk_offsets.append((self.offset, label))
+            self.handle.write(block)
+            self.offset += len(block)
+        self.pending = []
+
+    def close(self):
+        """ Write the pending blocks and the end marker. Doesn't close the
+        file. """
+        self.flush()
+        self.handle.write(EOF_BLOCK)
+        self.offset += len(EOF_BLOCK)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class BgzfReader(object):
+    def __init__(self, handle, threads=1, batch_blocks=BATCH_BLOCKS):
+        """ Read data from BGZF blocks, decompressing batches in parallel.
+
+        @param handle: a file open for reading bytes, positioned at the
+            start of a block
+        @param threads: the number of threads to decompress blocks in
+        @param batch_blocks: the number of blocks for each thread to
+            decompress at once
+        """
+        self.handle = handle
+        self.threads = threads
+        self.batch_size = threads * batch_blocks
+
+    def iter_blocks(self):
+        """ Yield the decompressed data from each block. """
+        executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        try:
+            while True:
+                raw_blocks = []
+                while len(raw_blocks) < self.batch_size:
+                    raw_block = read_raw_block(self.handle)
+                    if raw_block is None:
+                        break
+                    raw_blocks.append(raw_block)
+                if not raw_blocks:
+                    break
+                if executor is None:
+                    blocks = map(decompress_block, raw_blocks)
+                else:
+                    blocks = executor.map(decompress_block, raw_blocks)
+                for data in blocks:
+                    yield data
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+class BlockStream(object):
+    def __init__(self, blocks):
+        """ Read a series of data blocks as one stream of bytes.
+
+        @param blocks: an iterator of bytes
+        """
+        self.blocks = blocks
+        self.buffer = b''
+        self.pos = 0
+
+    def read(self, size):
+        """ Read size bytes, or fewer at the end of the stream. """
+        end = self.pos + size
+        if end <= len(self.buffer):
+            data = self.buffer[self.pos:end]
+            self.pos = end
+            return data
+        parts = [self.buffer[self.pos:]]
+        available = len(parts[0])
+        for block in self.blocks:
+            parts.append(block)
+            available += len(block)
+            if available >= size:
+                break
+        self.buffer = b''.join(parts)
+        self.pos = min(size, len(self.buffer))
+        return self.buffer[:self.pos]
+
+
+def reg2bin(start, end):
+    """ Calculate the BAM bin for a zero-based, half-open span. """
+    end -= 1
+    for shift, first_bin in ((14, 4681), (17, 585), (20, 73), (23, 9),
+                             (26, 1)):
+        if start >> shift == end >> shift:
+            return first_bin + (start >> shift)
+    return 0
+
+
+def encode_seq(seq):
+    """ Pack a sequence into four bits per base. """
+    codes = seq.encode('ascii').translate(ENCODE_SEQ)
+    if len(codes) % 2:
+        codes += b'\x00'
+    size = len(codes) // 2
+    high = int.from_bytes(codes[0::2], 'big')
+    low = int.from_bytes(codes[1::2], 'big')
+    # Codes are below 16, so shifting doesn't carry into the next byte.
+    return ((high << 4) | low).to_bytes(size, 'big')
+
+
+def decode_seq(packed, length):
+    """ Unpack four bits per base into a sequence. """
+    letters = bytearray(2 * len(packed))
+    letters[0::2] = packed.translate(HIGH_LETTERS)
+    letters[1::2] = packed.translate(LOW_LETTERS)
+    return letters[:length].decode('ascii')
+
+
+class BamWriter(object):
+    """ Write SAM records to a BAM file. """
+    def __init__(self, handle, references, threads=1, index_path=None):
+        """ Initialize.
+
+        @param handle: a file open for writing bytes
+        @param references: [(name, length)] or {name: length} for the
+            references that records can map to
+        @param threads: the number of threads to compress blocks in
+        @param index_path: where to write the index, or None to skip it
+        """
+        if hasattr(references, 'items'):
+            references = sorted(references.items())
+        self.references = list(references)
+        self.reference_ids = {name: i
+                              for i, (name, _length)
+                              in enumerate(self.references)}
+        self.bgzf = BgzfWriter(handle, threads)
+        self.index_path = index_path
+        self.chunk = []
+        self.chunk_size = 0
+        self.chunk_reference_ids = set()
+        self.is_started = self.is_closed = False
+
+    def writeheader(self):
+        """ Write the BAM header, to match the csv.DictWriter interface. """
+        if self.is_started:
+            return
+        self.is_started = True
+        text = '@HD\tVN:1.6\tSO:unsorted\n' + ''.join(
+            '@SQ\tSN:{}\tLN:{}\n'.format(name, length)
+            for name, length in self.references)
+        text = text.encode('ascii')
+        parts = [BAM_MAGIC, INT32.pack(len(text)), text,
+                 INT32.pack(len(self.references))]
+        for name, length in self.references:
+            name = name.encode('ascii') + b'\x00'
+            parts.extend((INT32.pack(len(name)), name, INT32.pack(length)))
+        self.bgzf.write_chunk(b''.join(parts))
+
+    def writerow(self, row):
+        """ Write a record from a dictionary, like csv.DictWriter. """
+        self.write_fields([row[field] for field in FIELD_NAMES])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_fields(self, fields):
+        """ Write a record from a list of at least eleven SAM fields. """
+        self.writeheader()
+        (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq,
+         qual) = fields[:11]
+        reference_id = self._get_reference_id(rname)
+        if rnext == '=':
+            next_reference_id = reference_id
+        else:
+            next_reference_id = self._get_reference_id(rnext)
+        start = int(pos) - 1
+        if cigar == '*':
+            cigar_ops = []
+        else:
+            cigar_ops = [(int(length), CIGAR_OPS.index(op))
+                         for length, op in cigar_pattern.findall(cigar)]
+        reference_length = sum(length
+                               for length, op in cigar_ops
+                               if CIGAR_OPS[op] in REFERENCE_OPS)
+        bin_ = reg2bin(start, start + max(1, reference_length))
+        if seq == '*':
+            seq = ''
+        if qual == '*':
+            encoded_qual = b'\xff' * len(seq)
+        else:
+            encoded_qual = qual.encode('ascii').translate(ENCODE_QUAL)
+        qname = qname.encode('ascii') + b'\x00'
+        body = b''.join((
+            RECORD_HEADER.pack(reference_id,
+                               start,
+                               len(qname),
+                               int(mapq),
+                               bin_,
+                               len(cigar_ops),
+                               int(flag),
+                               len(seq),
+                               next_reference_id,
+                               int(pnext) - 1,
+                               int(tlen)),
+            qname,
+            struct.pack('<{}I'.format(len(cigar_ops)),
+                        *[length << 4 | op for length, op in cigar_ops]),
+            encode_seq(seq),
+            encoded_qual))
+        record = INT32.pack(len(body)) + body
+        if self.chunk and self.chunk_size + len(record) > MAX_BLOCK_DATA:
+            self._write_chunk()
+        self.chunk.append(record)
+        self.chunk_size += len(record)
+        self.chunk_reference_ids.add(reference_id)
+
+    def close(self):
+        """ Write the last records, the end marker, and the index. Doesn't
+        close the file. """
+        if self.is_closed:
+            return
+        self.writeheader()
+        self._write_chunk()
+        self.bgzf.close()
+        self.is_closed = True
+        if self.index_path is not None:
+            with open(self.index_path, 'w') as index_file:
+                json.dump(self.get_index(), index_file)
+
+    def get_index(self):
+        """ Describe which references each chunk of records holds. """
+        chunks = [[offset, record_count, sorted(reference_ids)]
+                  for offset, (record_count, reference_ids)
+                  in self.bgzf.chunk_offsets]
+        return dict(references=[name for name, _length in self.references],
+                    chunks=chunks)
+
+    def _get_reference_id(self, name):
+        if name == '*':
+            return -1
+        try:
+            return self.reference_ids[name]
+        except KeyError:
+            raise ValueError(
+                'Reference {!r} is not in the BAM header.'.format(name))
+
+    def _write_chunk(self):
+        if not self.chunk:
+            return
+        self.bgzf.write_chunk(b''.join(self.chunk),
+                              (len(self.chunk), self.chunk_reference_ids))
+        self.chunk = []
+        self.chunk_size = 0
+        self.chunk_reference_ids = set()
+
+
+class BamReader(object):
+    """ Read SAM records from a BAM file. """
+    def __init__(self, handle, threads=1, index=None):
+        """ Initialize, and read the header.
+
+        @param handle: a file open for reading bytes, positioned at the start
+        @param threads: the number of threads to decompress blocks in
+        @param index: the index written with the file, or None to load it
+            from next to the file when fetch() needs it
+        """
+        self.handle = handle
+        self.threads = threads
+        self.index = index
+        self.stream = BlockStream(BgzfReader(handle, threads).iter_blocks())
+        if self.stream.read(4) != BAM_MAGIC:
+            raise ValueError('Not a BAM file.')
+        text_length, = INT32.unpack(self.stream.read(4))
+        self.header_text = self.stream.read(text_length).decode('ascii')
+        reference_count, = INT32.unpack(self.stream.read(4))
+        self.references = []
+        for _ in range(reference_count):
+            name_length, = INT32.unpack(self.stream.read(4))
+            name = self.stream.read(name_length)[:-1].decode('ascii')
+            length, = INT32.unpack(self.stream.read(4))
+            self.references.append((name, length))
+        self.names = [name for name, _length in self.references]
+
+    def __iter__(self):
+        return self.iter_fields()
+
+    def iter_fields(self):
+        """ Yield each record as a list of eleven SAM fields. """
+        return self._read_records(self.stream)
+
+    def iter_rows(self):
+        """ Yield each record as a dictionary, like csv.DictReader. """
+        for fields in self.iter_fields():
+            yield dict(zip(FIELD_NAMES, fields))
+
+    def fetch(self, rname):
+        """ Yield the records that mapped to a reference, using the index.
+
+        Without an index, read the whole file and skip the other records.
+        Seeks in the file, so don't mix it with iter_fields().
+        @param rname: the reference name, or '*' for unmapped reads
+        """
+        if self.index is None:
+            self.index = load_index(getattr(self.handle, 'name', None))
+        if self.index is None:
+            for fields in self.iter_fields():
+                if fields[2] == rname:
+                    yield fields
+            return
+        if rname == '*':
+            reference_id = -1
+        elif rname in self.names:
+            reference_id = self.names.index(rname)
+        else:
+            return
+        for offset, record_count, reference_ids in self.index['chunks']:
+            if reference_id not in reference_ids:
+                continue
+            for fields in self.iter_chunk_fields(offset, record_count):
+                if fields[2] == rname:
+                    yield fields
+
+    def iter_chunk_fields(self, offset, record_count):
+        """ Yield the records from a run of chunks in the index.
+
+        Seeks in the file, so don't mix it with iter_fields().
+        @param offset: the file offset where the first chunk starts
+        @param record_count: the number of records to read from there
+        """
+        self.handle.seek(offset)
+        # read a few blocks at a time, to stop near the end of the chunks
+        stream = BlockStream(BgzfReader(self.handle,
+                                        self.threads,
+                                        batch_blocks=1).iter_blocks())
+        return self._read_records(stream, record_count)
+
+    def iter_chunk_rows(self, offset, record_count):
+        """ Yield records from a run of chunks as dictionaries.
+
+        See iter_chunk_fields() for the parameters.
+        """
+        for fields in self.iter_chunk_fields(offset, record_count):
+            yield dict(zip(FIELD_NAMES, fields))
+
+    def _read_records(self, stream, record_count=None):
+        names = self.names
+        header_size = RECORD_HEADER.size
+        while record_count is None or record_count > 0:
+            size_bytes = stream.read(4)
+            if len(size_bytes) < 4:
+                break
+            if record_count is not None:
+                record_count -= 1
+            block_size, = INT32.unpack(size_bytes)
+            record = stream.read(block_size)
+            (reference_id, start, qname_length, mapq, _bin, cigar_count, flag,
+             seq_length, next_reference_id, next_start,
+             tlen) = RECORD_HEADER.unpack_from(record)
+            pos = header_size + qname_length
+            qname = record[header_size:pos-1].decode('ascii')
+            cigar_ops = struct.unpack_from('<{}I'.format(cigar_count),
+                                           record,
+                                           pos)
+            pos += 4*cigar_count
+            cigar = ''.join('{}{}'.format(op >> 4, CIGAR_OPS[op & 15])
+                            for op in cigar_ops) or '*'
+            packed_size = (seq_length + 1) // 2
+            seq = decode_seq(record[pos:pos+packed_size], seq_length) or '*'
+            pos += packed_size
+            qual = record[pos:pos+seq_length]
+            if not qual or qual[0] == 0xff:
+                qual = '*'
+            else:
+                qual = qual.translate(DECODE_QUAL).decode('ascii')
+            rname = '*' if reference_id < 0 else names[reference_id]
+            if next_reference_id < 0:
+                rnext = '*'
+            elif next_reference_id == reference_id:
+                rnext = '='
+            else:
+                rnext = names[next_reference_id]
+            yield [qname,
+                   str(flag),
+                   rname,
+                   str(start + 1),
+                   str(mapq),
+                   cigar,
+                   rnext,
+                   str(next_start + 1),
+                   str(tlen),
+                   seq,
+                   qual]
+
+
+def is_bam(handle):
+    """ Check whether a binary file starts with a BGZF block.
+
+    Leaves the file where it was.
+    """
+    start = handle.read(len(BGZF_MAGIC))
+    handle.seek(-len(start), 1)
+    return start == BGZF_MAGIC
+
+
+def is_bam_path(path):
+    return isinstance(path, str) and path.endswith('.bam')
+
+
+def find_chunk_ranges(index, range_count, min_range_size=1):
+    """ Group the chunks in a BAM file's index into ranges of records.
+
+    Chunks end wherever a block filled up, so mates can end up in different
+    ranges, and the caller has to pair those up.
+    @param index: the index written with the BAM file
+    @param range_count: the number of ranges to aim for
+    @param min_range_size: the fewest records in a range
+    @return: [(offset, record_count)] the file offset where each range
+        starts, and the number of records it holds
+    """
+    chunks = index['chunks']
+    total_count = sum(record_count for _offset, record_count, _ids in chunks)
+    range_size = max(min_range_size, total_count // range_count + 1)
+    ranges = []
+    for offset, record_count, _reference_ids in chunks:
+        if ranges and ranges[-1][1] < range_size:
+            ranges[-1][1] += record_count
+        else:
+            ranges.append([offset, record_count])
+    return [(offset, record_count) for offset, record_count in ranges]
+
+
+def load_index(bam_path):
+    """ Load the index written next to a BAM file.
+
+    @return: the index, or None if there isn't one
+    """
+    if bam_path is None:
+        return None
+    try:
+        with open(bam_path + INDEX_SUFFIX) as index_file:
+            return json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return None
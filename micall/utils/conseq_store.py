@@ -0,0 +1,59 @@
+"""
+Keep the remap consensus sequences from earlier runs.
+
+Samples from the same patient are sequenced again and again, and their
+consensus sequences barely change. Starting the remap from the last run's
+consensus instead of the generic seeds usually converges in one iteration.
+
+The store is a folder with one CSV file for each key, like a sample or a
+patient identifier, in the same format as the remap_conseq_csv output.
+"""
+
+import csv
+import os
+import re
+
+
+class ConseqStore(object):
+    def __init__(self, store_path):
+        """ Initialize.
+
+        @param store_path: the folder to keep the consensus files in, created
+            if it doesn't exist
+        """
+        self.store_path = store_path
+        if not os.path.isdir(store_path):
+            os.makedirs(store_path)
+
+    def get_path(self, key):
+        """ Find the file name for a key, without any path characters. """
+        safe_key = re.sub(r'[^\w.-]', '_', key)
+        return os.path.join(self.store_path, safe_key + '.csv')
+
+    def load(self, key):
+        """ Load the consensus sequences stored for a key.
+
+        @param key: the sample or patient identifier
+        @return: {region: sequence}, empty if nothing was stored
+        """
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return {row['region']: row['sequence']
+                    for row in csv.DictReader(f)}
+
+    def save(self, key, conseqs):
+        """ Store the consensus sequences for a key, replacing any old ones.
+
+        @param key: the sample or patient identifier
+        @param conseqs: {region: sequence}
+        """
+        path = self.get_path(key)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write('region,sequence\n')
+            for region in sorted(conseqs):
+                f.write('%s,%s\n' % (region, conseqs[region]))
+        # don't leave a partial file if the run fails while writing
+        os.rename(temp_path, path)
@@ -0,0 +1,176 @@
+"""
+Share a machine's processors between bowtie2 and worker pools.
+
+On shared cluster nodes, a job usually gets fewer processors than the
+machine has, either through its processor affinity or through a cgroup CPU
+quota. Each step that starts threads or processes reserves cores from one
+budget, and gives them back when it's done, so the next step can use them.
+"""
+
+from contextlib import contextmanager
+import math
+import os
+import re
+import threading
+
+CGROUP_PATH = '/sys/fs/cgroup'
+NUMA_NODE_PATH = '/sys/devices/system/node'
+
+
+def count_available_cpus(cgroup_path=CGROUP_PATH):
+    """ Count the processors this process may use.
+
+    Checks the processor affinity, and CPU quotas from cgroup v2 or v1.
+    @param cgroup_path: where the cgroup file system is mounted
+    @return: the number of processors, at least 1
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 1
+    quota = read_cgroup_quota(cgroup_path)
+    if quota is not None:
+        cpu_count = min(cpu_count, quota)
+    return max(1, cpu_count)
+
+
+def read_cgroup_quota(cgroup_path=CGROUP_PATH):
+    """ Read the CPU quota from cgroup v2 or v1.
+
+    @return: the quota, rounded up to whole processors, or None if there is
+        no limit
+    """
+    try:
+        with open(os.path.join(cgroup_path, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max':
+            return None
+        return int(math.ceil(int(quota) / float(period)))
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(cgroup_path, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(cgroup_path, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return int(math.ceil(quota / float(period)))
+
+
+def read_numa_cpu_sets(node_path=NUMA_NODE_PATH):
+    """ Find the processors on each NUMA node that this process may use.
+
+    @param node_path: where the kernel lists the NUMA nodes
+    @return: a list of processor sets, one for each node that has any
+        available processors, or None if there are fewer than two
+    """
+    try:
+        node_names = sorted((name
+                             for name in os.listdir(node_path)
+                             if re.match(r'node\d+$', name)),
+                            key=lambda name: int(name[4:]))
+    except (IOError, OSError):
+        return None
+    if hasattr(os, 'sched_getaffinity'):
+        available = os.sched_getaffinity(0)
+    else:
+        available = None
+    cpu_sets = []
+    for node_name in node_names:
+        try:
+            with open(os.path.join(node_path, node_name, 'cpulist')) as f:
+                cpu_set = parse_cpu_list(f.read())
+        except (IOError, OSError, ValueError):
+            continue
+        if available is not None:
+            cpu_set &= available
+        if cpu_set:
+            cpu_sets.append(cpu_set)
+    return cpu_sets if len(cpu_sets) > 1 else None
+
+
+def parse_cpu_list(text):
+    """ Parse a list of processors, like 0-3,8,10-11.
+
+    @return: a set of processor numbers
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class CpuBudget(object):
+    def __init__(self, total=None):
+        """ Initialize.
+
+        @param total: the number of cores to hand out, or None to count the
+            available processors
+        """
+        self.total = total or count_available_cpus()
+        self.available = self.total
+        self.condition = threading.Condition()
+
+    def acquire(self, count, minimum=1):
+        """ Take cores from the budget, waiting if too few are free.
+
+        @param count: the number of cores wanted, limited to the total
+        @param minimum: the fewest cores that are useful
+        @return: the number of cores granted, at least minimum and at most
+            count. Give them back with release().
+        """
+        count = max(1, min(count, self.total))
+        minimum = max(1, min(minimum, count))
+        with self.condition:
+            while self.available < minimum:
+                self.condition.wait()
+            granted = min(count, self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, granted):
+        """ Give cores back to the budget. """
+        with self.condition:
+            self.available += granted
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, count, minimum=1):
+        """ Hold some cores while running a step.
+
+            with budget.reserve(4) as thread_count:
+                run_bowtie2(thread_count)
+
+        See acquire() for the parameters.
+        """
+        granted = self.acquire(count, minimum)
+        try:
+            yield granted
+        finally:
+            self.release(granted)
+
+    @contextmanager
+    def reserve_pipeline(self, count, minimum=1):
+        """ Hold some cores for a step and the workers that consume its output.
+
+        Both run at the same time, so the cores are split between them.
+
+            with budget.reserve_pipeline(4) as (thread_count, worker_count):
+                lines = run_bowtie2(thread_count)
+                count_lines(lines, worker_count)
+
+        See acquire() for the parameters.
+        @return: (producer_count, consumer_count) that add up to the cores
+            granted. The producer always gets at least one, and the
+            consumers get half, rounded down, so they get none when only
+            one core is granted.
+        """
+        with self.reserve(count, minimum) as granted:
+            consumer_count = granted // 2
+            yield granted - consumer_count, consumer_count
@@ -1,8 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from itertools import cycle, islice
+from queue import Queue
 import subprocess
 import os
 import sys
 import re
 import shutil
+import threading
+
+from micall.utils.cpu_budget import read_numa_cpu_sets
+
+SHARD_SIZE = 100000  # read pairs in each chunk of a sharded bowtie2 run
 
 
 class AssetWrapper(object):
@@ -165,6 +174,192 @@ class Bowtie2(CommandWrapper):
         self.version = stdout.split('\n')[0].split()[-1]
         #self.validate_version(version_found)
 
+    def yield_mapping(self,
+                      args,
+                      fastq1,
+                      fastq2=None,
+                      nthreads=1,
+                      shard_count=1,
+                      work_path='',
+                      stderr=None):
+        """ Map reads with bowtie2, and yield the SAM lines.
+
+        @param args: bowtie2 arguments, without the input files or -p
+        @param fastq1: FASTQ file with the forward or unpaired reads
+        @param fastq2: FASTQ file with the reverse reads, or None
+        @param nthreads: the number of threads to use in total
+        @param shard_count: the number of bowtie2 processes to split the reads
+            between, see yield_sharded_output(). On machines with more than
+            one NUMA node, the processes take turns running on each node.
+        @param work_path: folder to write any temporary files in
+        @param stderr: where to write the standard error from bowtie2
+        """
+        if shard_count > 1:
+            return self.yield_sharded_output(
+                args,
+                fastq1,
+                fastq2,
+                shard_count=shard_count,
+                threads_per_shard=max(1, nthreads // shard_count),
+                work_path=work_path,
+                cpu_sets=read_numa_cpu_sets(),
+                stderr=stderr)
+        if fastq2 is None:
+            inputs = ['-U', fastq1]
+        else:
+            inputs = ['-1', fastq1, '-2', fastq2]
+        return self.yield_output(list(args) + inputs + ['-p', str(nthreads)],
+                                 stderr=stderr)
+
+    def yield_sharded_output(self,
+                             args,
+                             fastq1,
+                             fastq2=None,
+                             shard_count=2,
+                             threads_per_shard=1,
+                             work_path='',
+                             shard_size=SHARD_SIZE,
+                             reorder=False,
+                             cpu_sets=None,
+                             stderr=None):
+        """ Split the reads into chunks, and map them in several processes.
+
+        Output is yielded one chunk at a time in the same order as the chunks
+        in the FASTQ files, so mates stay next to each other. Chunks further
+        along are mapped while the earlier ones are being read.
+        @param args: bowtie2 arguments, without the input files or -p
+        @param fastq1: FASTQ file with the forward or unpaired reads, may be
+            compressed if the name ends with .gz
+        @param fastq2: FASTQ file with the reverse reads, or None
+        @param shard_count: the number of bowtie2 processes to run at once
+        @param threads_per_shard: the -p option for each bowtie2 process
+        @param work_path: folder to write the chunk files in
+        @param shard_size: the number of reads in each chunk
+        @param reorder: True if the output has to be in the same order as
+            the input files, instead of just keeping chunks in order
+        @param cpu_sets: a list of CPU sets to pin the processes to, for
+            example one for each NUMA node. Processes cycle through the sets.
+        @param stderr: where to write the standard error from bowtie2
+        """
+        shard_args = list(args) + ['-p', str(threads_per_shard)]
+        if reorder:
+            shard_args.append('--reorder')
+        sources = [fastq1] if fastq2 is None else [fastq1, fastq2]
+        cpu_sets = cycle(cpu_sets) if cpu_sets else None
+        jobs = Queue(maxsize=shard_count)
+        is_stopped = threading.Event()
+
+        def map_shard(shard_paths, sam_path, cpu_set):
+            if len(shard_paths) == 1:
+                inputs = ['-U', shard_paths[0]]
+            else:
+                inputs = ['-1', shard_paths[0], '-2', shard_paths[1]]
+            preexec_fn = None
+            if cpu_set is not None and hasattr(os, 'sched_setaffinity'):
+                def preexec_fn():
+                    os.sched_setaffinity(0, cpu_set)
+            with open(sam_path, 'w') as sam_file:
+                p = self.create_process(shard_args + inputs,
+                                        stdout=sam_file,
+                                        stderr=stderr,
+                                        preexec_fn=preexec_fn)
+                p.wait()
+            for shard_path in shard_paths:
+                os.remove(shard_path)
+            if p.returncode:
+                os.remove(sam_path)
+                raise subprocess.CalledProcessError(
+                    p.returncode,
+                    self.build_args(shard_args + inputs))
+            return sam_path
+
+        def split_reads(executor):
+            try:
+                for shard_index in range(sys.maxsize):
+                    shard_paths = [
+                        os.path.join(work_path,
+                                     'shard{}_R{}.fastq'.format(shard_index,
+                                                                 direction))
+                        for direction in range(1, len(sources)+1)]
+                    read_count = 0
+                    for reader, shard_path in zip(readers, shard_paths):
+                        with open(shard_path, 'w') as shard_file:
+                            lines = islice(reader, shard_size*4)
+                            read_count = write_lines(shard_file, lines) // 4
+                    if read_count == 0 or is_stopped.is_set():
+                        for shard_path in shard_paths:
+                            os.remove(shard_path)
+                        break
+                    sam_path = os.path.join(work_path,
+                                            'shard{}.sam'.format(shard_index))
+                    cpu_set = next(cpu_sets) if cpu_sets else None
+                    jobs.put(executor.submit(map_shard,
+                                             shard_paths,
+                                             sam_path,
+                                             cpu_set))
+            except Exception as ex:
+                split_errors.append(ex)
+            finally:
+                jobs.put(None)
+
+        readers = [open_fastq(source) for source in sources]
+        split_errors = []
+        executor = ThreadPoolExecutor(max_workers=shard_count)
+        splitter = threading.Thread(target=split_reads, args=(executor,))
+        splitter.daemon = True
+        splitter.start()
+        sam_path = None
+        job = True
+        try:
+            while job is not None:
+                job = jobs.get()
+                if job is None:
+                    break
+                sam_path = job.result()
+                with open(sam_path) as sam_file:
+                    for line in sam_file:
+                        yield line
+                os.remove(sam_path)
+                sam_path = None
+            if split_errors:
+                raise split_errors[0]
+        finally:
+            is_stopped.set()
+            if sam_path is not None:
+                os.remove(sam_path)
+            while job is not None:
+                # abandoned early, so clean up after the rest of the jobs
+                job = jobs.get()
+                if job is not None:
+                    remove_finished_output(job)
+            splitter.join()
+            executor.shutdown(wait=True)
+            for reader in readers:
+                reader.close()
+
+
+def open_fastq(path):
+    """ Open a FASTQ file for reading text, decompressing .gz files. """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+
+def write_lines(target, lines):
+    """ Write lines to a file, and return how many were written. """
+    line_count = 0
+    for line_count, line in enumerate(lines, 1):
+        target.write(line)
+    return line_count
+
+
+def remove_finished_output(job):
+    """ Wait for an abandoned shard job, and delete its output. """
+    try:
+        os.remove(job.result())
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
 
 class Bowtie2Build(CommandWrapper):
     def __init__(self,
@@ -0,0 +1,190 @@
+"""
+Pair up the mates in a stream of SAM records.
+
+bowtie2 writes the two mates of a pair next to each other, so most pairs can
+be matched by holding on to a single record. Records that arrive out of
+order wait in a cache keyed by query name. If the cache grows past its
+limit, its records are spilled to bucket files on disk, chosen by a hash of
+the query name, and each bucket is paired up separately at the end of the
+stream. That keeps memory bounded when a deep sample has many reads whose
+mates never show up.
+
+Pairs are yielded in the same order as a plain dictionary of cached records
+would yield them, unless records were spilled. Then the pairs with a mate on
+disk come after all the others. Unpaired records always come last, in the
+order they were read.
+"""
+
+from heapq import merge
+from operator import itemgetter
+import os
+import pickle
+import shutil
+import tempfile
+from zlib import crc32
+
+MAX_CACHED_ROWS = 200000  # out-of-order records to hold before spilling
+BUCKET_COUNT = 64         # files to spill records into
+
+
+class MatePairer(object):
+    """ Pair up mates by query name, and count how they were found.
+
+    Statistics from the last call to pair():
+    adjacent_count: pairs whose mates were next to each other
+    cached_count: pairs whose mates were found in the cache
+    spilled_count: records spilled to disk
+    spilled_pair_count: pairs found after spilling to disk
+    orphan_count: records whose mate never showed up
+    max_cached_count: the most records held in the cache at once
+    """
+    def __init__(self,
+                 get_qname=itemgetter(0),
+                 max_cached_rows=MAX_CACHED_ROWS,
+                 bucket_count=BUCKET_COUNT,
+                 work_path=None):
+        """ Initialize.
+
+        @param get_qname: a function that returns the query name of a record
+        @param max_cached_rows: the most out-of-order records to hold in
+            memory before spilling them to disk
+        @param bucket_count: the number of files to spill records into
+        @param work_path: the folder to create spill files in, or None for
+            the system's temporary folder
+        """
+        self.get_qname = get_qname
+        self.max_cached_rows = max_cached_rows
+        self.bucket_count = bucket_count
+        self.work_path = work_path
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.adjacent_count = 0
+        self.cached_count = 0
+        self.spilled_count = 0
+        self.spilled_pair_count = 0
+        self.orphan_count = 0
+        self.max_cached_count = 0
+
+    def pair(self, rows, include_singles=True):
+        """ Match up mates.
+
+        @param rows: a sequence of records, in any order
+        @param include_singles: True if unpaired records should be yielded,
+            paired with None: (row, None)
+        @return: yields (row1, row2) for each pair, in the order they
+            arrived.
+        """
+        self.reset_stats()
+        get_qname = self.get_qname
+        cached_rows = {}  # {qname: (row_number, row)}
+        spill_path = None
+        spill_files = None
+        pending_qname = pending = None
+        row_number = 0
+        try:
+            for row_number, row in enumerate(rows):
+                qname = get_qname(row)
+                if pending is not None:
+                    if qname == pending_qname:
+                        self.adjacent_count += 1
+                        yield pending[1], row
+                        pending = None
+                        continue
+                    cached_rows[pending_qname] = pending
+                    pending = None
+                    if len(cached_rows) > self.max_cached_count:
+                        self.max_cached_count = len(cached_rows)
+                    if len(cached_rows) >= self.max_cached_rows:
+                        if spill_files is None:
+                            spill_path = tempfile.mkdtemp(prefix='mates',
+                                                          dir=self.work_path)
+                            spill_files = [
+                                open(self._get_bucket_path(spill_path, i),
+                                     'wb')
+                                for i in range(self.bucket_count)]
+                        self._spill(cached_rows, spill_files)
+                old_row = cached_rows.pop(qname, None)
+                if old_row is not None:
+                    self.cached_count += 1
+                    yield old_row[1], row
+                else:
+                    pending_qname = qname
+                    pending = (row_number, row)
+            if pending is not None:
+                cached_rows[pending_qname] = pending
+
+            if spill_files is None:
+                self.orphan_count = len(cached_rows)
+                if include_singles:
+                    for _, row in cached_rows.values():
+                        yield row, None
+                return
+
+            self._spill(cached_rows, spill_files)
+            for spill_file in spill_files:
+                spill_file.close()
+            spill_files = None
+            for pair in self._pair_spilled(spill_path, include_singles):
+                yield pair
+        finally:
+            if spill_files is not None:
+                for spill_file in spill_files:
+                    spill_file.close()
+            if spill_path is not None:
+                shutil.rmtree(spill_path)
+
+    def _get_bucket_path(self, spill_path, bucket):
+        return os.path.join(spill_path, 'bucket{}.pickle'.format(bucket))
+
+    def _spill(self, cached_rows, spill_files):
+        """ Move all the cached records into bucket files. """
+        for qname, (row_number, row) in cached_rows.items():
+            bucket = crc32(qname.encode('utf8')) % self.bucket_count
+            pickle.dump((row_number, qname, row),
+                        spill_files[bucket],
+                        pickle.HIGHEST_PROTOCOL)
+        self.spilled_count += len(cached_rows)
+        cached_rows.clear()
+
+    def _pair_spilled(self, spill_path, include_singles):
+        """ Pair up the records in each bucket file.
+
+        Unpaired records from each bucket are written to another file, and
+        then all of those files are merged in the order the records arrived.
+        """
+        single_paths = []
+        for bucket in range(self.bucket_count):
+            bucket_path = self._get_bucket_path(spill_path, bucket)
+            cached_rows = {}
+            for row_number, qname, row in self._load(bucket_path):
+                old_row = cached_rows.pop(qname, None)
+                if old_row is None:
+                    cached_rows[qname] = (row_number, row)
+                else:
+                    self.spilled_pair_count += 1
+                    yield old_row[1], row
+            os.remove(bucket_path)
+            self.orphan_count += len(cached_rows)
+            if include_singles and cached_rows:
+                single_path = bucket_path + '.singles'
+                with open(single_path, 'wb') as single_file:
+                    for single in sorted(cached_rows.values(),
+                                         key=itemgetter(0)):
+                        pickle.dump(single,
+                                    single_file,
+                                    pickle.HIGHEST_PROTOCOL)
+                single_paths.append(single_path)
+        singles = merge(*map(self._load, single_paths), key=itemgetter(0))
+        for _, row in singles:
+            yield row, None
+
+    @staticmethod
+    def _load(path):
+        """ Read all the records that were pickled into a file. """
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
@@ -0,0 +1,527 @@
+"""
+Compact binary format for the SAM records passed between pipeline stages.
+
+The CSV versions of the SAM files (prelim.csv and remap.csv) store every field
+as text, and every stage parses them again. This format packs the same eleven
+fields: sequences use two bits per base, quality scores are raw bytes, numbers
+are binary, and reference names are stored once and referred to by number.
+
+Records are written in blocks, and each block stores its fields in columns:
+the fixed-size numbers for all the records, then all the read names, all the
+CIGAR strings, all the sequences, and all the quality strings. That way, the
+reader decodes each column with a few calls that run at C speed, and just
+slices each record's fields out of them. Sequences in a block are packed
+together in two bits per base, and any runs of other letters, like N, are
+stored separately and patched back in. If a block has too many other letters,
+its sequences use four bits per base, or aren't packed at all.
+
+An index at the end of the file lists the reference names, and which
+references each block holds, so a reader can seek to one reference's records
+without reading the rest of the file.
+
+Layout:
+    magic
+    name record: b'N', uint16 id, uint16 length, name
+    block: b'B', uint32 record count, uint32 byte size, then the column sizes,
+        record headers, read names, CIGARs, sequences, and qualities
+    sequences: uint8 encoding, uint32 packed size, uint32 run count, packed
+        sequences, uint32 start and end of each run of other letters, then
+        the letters in the runs
+    index: b'I', uint32 block count, uint16 name count, then for each name:
+        uint16 length, name, and then for each block: uint64 offset,
+        uint32 record count, uint16 name count, uint16 name ids
+    uint64 offset of the index, magic
+"""
+
+import io
+from csv import DictReader, DictWriter
+import os
+import re
+import struct
+
+MAGIC = b'MCSAM\x02'
+BLOCK_SIZE = 4096  # records in each block
+FIELD_NAMES = ['qname', 'flag', 'rname', 'pos', 'mapq', 'cigar', 'rnext',
+               'pnext', 'tlen', 'seq', 'qual']
+
+NO_NAME = 0xFFFF  # '*' in an RNAME or RNEXT field
+SAME_NAME = 0xFFFE  # '=' in an RNEXT field
+
+RAW_SEQ = 0
+TWO_BIT_SEQ = 2
+FOUR_BIT_SEQ = 4
+MAX_OTHER_FRACTION = 1/16.  # other letters allowed in two-bit sequences
+
+NAME_HEADER = struct.Struct('<cHH')
+BLOCK_HEADER = struct.Struct('<cII')
+# bytes of read names, CIGARs, sequence section, and qualities
+COLUMN_SIZES = struct.Struct('<IIII')
+SEQ_HEADER = struct.Struct('<BII')  # encoding, packed size, run count
+INDEX_HEADER = struct.Struct('<cIH')
+INDEX_ENTRY = struct.Struct('<QIH')
+TRAILER = struct.Struct('<Q')
+
+# flag, rname, pos, mapq, rnext, pnext, tlen, qname length, cigar length,
+# seq length, qual length
+RECORD_HEADER = struct.Struct('<HHiBHiiHHII')
+
+TWO_BIT_ALPHABET = b'ACGT'
+FOUR_BIT_ALPHABET = b'=ACMGRSVTWYHKDBN'  # same codes as BAM
+other_letters_pattern = re.compile(b'[^ACGT]+')
+
+
+def _build_encoding(alphabet, default=None):
+    if default is None:
+        codes = bytearray(range(256))
+    else:
+        codes = bytearray([default]) * 256
+    for code, letter in enumerate(alphabet):
+        codes[letter] = code
+    return bytes(codes)
+
+
+def _build_lanes(alphabet, encoding):
+    """ Build a table for each position in a packed byte, that translates
+    the byte to the letter at that position. """
+    per_byte = 8 // encoding
+    mask = (1 << encoding) - 1
+    return [bytes(alphabet[(byte >> (encoding * (per_byte - i - 1))) & mask]
+                  for byte in range(256))
+            for i in range(per_byte)]
+
+
+TWO_BIT_CODES = _build_encoding(TWO_BIT_ALPHABET, default=0)
+FOUR_BIT_CODES = _build_encoding(FOUR_BIT_ALPHABET)
+FOUR_BIT_LETTER_SET = set(FOUR_BIT_ALPHABET)
+LANES = {TWO_BIT_SEQ: _build_lanes(TWO_BIT_ALPHABET, TWO_BIT_SEQ),
+         FOUR_BIT_SEQ: _build_lanes(FOUR_BIT_ALPHABET, FOUR_BIT_SEQ)}
+
+
+def pack_seq(seq):
+    """ Pack a sequence into two or four bits per base.
+
+    The packing works on whole sequences as big integers, so it runs at C
+    speed instead of looping over each base.
+    @param seq: the sequence as ASCII bytes
+    @return: (encoding, packed_bytes)
+    """
+    if not seq.strip(TWO_BIT_ALPHABET):
+        return TWO_BIT_SEQ, _pack_codes(seq.translate(TWO_BIT_CODES),
+                                        TWO_BIT_SEQ)
+    if set(seq) <= FOUR_BIT_LETTER_SET:
+        return FOUR_BIT_SEQ, _pack_codes(seq.translate(FOUR_BIT_CODES),
+                                         FOUR_BIT_SEQ)
+    return RAW_SEQ, seq
+
+
+def _pack_codes(codes, encoding):
+    per_byte = 8 // encoding
+    packed_size = (len(codes) + per_byte - 1) // per_byte
+    codes += bytes(packed_size*per_byte - len(codes))
+    packed = 0
+    for i in range(per_byte):
+        # each byte of a lane is less than 16, so shifting a whole lane
+        # never carries bits into the next byte.
+        lane = int.from_bytes(codes[i::per_byte], 'big')
+        packed |= lane << (encoding * (per_byte - i - 1))
+    return packed.to_bytes(packed_size, 'big')
+
+
+def unpack_seq(encoding, packed, length):
+    """ Reverse pack_seq().
+
+    @param encoding: RAW_SEQ, TWO_BIT_SEQ, or FOUR_BIT_SEQ
+    @param packed: the packed bytes
+    @param length: the number of bases in the sequence
+    @return: the sequence as ASCII bytes
+    """
+    return bytes(_unpack_letters(encoding, packed, length))
+
+
+def _unpack_letters(encoding, packed, length):
+    if encoding == RAW_SEQ:
+        return bytearray(packed)
+    lanes = LANES[encoding]
+    per_byte = len(lanes)
+    letters = bytearray(len(packed) * per_byte)
+    for i, lane in enumerate(lanes):
+        letters[i::per_byte] = packed.translate(lane)
+    del letters[length:]
+    return letters
+
+
+def pack_seq_column(seqs):
+    """ Pack all the sequences in a block together.
+
+    @param seqs: the sequences joined together, as ASCII bytes
+    @return: the packed section, see the layout in the module docstring
+    """
+    other_count = len(seqs.translate(None, TWO_BIT_ALPHABET))
+    if other_count > len(seqs) * MAX_OTHER_FRACTION:
+        encoding, packed = pack_seq(seqs)
+        runs = []
+    else:
+        encoding = TWO_BIT_SEQ
+        packed = _pack_codes(seqs.translate(TWO_BIT_CODES), TWO_BIT_SEQ)
+        runs = [match.span() for match in other_letters_pattern.finditer(seqs)]
+    run_bounds = [bound for run in runs for bound in run]
+    return b''.join([SEQ_HEADER.pack(encoding, len(packed), len(runs)),
+                     packed,
+                     struct.pack('<{}I'.format(len(run_bounds)), *run_bounds)]
+                    + [seqs[start:end] for start, end in runs])
+
+
+def unpack_seq_column(section, length):
+    """ Reverse pack_seq_column().
+
+    @param length: the number of bases in all the sequences
+    @return: the sequences joined together, as ASCII bytes
+    """
+    encoding, packed_size, run_count = SEQ_HEADER.unpack_from(section)
+    start = SEQ_HEADER.size
+    end = start + packed_size
+    letters = _unpack_letters(encoding, section[start:end], length)
+    run_bounds = struct.unpack_from('<{}I'.format(2*run_count), section, end)
+    text_start = end + 8*run_count
+    for i in range(0, len(run_bounds), 2):
+        run_start, run_end = run_bounds[i], run_bounds[i+1]
+        text_end = text_start + run_end - run_start
+        letters[run_start:run_end] = section[text_start:text_end]
+        text_start = text_end
+    return bytes(letters)
+
+
+class PackedSamWriter(object):
+    """ Write SAM records to a binary file in the packed format. """
+    def __init__(self, handle, block_size=BLOCK_SIZE):
+        """ Initialize.
+
+        @param handle: a file open for writing bytes
+        @param block_size: the number of records in each block
+        """
+        self.handle = handle
+        self.block_size = block_size
+        self.name_ids = {}
+        self.headers = []
+        self.qnames = []
+        self.cigars = []
+        self.seqs = []
+        self.quals = []
+        self.block_name_ids = set()
+        self.index = []  # [(offset, record_count, name_ids)]
+        self.is_started = self.is_closed = False
+
+    def writeheader(self):
+        """ Write the magic number, to match the csv.DictWriter interface. """
+        if not self.is_started:
+            self.handle.write(MAGIC)
+            self.is_started = True
+
+    def writerow(self, row):
+        """ Write a record from a dictionary, like csv.DictWriter. """
+        self.write_fields([row[field] for field in FIELD_NAMES])
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_fields(self, fields):
+        """ Write a record from a list of at least eleven SAM fields. """
+        self.writeheader()
+        (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq,
+         qual) = fields[:11]
+        rname_id = self._get_name_id(rname)
+        if rnext == '=':
+            rnext_id = SAME_NAME
+        else:
+            rnext_id = self._get_name_id(rnext)
+        self.block_name_ids.add(rname_id)
+        qname = qname.encode('ascii')
+        cigar = cigar.encode('ascii')
+        seq = seq.encode('ascii')
+        qual = qual.encode('ascii')
+        self.headers.append(RECORD_HEADER.pack(int(flag),
+                                               rname_id,
+                                               int(pos),
+                                               int(mapq),
+                                               rnext_id,
+                                               int(pnext),
+                                               int(tlen),
+                                               len(qname),
+                                               len(cigar),
+                                               len(seq),
+                                               len(qual)))
+        self.qnames.append(qname)
+        self.cigars.append(cigar)
+        self.seqs.append(seq)
+        self.quals.append(qual)
+        if len(self.headers) >= self.block_size:
+            self._write_block()
+
+    def close(self):
+        """ Write the last block and the index. Doesn't close the file. """
+        if self.is_closed:
+            return
+        self.writeheader()
+        self._write_block()
+        index_offset = self.handle.tell()
+        names = sorted(self.name_ids, key=self.name_ids.get)
+        self.handle.write(INDEX_HEADER.pack(b'I', len(self.index), len(names)))
+        for name in names:
+            encoded_name = name.encode('ascii')
+            self.handle.write(struct.pack('<H', len(encoded_name)))
+            self.handle.write(encoded_name)
+        for offset, record_count, name_ids in self.index:
+            self.handle.write(INDEX_ENTRY.pack(offset,
+                                               record_count,
+                                               len(name_ids)))
+            self.handle.write(struct.pack('<{}H'.format(len(name_ids)),
+                                          *sorted(name_ids)))
+        self.handle.write(TRAILER.pack(index_offset))
+        self.handle.write(MAGIC)
+        self.is_closed = True
+
+    def _get_name_id(self, name):
+        if name == '*':
+            return NO_NAME
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.name_ids)
+            encoded_name = name.encode('ascii')
+            self.handle.write(NAME_HEADER.pack(b'N',
+                                               name_id,
+                                               len(encoded_name)))
+            self.handle.write(encoded_name)
+        return name_id
+
+    def _write_block(self):
+        if not self.headers:
+            return
+        qnames = b''.join(self.qnames)
+        cigars = b''.join(self.cigars)
+        seqs = pack_seq_column(b''.join(self.seqs))
+        quals = b''.join(self.quals)
+        payload = b''.join((COLUMN_SIZES.pack(len(qnames),
+                                              len(cigars),
+                                              len(seqs),
+                                              len(quals)),
+                            b''.join(self.headers),
+                            qnames,
+                            cigars,
+                            seqs,
+                            quals))
+        record_count = len(self.headers)
+        self.index.append((self.handle.tell(),
+                           record_count,
+                           self.block_name_ids))
+        self.handle.write(BLOCK_HEADER.pack(b'B', record_count, len(payload)))
+        self.handle.write(payload)
+        self.headers = []
+        self.qnames = []
+        self.cigars = []
+        self.seqs = []
+        self.quals = []
+        self.block_name_ids = set()
+
+
+class PackedSamReader(object):
+    """ Read SAM records from a binary file in the packed format. """
+    def __init__(self, handle):
+        """ Initialize.
+
+        @param handle: a file open for reading bytes, positioned at the start
+        """
+        self.handle = handle
+        magic = handle.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('Not a packed SAM file.')
+        self.names = {NO_NAME: '*', SAME_NAME: '='}
+        self.index = None
+
+    def __iter__(self):
+        return self.iter_fields()
+
+    def iter_fields(self):
+        """ Yield each record as a list of eleven SAM fields. """
+        for block in self.iter_blocks():
+            for fields in block:
+                yield fields
+
+    def iter_rows(self):
+        """ Yield each record as a dictionary, like csv.DictReader. """
+        for block in self.iter_blocks(as_dicts=True):
+            for row in block:
+                yield row
+
+    def iter_blocks(self, as_dicts=False):
+        """ Yield lists of records, one block at a time.
+
+        Blocks are a convenient batch size to hand to other processes.
+        @param as_dicts: True if each record should be a dictionary, like
+            csv.DictReader, otherwise a list of eleven SAM fields
+        """
+        handle = self.handle
+        while True:
+            tag = handle.read(1)
+            if tag == b'N':
+                self._read_name()
+            elif tag == b'B':
+                yield self._read_block(as_dicts)
+            else:
+                break
+
+    def fetch(self, rname):
+        """ Yield the records that mapped to a reference, using the index.
+
+        Only the blocks that hold the reference are read.
+        @param rname: the reference name
+        """
+        if self.index is None:
+            self._read_index()
+        name_id = self.name_ids.get(rname)
+        if name_id is None:
+            return
+        for offset, name_ids in self.index:
+            if name_id not in name_ids:
+                continue
+            self.handle.seek(offset)
+            self.handle.read(1)
+            for fields in self._read_block():
+                if fields[2] == rname:
+                    yield fields
+
+    def _read_name(self):
+        name_id, length = struct.unpack('<HH', self.handle.read(4))
+        self.names[name_id] = self.handle.read(length).decode('ascii')
+
+    def _read_block(self, as_dicts=False):
+        """ Read a block's records.
+
+        @param as_dicts: True if each record should be a dictionary, like
+            csv.DictReader, otherwise a list of eleven SAM fields
+        """
+        record_count, size = struct.unpack('<II', self.handle.read(8))
+        payload = self.handle.read(size)
+        qnames_size, cigars_size, seqs_size, quals_size = \
+            COLUMN_SIZES.unpack_from(payload)
+        start = COLUMN_SIZES.size
+        end = start + record_count*RECORD_HEADER.size
+        headers = list(RECORD_HEADER.iter_unpack(payload[start:end]))
+        start, end = end, end + qnames_size
+        qnames = payload[start:end].decode('ascii')
+        start, end = end, end + cigars_size
+        cigars = payload[start:end].decode('ascii')
+        start, end = end, end + seqs_size
+        seq_length = sum(header[9] for header in headers)
+        seqs = unpack_seq_column(payload[start:end], seq_length).decode('ascii')
+        start, end = end, end + quals_size
+        quals = payload[start:end].decode('ascii')
+
+        names = self.names
+        records = []
+        qname_start = cigar_start = seq_start = qual_start = 0
+        for (flag, rname_id, pos, mapq, rnext_id, pnext, tlen, qname_length,
+             cigar_length, seq_length, qual_length) in headers:
+            qname_end = qname_start + qname_length
+            cigar_end = cigar_start + cigar_length
+            seq_end = seq_start + seq_length
+            qual_end = qual_start + qual_length
+            qname = qnames[qname_start:qname_end]
+            cigar = cigars[cigar_start:cigar_end]
+            seq = seqs[seq_start:seq_end]
+            qual = quals[qual_start:qual_end]
+            if as_dicts:
+                # a dictionary display is faster than dict(zip(...))
+                records.append({'qname': qname,
+                                'flag': str(flag),
+                                'rname': names[rname_id],
+                                'pos': str(pos),
+                                'mapq': str(mapq),
+                                'cigar': cigar,
+                                'rnext': names[rnext_id],
+                                'pnext': str(pnext),
+                                'tlen': str(tlen),
+                                'seq': seq,
+                                'qual': qual})
+            else:
+                records.append([qname,
+                                str(flag),
+                                names[rname_id],
+                                str(pos),
+                                str(mapq),
+                                cigar,
+                                names[rnext_id],
+                                str(pnext),
+                                str(tlen),
+                                seq,
+                                qual])
+            qname_start = qname_end
+            cigar_start = cigar_end
+            seq_start = seq_end
+            qual_start = qual_end
+        return records
+
+    def _read_index(self):
+        handle = self.handle
+        handle.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+        index_offset, = TRAILER.unpack(handle.read(TRAILER.size))
+        handle.seek(index_offset)
+        _tag, block_count, name_count = INDEX_HEADER.unpack(
+            handle.read(INDEX_HEADER.size))
+        self.name_ids = {}
+        for name_id in range(name_count):
+            length, = struct.unpack('<H', handle.read(2))
+            name = handle.read(length).decode('ascii')
+            self.names[name_id] = name
+            self.name_ids[name] = name_id
+        self.index = []
+        for _ in range(block_count):
+            offset, _record_count, name_count = INDEX_ENTRY.unpack(
+                handle.read(INDEX_ENTRY.size))
+            name_ids = struct.unpack('<{}H'.format(name_count),
+                                     handle.read(2*name_count))
+            self.index.append((offset, set(name_ids)))
+
+
+def is_binary(handle):
+    return not isinstance(handle, io.TextIOBase)
+
+
+def create_sam_writer(handle, fieldnames=FIELD_NAMES, references=None,
+                      threads=1):
+    """ Create a writer for SAM records in CSV, packed, or BAM format.
+
+    @param handle: an open file. Text files get a csv.DictWriter, binary
+        files whose names end in .bam get a BamWriter, and other binary
+        files get a PackedSamWriter. Call close() on a binary writer when
+        all the rows are written.
+    @param references: {name: length} for all the references that records
+        can map to, needed for BAM files
+    @param threads: the number of threads to compress BAM blocks in
+    """
+    if is_binary(handle):
+        from micall.utils.bam import BamWriter, INDEX_SUFFIX, is_bam_path
+        path = getattr(handle, 'name', None)
+        if is_bam_path(path):
+            return BamWriter(handle,
+                             references or {},
+                             threads,
+                             index_path=path + INDEX_SUFFIX)
+        return PackedSamWriter(handle)
+    return DictWriter(handle, fieldnames, lineterminator=os.linesep)
+
+
+def read_sam_rows(handle, threads=1):
+    """ Read SAM records from CSV, packed, or BAM format as dictionaries.
+
+    @param handle: an open file. Text files are read as CSV, and binary files
+        are read as BAM if they start with a BGZF block, otherwise in the
+        packed format.
+    @param threads: the number of threads to decompress BAM blocks in
+    """
+    if is_binary(handle):
+        from micall.utils.bam import BamReader, is_bam
+        if is_bam(handle):
+            return BamReader(handle, threads).iter_rows()
+        return PackedSamReader(handle).iter_rows()
+    return DictReader(handle)
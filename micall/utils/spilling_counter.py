@@ -0,0 +1,199 @@
+"""
+Count items in groups, with a bounded amount of memory.
+
+Diverse samples can have millions of distinct merged sequences, and holding
+a counter for all of them at once can run out of memory. Once the counters
+hold too many distinct items, they are written to disk as a run sorted by
+group and item, and cleared. At the end, the runs are merged with the
+counters that are still in memory, so each item's counts are added up. The
+items in each group are then ranked, again spilling sorted runs to disk if a
+single group has too many of them.
+
+The results are the same as counting everything in memory and sorting it.
+"""
+
+from collections import Counter
+from heapq import merge
+from itertools import groupby
+from operator import itemgetter
+import os
+import pickle
+import shutil
+import tempfile
+
+MAX_COUNTED_ITEMS = 1000000  # distinct items to hold before spilling
+
+
+def rank_by_count(item, count):
+    return count, item
+
+
+class SpillingCounter(object):
+    """ Count items in groups, and spill the counts to disk when they grow.
+
+    Statistics:
+    spill_count: the number of runs spilled to disk while counting
+    spilled_item_count: the number of counts written in those runs
+    max_item_count: the most distinct items held in memory at once
+    """
+    def __init__(self, max_items=MAX_COUNTED_ITEMS, work_path=None):
+        """ Initialize.
+
+        @param max_items: the most distinct items to hold in memory before
+            spilling them to disk
+        @param work_path: the folder to create spill files in, or None for
+            the system's temporary folder
+        """
+        self.max_items = max_items
+        self.work_path = work_path
+        self.counts = {}  # {group: Counter({item: count})}
+        self.item_count = 0
+        self.spill_path = None
+        self.run_paths = []
+        self.spill_count = 0
+        self.spilled_item_count = 0
+        self.max_item_count = 0
+
+    def add(self, group, item, count=1):
+        """ Count an item in a group.
+
+        @param group: any value that can be sorted and pickled, like a tuple
+        @param item: a value that can be sorted and pickled, like a string
+        @param count: the number to add to the item's count
+        """
+        counter = self.counts.get(group)
+        if counter is None:
+            counter = self.counts[group] = Counter()
+        if item not in counter:
+            self.item_count += 1
+            if self.item_count > self.max_item_count:
+                self.max_item_count = self.item_count
+        counter[item] += count
+        if self.item_count >= self.max_items:
+            self.spill()
+
+    def update(self, group, counts):
+        """ Count several items in a group.
+
+        @param counts: {item: count}
+        """
+        for item, count in counts.items():
+            self.add(group, item, count)
+
+    def spill(self):
+        """ Write the counts in memory to a sorted run on disk. """
+        if not self.counts:
+            return
+        run_path = self._write_run(sorted(self._iter_counts()))
+        self.run_paths.append(run_path)
+        self.spill_count += 1
+        self.spilled_item_count += self.item_count
+        self.counts.clear()
+        self.item_count = 0
+
+    def iter_groups(self, key=rank_by_count):
+        """ Add up all the counts, and rank the items in each group.
+
+        Finish with each group's ranked items before moving on to the next
+        group.
+        @param key: a function that takes an item and its count, and returns
+            the value to rank them by, highest first
+        @return: yields (group, ranked_items) in order of group, where
+            ranked_items yields (item, count)
+        """
+        try:
+            if not self.run_paths:
+                for group in sorted(self.counts):
+                    yield group, self._rank(self.counts[group].items(), key)
+                return
+            runs = [self._load(run_path) for run_path in self.run_paths]
+            runs.append(sorted(self._iter_counts()))
+            totals = self._add_up(merge(*runs))
+            for group, entries in groupby(totals, key=itemgetter(0)):
+                ranked_items = self._rank(((item, count)
+                                           for _, item, count in entries),
+                                          key)
+                yield group, ranked_items
+                for _ in ranked_items:
+                    pass  # skip any items the caller didn't read
+        finally:
+            self.close()
+
+    def close(self):
+        """ Forget all the counts, and remove any spill files. """
+        self.counts.clear()
+        self.item_count = 0
+        self.run_paths = []
+        if self.spill_path is not None:
+            shutil.rmtree(self.spill_path)
+            self.spill_path = None
+
+    def _iter_counts(self):
+        for group, counter in self.counts.items():
+            for item, count in counter.items():
+                yield group, item, count
+
+    @staticmethod
+    def _add_up(entries):
+        """ Add up the counts of the same item in neighbouring entries. """
+        entries = iter(entries)
+        try:
+            group, item, count = next(entries)
+        except StopIteration:
+            return
+        for next_group, next_item, next_count in entries:
+            if next_item == item and next_group == group:
+                count += next_count
+            else:
+                yield group, item, count
+                group, item, count = next_group, next_item, next_count
+        yield group, item, count
+
+    def _rank(self, entries, key):
+        """ Sort (item, count) entries from highest key to lowest.
+
+        Groups with too many items are sorted in runs on disk, and then the
+        runs are merged.
+        """
+        def sort_key(entry):
+            return key(*entry)
+
+        chunk = []
+        run_paths = []
+        try:
+            for entry in entries:
+                chunk.append(entry)
+                if len(chunk) >= self.max_items:
+                    chunk.sort(key=sort_key, reverse=True)
+                    run_paths.append(self._write_run(chunk))
+                    chunk = []
+            chunk.sort(key=sort_key, reverse=True)
+            runs = [self._load(run_path) for run_path in run_paths]
+            runs.append(chunk)
+            for entry in merge(*runs, key=sort_key, reverse=True):
+                yield entry
+        finally:
+            for run_path in run_paths:
+                if os.path.exists(run_path):
+                    os.remove(run_path)
+
+    def _write_run(self, entries):
+        if self.spill_path is None:
+            self.spill_path = tempfile.mkdtemp(prefix='counts',
+                                               dir=self.work_path)
+        handle, run_path = tempfile.mkstemp(suffix='.pickle',
+                                            dir=self.spill_path)
+        with os.fdopen(handle, 'wb') as run_file:
+            for entry in entries:
+                pickle.dump(entry, run_file, pickle.HIGHEST_PROTOCOL)
+        return run_path
+
+    @staticmethod
+    def _load(path):
+        """ Read all the entries that were pickled into a file. """
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
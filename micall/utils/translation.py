@@ -1,6 +1,7 @@
 """
 Utility function for translating nucleotides (codons) into amino acids.
 """
+from itertools import product
 import re
 
 codon_dict = {'TTT': 'F', 'TTC': 'F', 'TTA': 'L', 'TTG': 'L',
@@ -31,6 +32,55 @@ complement_dict = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A',
                    'W': 'S', 'R': 'Y', 'K': 'M', 'Y': 'R', 'S': 'W', 'M': 'K',
                    'B': 'V', 'D': 'H', 'H': 'D', 'V': 'B',
                    '*': '*', 'N': 'N', '-': '-'}
+CODON_ALPHABET = 'ACGT' + ''.join(mixture_dict)
+
+# kinds of codon in codon_table
+PLAIN_CODON = 'plain'  # no mixtures
+MIXED_CODON = 'mixed'  # mixtures or a single gap
+GAP_CODON = 'gap'  # three gaps
+PARTIAL_CODON = 'partial'  # two gaps, or a ?
+
+
+def _get_codon_kind(codon):
+    """ Classify a codon of three upper case characters. """
+    if codon.count('-') > 1 or '?' in codon:
+        return GAP_CODON if codon == '---' else PARTIAL_CODON
+    if mixture_regex.search(codon):
+        return MIXED_CODON
+    return PLAIN_CODON
+
+
+def _resolve_codon(codon, kind):
+    """ Find all the amino acids a codon could code for.
+
+    @param codon: three upper case characters
+    @param kind: the codon's kind from _get_codon_kind()
+    @return: a sorted tuple of amino acids
+    @raise KeyError: if the codon has an unknown character
+    """
+    if kind == GAP_CODON:
+        return '-',
+    if kind == PARTIAL_CODON:
+        return ()
+    resolutions = product(*(mixture_dict.get(nuc, nuc) for nuc in codon))
+    return tuple(sorted({codon_dict[''.join(resolution)]
+                         for resolution in resolutions}))
+
+
+def _build_codon_table():
+    table = {}
+    for codon in map(''.join, product(CODON_ALPHABET, repeat=3)):
+        kind = _get_codon_kind(codon)
+        table[codon] = kind, _resolve_codon(codon, kind)
+    return table
+
+
+# {codon: (kind, aminos)} for every codon of nucleotides, mixtures, and gaps
+codon_table = _build_codon_table()
+# {codon: amino} with translate()'s default settings
+amino_table = {codon: ('?' if kind == PARTIAL_CODON or len(aminos) > 1
+                       else aminos[0])
+               for codon, (kind, aminos) in codon_table.items()}
 
 
 def reverse_and_complement(seq):
@@ -66,79 +116,63 @@ def translate(seq,
     if type(seq) == bytes:
         seq = seq.decode('utf-8')
     seq = '-'*offset + seq.upper()
+    codons = [seq[codon_site:codon_site+3]
+              for codon_site in range(0, len(seq) - 2, 3)]
+    if (ambig_char == '?' and translate_mixtures and not resolve and
+            not return_list and not list_ambiguous and stats is None):
+        try:
+            return ''.join([amino_table[codon] for codon in codons])
+        except KeyError:
+            pass  # unusual characters, use the full rules below
     aa_list = []
-    aa_seq = ''  # use to align against reference, for resolving indels
+    aa_seq = []  # use to align against reference, for resolving indels
     if stats is not None:
         stats['ambiguous'] = 0
-        stats['length'] = 0
+        stats['length'] = len(codons)
         stats['max_aminos'] = 1 if seq else 0
 
     # loop over codon sites in nucleotide sequence
-    for codon_site in range(0, len(seq), 3):
-        codon = seq[codon_site:codon_site+3]
-
-        if len(codon) < 3:
-            break
-
-        if stats is not None:
-            stats['length'] += 1
-        # note that we're willing to handle a single missing nucleotide as an ambiguity
-        if codon.count('-') > 1 or '?' in codon:
-            if codon == '---':  # don't bother to translate incomplete codons
-                aa_seq += '-'
-                aa_list.append(['-'])
+    for codon in codons:
+        try:
+            kind, aminos = codon_table[codon]
+        except KeyError:
+            # unusual characters, only resolve the codon if it's needed
+            kind = _get_codon_kind(codon)
+            if kind == PLAIN_CODON:
+                aminos = _resolve_codon(codon, kind)
             else:
-                aa_seq += ambig_char
-                aa_list.append([ambig_char])
-            continue
-
-        # look for nucleotide mixtures in codon, resolve to alternative codons if found
-        num_mixtures = len(mixture_regex.findall(codon))
+                aminos = None
 
-        if num_mixtures == 0:
-            aa = codon_dict[codon]
-            aa_seq += aa
-            aa_list.append([aa])
+        # note that we're willing to handle a single missing nucleotide as an ambiguity
+        if kind == PARTIAL_CODON:
+            aa_seq.append(ambig_char)
+            aa_list.append([ambig_char])
+        elif kind == GAP_CODON or kind == PLAIN_CODON:
+            aa_seq.append(aminos[0])
+            aa_list.append([aminos[0]])
         elif not translate_mixtures and not list_ambiguous:
             if stats is not None:
                 stats['ambiguous'] += 1
-            aa_seq += ambig_char
+            aa_seq.append(ambig_char)
             aa_list.append([ambig_char])
         else:
-            # expand codon into all possible resolutions of mixtures
-            codons = [codon]
-            while True:
-                next_codons = []
-                for codon in codons:
-                    mixtures = mixture_regex.findall(codon)
-                    if len(mixtures) == 0:
-                        next_codons.append(codon)
-                        continue
-                    pos = codon.index(mixtures[0])
-                    for nuc in mixture_dict[mixtures[0]]:
-                        next_codons.append(codon[0:pos] + nuc + codon[(pos+1):])
-
-                if len(codons) == len(next_codons):
-                    # no change in number of codons, exit
-                    break
-                codons = next_codons
-
-            aminos = list(set([codon_dict[codon] for codon in codons]))
-            aa_list.append(aminos)
+            if aminos is None:
+                aminos = _resolve_codon(codon, kind)
+            aa_list.append(list(aminos))
 
             if len(aminos) > 1:
                 if stats is not None:
                     stats['ambiguous'] += 1
                     stats['max_aminos'] = max(len(aminos), stats['max_aminos'])
                 if list_ambiguous or return_list:
-                    aminos.sort()
-                    aa_seq += '[{}]'.format(''.join(aminos))
+                    aa_seq.append('[{}]'.format(''.join(aminos)))
                 elif resolve:
-                    aa_seq += aminos[0]  # arbitrary resolution
+                    aa_seq.append(aminos[0])  # arbitrary resolution
                 else:
-                    aa_seq += ambig_char
+                    aa_seq.append(ambig_char)
             else:
-                aa_seq += aminos[0]
+                aa_seq.append(aminos[0])
+    aa_seq = ''.join(aa_seq)
     return aa_list if return_list else aa_seq
 
 if __name__ == '__live_coding__':